@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Load test for the key server, through the client code TUIJam itself uses
+(tuijam.utility.query_key_server).
+
+Without --url, key_server_example.py is started in-process on a free local
+port, with its rate limit lifted unless --rate-limit is given. Clients cycle
+through --keypairs pre-generated RSA key pairs, so the client side's key
+generation doesn't swamp the measurement. By default there are twice as
+many key pairs as the server's cache holds, so cycling through them misses
+the cache and every request pays for the encryption, as TUIJam's own lookups
+(with a fresh key pair each) do. Generating them takes a while, on all
+cores. The cache hit ratio is read from the server's /metrics and reported.
+
+    python benchmarks/key_server_load.py --clients 16 --duration 10
+    python benchmarks/key_server_load.py --url http://localhost:5000 -o load.json
+"""
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from os.path import abspath, dirname
+import argparse
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import requests  # noqa: E402
+import rsa  # noqa: E402
+
+from tuijam.utility import query_key_server, KEY_IDS  # noqa: E402
+
+# Twice key_server_example.CACHE_SIZE, so that a key pair has long left
+# the cache when clients come round to it again, even out of order
+DEFAULT_KEYPAIRS = 2048
+
+
+def start_server(rate_limit):
+    from werkzeug.serving import make_server
+
+    import key_server_example as server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no access log
+
+    server.encrypt_keys.cache_clear()
+
+    if rate_limit is None:
+        server.limiter.rate = server.limiter.burst = float("inf")
+    else:
+        server.limiter.rate = rate_limit
+
+    httpd = make_server("127.0.0.1", 0, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}", httpd
+
+
+def cache_hits(url):
+    """The server's key_server.cache_hits counter, or None if it has none."""
+    try:
+        text = requests.get(url + "/metrics", timeout=10).text
+    except requests.RequestException:
+        return None
+
+    for line in text.splitlines():
+        if line.startswith('tuijam_events_total{name="key_server.cache_hits"}'):
+            return int(line.split()[-1])
+    return 0 if "tuijam_events_total" in text else None
+
+
+def quantile(timings, q):
+    return timings[min(len(timings) - 1, int(q * len(timings)))]
+
+
+def run(url, clients, duration, keypairs):
+    keypairs = itertools.cycle(keypairs)
+    keypair_lock = threading.Lock()
+    timings, outcomes = [], Counter()
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        session_timings, session_outcomes = [], Counter()
+
+        while time.perf_counter() < deadline:
+            with keypair_lock:
+                keypair = next(keypairs)
+
+            start = time.perf_counter()
+            try:
+                keys = query_key_server(url, KEY_IDS, keypair=keypair)
+                session_outcomes["ok" if len(keys) == len(KEY_IDS) else "incomplete"] += 1
+            except requests.HTTPError as e:
+                session_outcomes[str(e.response.status_code)] += 1
+            except requests.RequestException as e:
+                session_outcomes[type(e).__name__] += 1
+            session_timings.append(time.perf_counter() - start)
+
+        with results_lock:
+            timings.extend(session_timings)
+            outcomes.update(session_outcomes)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    timings.sort()
+    return dict(
+        url=url,
+        clients=clients,
+        duration=elapsed,
+        requests=len(timings),
+        throughput=len(timings) / elapsed,
+        outcomes=dict(outcomes),
+        latency={
+            "p50": quantile(timings, 0.5),
+            "p90": quantile(timings, 0.9),
+            "p99": quantile(timings, 0.99),
+            "max": timings[-1],
+        }
+        if timings
+        else {},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a TUIJam key server.")
+    parser.add_argument("--url", help="server to test (default: an in-process one)")
+    parser.add_argument("-c", "--clients", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=10)
+    parser.add_argument("--keypairs", type=int, default=DEFAULT_KEYPAIRS)
+    parser.add_argument(
+        "--rate-limit", type=float, help="requests/s per client for the in-process server"
+    )
+    parser.add_argument("-o", "--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    httpd = None
+    url = args.url
+    if url is None:
+        url, httpd = start_server(args.rate_limit)
+
+    print(f"generating {args.keypairs} RSA key pairs")
+    with ProcessPoolExecutor() as executor:
+        keypairs = list(executor.map(rsa.newkeys, [512] * args.keypairs, chunksize=16))
+
+    hits_before = cache_hits(url)
+    results = run(url, args.clients, args.duration, keypairs)
+    hits_after = cache_hits(url)
+
+    if hits_before is not None and hits_after is not None and results["requests"]:
+        results["cache_hits"] = hits_after - hits_before
+        results["cache_hit_ratio"] = results["cache_hits"] / results["requests"]
+
+    print(
+        f"{results['requests']} requests in {results['duration']:.1f} s, "
+        f"{results['throughput']:.1f} req/s, outcomes {results['outcomes']}"
+    )
+    if "cache_hit_ratio" in results:
+        print(f"  cache hits {results['cache_hits']} ({results['cache_hit_ratio']:.1%})")
+    for name, seconds in results["latency"].items():
+        print(f"  {name:<4} {seconds * 1000:8.2f} ms")
+
+    if httpd is not None:
+        results["server_metrics"] = requests.get(url + "/metrics").text
+        httpd.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
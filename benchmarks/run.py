@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the model, persistence and widget hot paths.
+
+All data is synthetic and seeded, so runs are reproducible and need no
+network access. Results are written as JSON; pass --compare with the JSON of
+an earlier run to see the relative change of every benchmark.
+
+    python benchmarks/run.py -o bench.json
+    python benchmarks/run.py --quick --compare bench.json
+"""
+from os.path import abspath, dirname
+from statistics import mean, median
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from tuijam import __version__  # noqa: E402
+from tuijam.music_objects import (  # noqa: E402
+    Song,
+    Album,
+    Playlist,
+    Situation,
+    YTVideo,
+    serialize,
+    deserialize,
+)
+from tuijam.synthetic import Catalog, track_dicts  # noqa: E402
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+class BenchApp:
+    """The few App attributes the panels touch, with no player or backend."""
+
+    loop = None
+    lastfm = None
+    current_song = None
+
+    def __init__(self):
+        from tuijam.prefetch import Prefetcher
+
+        self.prefetcher = Prefetcher(self)
+        self.prefetcher.enabled = False
+
+    def play(self, song):
+        self.current_song = song
+        return True
+
+    def stop(self):
+        pass
+
+
+class Runner:
+    def __init__(self, repeat, scale):
+        self.repeat = repeat
+        self.scale = scale
+        self.results = []
+
+    def n(self, count):
+        return max(1, int(count * self.scale))
+
+    def time(self, name, fn, setup=None, n=None):
+        """
+        Times fn(state) `repeat` times, where state is the return value of a
+        fresh call to setup() that is excluded from the timing.
+        """
+        timings = []
+
+        for _ in range(self.repeat):
+            state = setup() if setup else None
+            start = time.perf_counter()
+            fn(state)
+            timings.append(time.perf_counter() - start)
+
+        result = dict(
+            name=name,
+            n=n,
+            repeat=self.repeat,
+            min=min(timings),
+            median=median(timings),
+            mean=mean(timings),
+        )
+        self.results.append(result)
+        print(f"{name:<45} n={n or '':<8} median={result['median'] * 1000:10.3f} ms")
+
+
+@benchmark
+def from_dict(r):
+    tracks = track_dicts(r.n(100000))
+    r.time("Song.from_dict", lambda _: [Song.from_dict(d) for d in tracks], n=len(tracks))
+
+    catalog = Catalog(seed=1, n_playlists=r.n(200), playlist_size=100, n_videos=0)
+    r.time(
+        "Playlist.from_dict",
+        lambda _: [Playlist.from_dict(d) for d in catalog.playlists],
+        n=len(catalog.playlists),
+    )
+
+    situations = [Catalog(seed=i, n_artists=1, n_playlists=0, n_videos=0).situations for i in range(r.n(50))]
+    situations = [s for group in situations for s in group]
+    r.time(
+        "Situation.from_dict",
+        lambda _: [Situation.from_dict(d) for d in situations],
+        n=len(situations),
+    )
+
+
+@benchmark
+def persistence(r):
+    videos = [YTVideo.from_dict(d) for d in Catalog(seed=2, n_artists=1, n_videos=100).videos]
+
+    for count in (1000, 10000, 100000):
+        count = r.n(count)
+        songs = [Song.from_dict(d) for d in track_dicts(count)]
+        objs = songs + videos[: count // 10]
+        blob = serialize(objs)
+
+        r.time(f"serialize[{count}]", lambda _: serialize(objs), n=len(objs))
+        r.time(f"deserialize[{count}]", lambda _: deserialize(blob), n=len(objs))
+
+
+@benchmark
+def search_panel(r):
+    import urwid
+    from tuijam.ui import SearchPanel
+
+    catalog = Catalog(seed=3, n_videos=200)
+    categories = (
+        [Song.from_dict(d) for d in catalog.tracks[: r.n(2000)]],
+        [Album.from_dict(d) for d in catalog.albums],
+        [YTVideo.from_dict(d) for d in catalog.videos],
+    )
+
+    def setup():
+        panel = SearchPanel(BenchApp())
+        panel.line_box = urwid.LineBox(panel)
+        panel.no_limit = True
+        return panel
+
+    def set_results(panel):
+        panel.no_limit = True
+        panel.set_search_results(categories)
+
+    n_rows = sum(len(c) for c in categories)
+    r.time("SearchPanel.set_search_results", set_results, setup, n=n_rows)
+
+    def setup_selected():
+        panel = setup()
+        set_results(panel)
+        return panel
+
+    def select_all(panel):
+        for pos in range(len(panel.walker)):
+            panel.walker.set_focus(pos)
+            panel.selected_search_obj()
+
+    r.time("SearchPanel.selected_search_obj", select_all, setup_selected, n=n_rows)
+
+    def scroll(panel):
+        for _ in range(n_scroll):
+            panel.keypress((120, 40), "down")
+            panel.render((120, 40), focus=True)
+
+    n_scroll = min(n_rows - 1, r.n(1000))
+    r.time("SearchPanel.scroll", scroll, setup_selected, n=n_scroll)
+
+
+@benchmark
+def queue_panel(r):
+    from tuijam.ui import QueuePanel
+
+    songs = [Song.from_dict(d) for d in track_dicts(r.n(20000))]
+    ops = r.n(1000)
+    rng = random.Random(4)
+
+    def setup_empty():
+        return QueuePanel(BenchApp())
+
+    def setup_full():
+        panel = setup_empty()
+        panel.add_songs_to_queue(songs)
+        return panel
+
+    r.time("QueuePanel.add_songs_to_queue", lambda q: q.add_songs_to_queue(songs), setup_empty, n=len(songs))
+    r.time("QueuePanel.shuffle", lambda q: q.shuffle(), setup_full, n=len(songs))
+
+    def play_next(q):
+        for _ in range(ops):
+            q.play_next()
+
+    r.time("QueuePanel.play_next", play_next, setup_full, n=ops)
+
+    def to_top(q):
+        for _ in range(ops):
+            q.to_top(rng.randrange(len(q.queue)))
+
+    r.time("QueuePanel.to_top", to_top, setup_full, n=ops)
+
+    def drop(q):
+        for _ in range(ops):
+            q.drop(rng.randrange(len(q.queue)))
+
+    r.time("QueuePanel.drop", drop, setup_full, n=ops)
+
+    def move_range(q):
+        for _ in range(ops):
+            start = rng.randrange(len(q.queue) - 100)
+            q.move_range(start, start + 100, rng.randrange(len(q.queue) - 100))
+
+    r.time("QueuePanel.move_range[100]", move_range, setup_full, n=ops)
+
+    def type_filter(q):
+        for end in range(1, len(pattern) + 1):
+            q.set_filter(pattern[:end])
+        q.end_filter(True)
+
+    pattern = songs[len(songs) // 2].title[:6] + " " + songs[len(songs) // 2].artist[:3]
+    r.time("QueuePanel.set_filter[keystroke]", type_filter, setup_full, n=len(pattern))
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {res["name"]: res for res in json.load(f)["results"]}
+
+    print(f"\ncompared to {baseline_file}:")
+    for res in results:
+        old = baseline.get(res["name"])
+        if old and old["median"] > 0:
+            change = (res["median"] / old["median"] - 1) * 100
+            print(f"{res['name']:<45} {change:+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the TUIJam benchmarks.")
+    parser.add_argument("-o", "--output", default="bench.json")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="run at a tenth of the size")
+    parser.add_argument("--compare", metavar="JSON", help="results of an earlier run")
+    parser.add_argument("-k", dest="select", help="only run benchmarks matching this")
+    args = parser.parse_args()
+
+    runner = Runner(args.repeat, 0.1 if args.quick else 1.0)
+
+    for bench in BENCHMARKS:
+        if args.select is None or args.select in bench.__name__:
+            bench(runner)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            dict(
+                version=__version__,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                timestamp=time.time(),
+                scale=runner.scale,
+                results=runner.results,
+            ),
+            f,
+            indent=2,
+        )
+
+    if args.compare:
+        compare(runner.results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,196 @@
 #!/usr/bin/env python
-import rsa
+"""
+Serves the API keys TUIJam asks for (see tuijam.utility.lookup_keys), each
+encrypted with the public RSA key sent along with the request.
+
+    python key_server_example.py --port 5000
+    gunicorn -w 4 key_server_example:app
+
+RSA is CPU bound, so run several worker processes (gunicorn -w) to use more
+than one core; the rate limits and the cache are then per worker.
+
+Requests are checked before any RSA work is done: bodies over MAX_BODY
+bytes, malformed JSON, keys that aren't PKCS#1 PEM or are too small or too
+large all get a 4xx straight away. Each client address has a token bucket of
+RATE_BURST requests that refills at RATE_PER_SEC. Encrypted answers are kept
+in an LRU cache per (public key, ids). TUIJam makes a fresh key pair for each
+lookup, so the cache only spares the work of retries that resend the same
+key, like a client whose connection dropped before the answer arrived. GET
+/metrics serves request counts and latencies (and cache hits) in the
+Prometheus text format.
+Set KEY_SERVER_BEHIND_PROXY=1 to rate limit by X-Forwarded-For.
+"""
+from collections import OrderedDict
+from functools import lru_cache
 import base64
-from flask import Flask, request, jsonify
+import os
+import threading
+import time
+
+import rsa
+from flask import Flask, request, jsonify, g
+
+from tuijam.metrics import Metrics
 
 KEYS = dict(
-    LASTFM_API_KEY="REDACTED",
-    LASTFM_API_SECRET="READACTED",
-    GOOGLE_DEVELOPER_KEY="READACTED",
+    LASTFM_API_KEY=os.environ.get("LASTFM_API_KEY", "REDACTED"),
+    LASTFM_API_SECRET=os.environ.get("LASTFM_API_SECRET", "READACTED"),
+    GOOGLE_DEVELOPER_KEY=os.environ.get("GOOGLE_DEVELOPER_KEY", "READACTED"),
 )
 
+MAX_BODY = 4096
+MAX_PUBLIC_KEY = 2048  # characters of PEM
+KEY_BITS = (512, 4096)
+RATE_PER_SEC = 1.0
+RATE_BURST = 10
+MAX_CLIENTS = 10000
+CACHE_SIZE = 1024
+
+PEM_HEADER = "-----BEGIN RSA PUBLIC KEY-----"
+
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_BODY
 
+if os.environ.get("KEY_SERVER_BEHIND_PROXY"):
+    from werkzeug.middleware.proxy_fix import ProxyFix
+
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
+metrics = Metrics()
+
+
+class BadRequest(Exception):
+    pass
+
+
+class RateLimiter:
+    """A token bucket per client, for the MAX_CLIENTS most recent clients."""
+
+    def __init__(self, rate=RATE_PER_SEC, burst=RATE_BURST, max_clients=MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()  # client -> (tokens, time of last update)
+        self.lock = threading.Lock()
+
+    def allow(self, client):
+        """Whether client may make a request now, and if not, when it may."""
+        now = time.monotonic()
+
+        with self.lock:
+            tokens, last = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+
+        return allowed, 0 if allowed else (1 - tokens) / self.rate
+
+
+limiter = RateLimiter()
+
+
+def parse_request(data):
+    """(public key PEM, ids) of a request body, or raises BadRequest."""
+    if not isinstance(data, dict):
+        raise BadRequest("expected a JSON object")
+
+    public_key, ids = data.get("public_key"), data.get("ids")
+
+    if (
+        not isinstance(public_key, str)
+        or len(public_key) > MAX_PUBLIC_KEY
+        or not public_key.lstrip().startswith(PEM_HEADER)
+    ):
+        raise BadRequest("public_key must be a PKCS#1 PEM RSA public key")
+
+    if (
+        not isinstance(ids, list)
+        or not 0 < len(ids) <= len(KEYS)
+        or not all(isinstance(id_, str) for id_ in ids)
+    ):
+        raise BadRequest(f"ids must be a list of at most {len(KEYS)} key names")
+
+    # Unknown ids are left out of the answer, so clients may ask for more
+    # keys than a given server has
+    return public_key, tuple(sorted(set(ids) & KEYS.keys()))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def encrypt_keys(public_key, ids):
+    try:
+        pub_key = rsa.PublicKey.load_pkcs1(public_key.encode())
+    except Exception:
+        raise BadRequest("public_key must be a PKCS#1 PEM RSA public key")
+
+    if not KEY_BITS[0] <= pub_key.n.bit_length() <= KEY_BITS[1]:
+        raise BadRequest(f"public_key must have {KEY_BITS[0]} to {KEY_BITS[1]} bits")
 
-@app.route("/", methods=["POST"])
-def query():
-    req_data = request.json
-    pub_key = rsa.PublicKey.load_pkcs1(req_data["public_key"])
     keys = {}
-    for id_ in req_data["ids"]:
+    for id_ in ids:
         crypt_bytes = rsa.encrypt(KEYS[id_].encode(), pub_key)
         b64_utf = base64.encodebytes(crypt_bytes).decode()
         keys[id_] = b64_utf
+    return keys
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record(response):
+    endpoint = request.endpoint or "unknown"
+    metrics.observe(f"key_server.{endpoint}", time.perf_counter() - g.start)
+    metrics.count(f"key_server.status.{response.status_code}")
+    return response
+
+
+@app.errorhandler(413)
+def too_large(e):
+    return jsonify(error=f"request bodies are limited to {MAX_BODY} bytes"), 413
+
+
+@app.route("/", methods=["POST"])
+def query():
+    allowed, retry_after = limiter.allow(request.remote_addr)
+    if not allowed:
+        metrics.count("key_server.rate_limited")
+        response = jsonify(error="too many requests")
+        response.headers["Retry-After"] = str(max(1, round(retry_after)))
+        return response, 429
+
+    try:
+        public_key, ids = parse_request(request.get_json(silent=True))
+
+        hits = encrypt_keys.cache_info().hits
+        with metrics.timer("key_server.encrypt"):
+            keys = encrypt_keys(public_key, ids)
+        if encrypt_keys.cache_info().hits > hits:
+            metrics.count("key_server.cache_hits")
+    except BadRequest as e:
+        return jsonify(error=str(e)), 400
+
     return jsonify(keys)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.to_prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve TUIJam's API keys.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,102 @@
+import pytest
+import urwid
+
+from tuijam.ui import MainLoop, NAVIGATION, move_list_focus
+
+SIZE = (20, 10)
+
+
+class Row(urwid.Text):
+    _selectable = True
+
+    def keypress(self, size, key):
+        return key
+
+
+def make_list(heading_rows=1, song_rows=1):
+    """100 rows with a heading every 10 rows, like a search result."""
+    rows = []
+    for i in range(100):
+        if i % 10:
+            rows.append(Row("\n".join([f"song {i}"] * song_rows)))
+        else:
+            rows.append(urwid.Text("\n".join([f"heading {i}"] * heading_rows)))
+    listbox = urwid.ListBox(urwid.SimpleFocusListWalker(rows))
+    listbox.set_focus(1)
+    listbox.render(SIZE, focus=True)
+    return listbox
+
+
+def state(listbox):
+    canvas = listbox.render(SIZE, focus=True)
+    return listbox.focus_position, canvas.text
+
+
+def press(listbox, key, times):
+    for _ in range(times):
+        listbox.keypress(SIZE, key)
+        listbox.render(SIZE, focus=True)
+
+
+@pytest.mark.parametrize("heading_rows, song_rows", [(1, 1), (2, 1), (1, 3)])
+@pytest.mark.parametrize("down, up", [(37, 24), (5, 3), (9, 9), (120, 50), (60, 140)])
+def test_move_list_focus_matches_stepwise(heading_rows, song_rows, down, up):
+    stepwise = make_list(heading_rows, song_rows)
+    coalesced = make_list(heading_rows, song_rows)
+
+    press(stepwise, "down", down)
+    move_list_focus(coalesced, SIZE, down)
+    assert state(coalesced) == state(stepwise)
+
+    press(stepwise, "up", up)
+    move_list_focus(coalesced, SIZE, -up)
+    assert state(coalesced) == state(stepwise)
+
+
+class Panel(urwid.WidgetWrap):
+    """Stands in for App: every arrow key only moves the list's focus."""
+
+    def focus_step(self, key):
+        return NAVIGATION.get(key)
+
+    def move_focus(self, size, n):
+        move_list_focus(self._w, size, n)
+
+
+def coalesced_loop(listbox):
+    loop = MainLoop(Panel(listbox))
+    loop.screen_size = SIZE
+    return loop
+
+
+@pytest.mark.parametrize(
+    "start, keys",
+    [
+        (1, ["up", "up", "down"]),
+        (99, ["down", "down", "up"]),
+        (99, ["down", "up", "up", "down", "down", "down"]),
+        (5, ["down"] * 6 + ["up"] * 9 + ["down"] * 3),
+    ],
+)
+def test_process_input_matches_stepwise_across_direction_changes(start, keys):
+    stepwise = make_list()
+    coalesced = make_list()
+    for listbox in (stepwise, coalesced):
+        listbox.set_focus(start)
+        listbox.render(SIZE, focus=True)
+
+    for key in keys:
+        press(stepwise, key, 1)
+    coalesced_loop(coalesced).process_input(keys)
+
+    assert state(coalesced) == state(stepwise)
+
+
+def test_move_list_focus_reveals_heading_at_edge():
+    listbox = make_list()
+    move_list_focus(listbox, SIZE, 8)  # song 9, at the bottom of the view
+    move_list_focus(listbox, SIZE, 1)  # scrolls heading 10 into view
+
+    position, text = state(listbox)
+    assert position == 9
+    assert text[-1].strip() == b"heading 10"
@@ -9,4 +9,15 @@ LOG_FILE = join(CONFIG_DIR, "log.txt")
 HISTORY_FILE = join(CONFIG_DIR, "hist.json")
 QUEUE_FILE = join(CONFIG_DIR, "queue.json")
 CRED_FILE = join(CONFIG_DIR, "google_oauth.cred")
+STATION_CACHE_FILE = join(CONFIG_DIR, "stations.json")
+LIBRARY_FILE = join(CONFIG_DIR, "library.json")
+PLAYLIST_DIR = join(CONFIG_DIR, "playlists")
+RATINGS_FILE = join(CONFIG_DIR, "ratings.json")
+CONTROL_SOCKET = join(CONFIG_DIR, "control.sock")
+ART_CACHE_DIR = join(CONFIG_DIR, "art")
+ART_SIZES = (128, 256, 512)
+METRICS_FILE = join(CONFIG_DIR, "metrics.json")
+METRICS_PROM_FILE = join(CONFIG_DIR, "metrics.prom")
+PROFILE_DIR = join(CONFIG_DIR, "profiles")
+FAKE_DATA_DIR = join(CONFIG_DIR, "fake")
 LOCALE_DIR = join(CONFIG_DIR, "lang")
@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
 # coding=utf-8
-from os.path import join, isfile
-from os import makedirs
+from os.path import isfile, expanduser, join, relpath
+from os import makedirs, write
+from collections import deque
+from functools import partial
 import sys
 import locale
 
 import logging
+import time
 import urwid
 import gmusicapi
-import yaml
 
 from .music_objects import (
     Song,
@@ -18,32 +20,85 @@ from .music_objects import (
     RadioStation,
     Playlist,
     YTVideo,
+    LocalTrack,
 )
 from .music_objects import serialize, deserialize
-from .ui import SearchInput, SearchPanel, QueuePanel, PlayBar, controls, palette
-from tuijam import CONFIG_DIR, CONFIG_FILE, QUEUE_FILE, HISTORY_FILE, CRED_FILE, LOCALE_DIR, _
+from .ui import (
+    SearchInput,
+    SearchPanel,
+    QueuePanel,
+    PlayBar,
+    StatsPanel,
+    MainLoop,
+    controls,
+    palette,
+    DEFAULT_CONTROLS,
+    DEFAULT_PALETTE,
+    KeyDispatch,
+    compile_bindings,
+    bindings,
+    NAVIGATION,
+)
+from tuijam import CONFIG_DIR, QUEUE_FILE, HISTORY_FILE, CRED_FILE, LOCALE_DIR, _
+from tuijam import METRICS_FILE, METRICS_PROM_FILE, LOG_FILE, FAKE_DATA_DIR
+from tuijam import STATION_CACHE_FILE, PLAYLIST_DIR, RATINGS_FILE, ART_CACHE_DIR
+from tuijam import LIBRARY_FILE
 from tuijam.utility import lookup_keys
+from .config import config
 
 from .lastfm import LastFMAPI
+from .stations import StationCache
+from .playlists import PlaylistStore, LIKED_ID
+from .ratings import RatingQueue
+from .control import ControlServer
+from .prefetch import Prefetcher
+from .art_cache import ArtCache, remote_art_url
+from .metrics import metrics, Instrumented
+from .logs import setup_logging
+from .text_index import TokenIndex
+from .local_library import LocalLibrary
+from .providers import GoogleMusicProvider, YouTubeProvider, LocalProvider
 
 
 class App(urwid.Pile):
-    def __init__(self):
+    def __init__(self, data_dir=CONFIG_DIR):
         import mpv
 
+        # Where the queue, history and caches are kept. Fake and scripted
+        # sessions use their own, so they leave the real ones alone.
+        self.data_dir = data_dir
+        makedirs(data_dir, exist_ok=True)
+
         self.player = mpv.MPV()
         self.player.volume = 100
         self.player["vid"] = "no"
         self.volume = 8
-        self.g_api = None
+        self.gmusic = None
         self.loop = None
         self.config_pw = None
         self.reached_end_of_track = False
+        self.seeking = False
+        self.play_started = None
         self.lastfm = None
         self.youtube = None
+        self.local = None
+        self.providers = []
+        self.fake_backend = None
+        self.local_library = None
+        self.profiler = None
         self.mpris = None
+        self.control = None
         self.vim_mode = None
         self.vim_insert = False
+        self.station_cache = StationCache(self.data_path(STATION_CACHE_FILE))
+        self.playlist_store = PlaylistStore(self.data_path(PLAYLIST_DIR))
+        self.ratings = RatingQueue(self, self.data_path(RATINGS_FILE))
+        self.prefetcher = Prefetcher(self)
+        self.art_cache = ArtCache(self, self.data_path(ART_CACHE_DIR))
+        self.main_calls = deque()
+        self.wake_fd = None
+        self.config_alarm = None
+        self.config_generation = None
 
         @self.player.event_callback("end_file")
         def end_file_callback(event):
@@ -55,6 +110,20 @@ class App(urwid.Pile):
                     self.current_song.lastfm_scrobbled = False
                 self.schedule_refresh(dt=0.01)
 
+        @self.player.event_callback("playback_restart")
+        def playback_restart_callback(event):
+
+            if self.seeking:
+                self.seeking = False
+                if self.mpris:
+                    self.call_in_main(self.mpris.seeked)
+
+            elif self.play_started is not None:
+                metrics.observe(
+                    "play.time_to_first_audio", time.perf_counter() - self.play_started
+                )
+                self.play_started = None
+
         self.search_panel = SearchPanel(self)
         search_panel_wrapped = urwid.LineBox(self.search_panel, title=_("Search Results"))
 
@@ -72,6 +141,7 @@ class App(urwid.Pile):
 
         self.queue_panel = QueuePanel(self)
         queue_panel_wrapped = urwid.LineBox(self.queue_panel, title=_("Queue"))
+        self.queue_panel.line_box = queue_panel_wrapped
 
         queue_panel_wrapped = urwid.AttrMap(
             queue_panel_wrapped, "region_bg normal", "region_bg select"
@@ -93,18 +163,81 @@ class App(urwid.Pile):
 
         self.set_focus(self.search_input)
 
+        self.focus_keys = KeyDispatch(
+            "focus", dict(g_focus_next=self.focus_next, g_focus_prev=self.focus_prev)
+        )
+        self.playback_keys = KeyDispatch(
+            "playback",
+            dict(
+                g_play_pause=self.toggle_play,
+                g_stop=self.stop,
+                g_play_next=self.queue_panel.play_next,
+                g_play_previous=self.queue_panel.play_previous,
+                g_recent=self.view_recent,
+                g_shuffle=self.queue_panel.shuffle,
+                g_rate_good=partial(self.rate_current_song, 5),
+                g_rate_bad=partial(self.rate_current_song, 1),
+                g_clear_queue=self.queue_panel.clear,
+                g_queue_all=self.queue_all,
+                g_stats=self.toggle_stats,
+            ),
+        )
+        self.panel_keys = KeyDispatch(
+            "panels",
+            dict(
+                seek_pos=partial(self.seek, 10),
+                seek_neg=partial(self.seek, -10),
+                vol_down=self.volume_down,
+                vol_up=self.volume_up,
+                focus_search=self.focus_search,
+            ),
+        )
+        # (key, focus, app size, panel, panel size) of the navigation key
+        # just pressed, while its repeats can go to the panel straight away
+        self.held = None
+        self.key_size = None
+
+        self.stats_panel = StatsPanel(self)
+        self.stats_alarm = None
+        self.metrics_export = None
+        self.metrics_export_interval = 60
+        self.metrics_alarm = None
+
         self.play_state = "stop"
         self.current_song = None
         self.history = []
+        self.history_index = TokenIndex()
+
+    def data_path(self, path):
+        """The place of path, a file in CONFIG_DIR, in the data directory."""
+        return join(self.data_dir, relpath(path, CONFIG_DIR))
 
     def pop_from_history(self):
         if len(self.history) > 0:
-            return self.history.pop(0)
+            song = self.history.pop(0)
+            self.history_index.remove([song])
+            return song
 
-    def login(self):
-        self.g_api = gmusicapi.Mobileclient(debug_logging=False)
+    def login(self, fake_backend=None):
         self.load_config()
 
+        if fake_backend is not None:
+            from .fake_backend import setup_fake_backend
+
+            self.fake_backend = fake_backend
+            g_api, youtube = setup_fake_backend(fake_backend or None)
+            self.gmusic = GoogleMusicProvider(Instrumented(g_api, "gmusic"))
+            self.youtube = YouTubeProvider(youtube, stream_url_for=youtube.stream_url)
+        else:
+            self.login_online()
+
+        self.providers = [
+            provider for provider in (self.gmusic, self.local, self.youtube) if provider
+        ]
+
+    def login_online(self):
+        g_api = Instrumented(gmusicapi.Mobileclient(debug_logging=False), "gmusic")
+
         if not isfile(CRED_FILE):
             from oauth2client.client import FlowExchangeError
 
@@ -113,12 +246,13 @@ class App(urwid.Pile):
             print(_("permission for TUIJam to access your Google Play Music account."))
             input(_("Press enter to continue."))
             try:
-                self.g_api.perform_oauth(CRED_FILE, open_browser=True)
+                g_api.perform_oauth(CRED_FILE, open_browser=True)
             except FlowExchangeError:
                 raise RuntimeError(_("Oauth authentication Failed."))
 
-        self.g_api.oauth_login(self.g_api.FROM_MAC_ADDRESS, CRED_FILE,
-                               locale=locale.getdefaultlocale()[0])
+        g_api.oauth_login(g_api.FROM_MAC_ADDRESS, CRED_FILE,
+                          locale=locale.getdefaultlocale()[0])
+        self.gmusic = GoogleMusicProvider(g_api)
 
         if self.lastfm_sk is not None:
             try:
@@ -132,47 +266,173 @@ class App(urwid.Pile):
 
         try:
             developer_key, = lookup_keys("GOOGLE_DEVELOPER_KEY")
-            self.youtube = build("youtube", "v3", developerKey=developer_key)
+            self.youtube = YouTubeProvider(
+                build("youtube", "v3", developerKey=developer_key)
+            )
         except Exception:
-            self.youtube = None
+            # Queued and restored videos still play, through youtu.be links
+            self.youtube = YouTubeProvider()
             print(_("Could not retrieve YouTube key."))
-            print(_("YouTube will not be available."))
+            print(_("YouTube search will not be available."))
 
     def load_config(self):
-        if not isfile(CONFIG_FILE):
-            with open(CONFIG_FILE, "w") as outfile:
-                yaml.safe_dump(
-                    dict(
-                        mpris_enabled=True,
-                        persist_queue=True,
-                        reverse_scrolling=False,
-                        video=False,
-                        vim=False,
-                        use_terminal_colors=False,
-                        palette=palette,
-                    ),
-                    outfile,
-                    default_flow_style=False,
-                )
+        config.write_defaults(palette=DEFAULT_PALETTE)
+        config.load()
+
+        # Only read at startup, these need a restart to change
+        self.lastfm_sk = config.get("lastfm_sk", None)
+        self.mpris_enabled = config.get("mpris_enabled", True)
+        self.control_socket = config.get("control_socket", False)
+
+        local_dirs = config.get("local_music_dirs", [])
+        if local_dirs:
+            self.local_library = LocalLibrary(
+                self,
+                local_dirs,
+                path=self.data_path(LIBRARY_FILE),
+                watch=config.get("local_music_watch", True),
+            )
+            self.local = LocalProvider(self.local_library)
+
+        self.apply_config()
+
+    def apply_config(self):
+        """Applies the options that can change while TUIJam is running."""
+        controls.clear()
+        controls.update(DEFAULT_CONTROLS)
+        controls.update(config.get("controls", {}))
+        for k, v in controls.items():
+            if type(v) is str:
+                controls[k] = [v]
+
+        for key, actions in compile_bindings():
+            logging.warning(f"Key {key!r} is bound to more than one action: {', '.join(actions)}")
+        self.held = None
+
+        palette.clear()
+        palette.update(DEFAULT_PALETTE)
+        palette.update(config.get("palette", {}))
+
+        self.persist_queue = config.get("persist_queue", True)
+        self.reverse_scrolling = config.get("reverse_scrolling", False)
+        self.video = config.get("video", False)
+        self.vim_mode = config.get("vim_mode", False)
+        if not self.vim_mode:
+            self.vim_insert = False
+        self.use_terminal_colors = config.get("use_terminal_colors", False)
+        self.prefetcher.enabled = config.get("prefetch", True)
+        self.art_cache.max_bytes = config.get("art_cache_size_mb", 100) * 2 ** 20
+        self.art_cache.size = config.get("art_size", 512)
+        self.queue_panel.dedup = config.get("queue_dedup", "allow")
+        if self.queue_panel.dedup not in QueuePanel.DEDUP_POLICIES:
+            logging.warning(f"Unknown queue_dedup {self.queue_panel.dedup}, allowing duplicates")
+            self.queue_panel.dedup = "allow"
+        search_history = self.search_panel.search_history
+        search_history.max_depth = config.get("search_history_depth", 50)
+        search_history.max_bytes = config.get("search_history_size_mb", 32) * 2 ** 20
+        self.metrics_export = config.get("metrics_export", None)
+        self.metrics_export_interval = config.get("metrics_export_interval", 60)
+        self.config_generation = config.generation
+
+    def reload_config(self, *args):
+        """Re-applies config.yaml if it changed, leaving playback alone."""
+        config.load()
+        if config.generation == self.config_generation:
+            return
+
+        logging.info("Reloading the configuration")
+        self.apply_config()
+
+        self.player["vid"] = "auto" if self.video else "no"
+        if self.metrics_alarm is None:
+            self.schedule_metrics_export()
 
-        with open(CONFIG_FILE) as f:
-            config = yaml.safe_load(f.read())
+        if self.loop is not None:
+            self.register_palette()
+            self.loop.screen.clear()
 
-            controls.update(config.get("controls", {}))
-            for k, v in controls.items():
-                if type(v) is str:
-                    controls[k] = [v]
+    def register_palette(self):
+        self.loop.screen.register_palette(
+            [(k.replace("-", " "), "", "", "", fg, bg) for k, (fg, bg) in palette.items()]
+        )
+
+    def watch_config(self, *args):
+        """Checks config.yaml for changes every config.poll_interval seconds."""
+        if config.changed():
+            self.reload_config()
+        self.config_alarm = self.loop.set_alarm_in(config.poll_interval, self.watch_config)
 
-            palette.update(config.get("palette", {}))
+    def call_in_main(self, fn, *args):
+        """Runs fn(*args) on the urwid loop. Safe to call from any thread."""
+        self.main_calls.append((fn, args))
 
-            self.lastfm_sk = config.get("lastfm_sk", None)
+        if self.wake_fd is not None:
+            write(self.wake_fd, b"\0")
 
-            self.mpris_enabled = config.get("mpris_enabled", True)
-            self.persist_queue = config.get("persist_queue", True)
-            self.reverse_scrolling = config.get("reverse_scrolling", False)
-            self.video = config.get("video", False)
-            self.vim_mode = config.get("vim_mode", False)
-            self.use_terminal_colors = config.get("use_terminal_colors", False)
+    def run_main_calls(self, data=None):
+        while self.main_calls:
+            fn, args = self.main_calls.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.exception(e)
+
+        return True  # keep the wake-up pipe open
+
+    def art_fetched(self, url):
+        if not self.mpris:
+            return
+
+        if url == remote_art_url(self.current_song):
+            self.mpris.emit_property_changed("Metadata")
+
+        self.mpris.art_fetched(url)
+
+    def toggle_stats(self):
+        if self.loop.widget is self:
+            self.loop.widget = urwid.Overlay(
+                self.stats_panel,
+                self,
+                "center",
+                ("relative", 80),
+                "middle",
+                ("relative", 70),
+            )
+            self.update_stats()
+        else:
+            self.loop.widget = self
+            if self.stats_alarm is not None:
+                self.loop.remove_alarm(self.stats_alarm)
+                self.stats_alarm = None
+
+    def update_stats(self, *args):
+        self.stats_panel.update()
+        self.stats_alarm = self.loop.set_alarm_in(1, self.update_stats)
+
+    def export_metrics(self, *args):
+        if args:
+            self.metrics_alarm = None
+
+        if self.metrics_export == "prometheus":
+            path = self.data_path(METRICS_PROM_FILE)
+        elif self.metrics_export == "json":
+            path = self.data_path(METRICS_FILE)
+        else:
+            return
+
+        try:
+            metrics.export(path, self.metrics_export)
+        except OSError as e:
+            logging.warning(f"Could not export metrics: {e}")
+
+        if args:  # called from the loop, keep exporting
+            self.schedule_metrics_export()
+
+    def schedule_metrics_export(self):
+        if self.metrics_export:
+            self.metrics_alarm = self.loop.set_alarm_in(
+                self.metrics_export_interval, self.export_metrics
+            )
 
     def refresh(self, *args, **kwargs):
         if self.play_state == "play" and self.reached_end_of_track:
@@ -186,19 +446,28 @@ class App(urwid.Pile):
             self.schedule_refresh()
 
         song = self.current_song
-        if self.lastfm and isinstance(song, Song):
+        if self.lastfm and isinstance(song, (Song, LocalTrack)):
             progress, _ = self.playbar.get_prog_tot()
             self.lastfm.scrobble_song(song, progress)
 
     def schedule_refresh(self, dt=0.5):
         self.loop.set_alarm_in(dt, self.refresh)
 
+    def provider_for(self, obj):
+        for provider in self.providers:
+            if provider.plays(obj):
+                return provider
+
     def play(self, song):
+        self.play_started = time.perf_counter()
+
+        provider = self.provider_for(song)
+        if provider is None:
+            logging.warning(f"No provider can play {song!r}")
+            return False
+
         try:
-            if isinstance(song, Song):
-                song.stream_url = self.g_api.get_stream_url(song.id)
-            else:  # YTVideo
-                song.stream_url = f"https://youtu.be/{song.id}"
+            song.stream_url = provider.stream_url(song)
         except Exception as e:
             logging.exception(e)
             return False
@@ -211,11 +480,14 @@ class App(urwid.Pile):
         self.playbar.update()
     
         self.history.insert(0, song)
+        self.history_index.add([song])
+        self.history_index.remove(self.history[100:])
         self.history = self.history[:100]
     
         self.schedule_refresh()
 
         if self.mpris:
+            self.art_cache.prefetch([song] + self.queue_panel.queue[:3])
             self.mpris.emit_property_changed("PlaybackStatus")
             self.mpris.emit_property_changed("Metadata")
         return True
@@ -235,9 +507,19 @@ class App(urwid.Pile):
 
     def seek(self, dt):
         try:
+            self.seeking = True
             self.player.seek(dt)
         except SystemError:
-            pass
+            self.seeking = False
+
+        self.playbar.update()
+
+    def seek_to(self, position):
+        try:
+            self.seeking = True
+            self.player.seek(position, reference="absolute")
+        except SystemError:
+            self.seeking = False
 
         self.playbar.update()
 
@@ -261,99 +543,157 @@ class App(urwid.Pile):
         if self.mpris:
             self.mpris.emit_property_changed("PlaybackStatus")
 
-    def volume_down(self):
-        self.volume = max([0, self.volume - 1])
+    def set_volume(self, volume):
+        self.volume = max(0, min(8, volume))
         self.player.volume = int(self.volume * 100 / 8)
         self.playbar.update()
 
         if self.mpris:
             self.mpris.emit_property_changed("Volume")
 
-    def volume_up(self):
-        self.volume = min([8, self.volume + 1])
-        self.player.volume = int(self.volume * 100 / 8)
-        self.playbar.update()
+    def volume_down(self):
+        self.set_volume(self.volume - 1)
 
-        if self.mpris:
-            self.mpris.emit_property_changed("Volume")
+    def volume_up(self):
+        self.set_volume(self.volume + 1)
 
+    @metrics.timed("input.keypress")
     def keypress(self, size, key):
+        held = self.held
+        if held is not None and held[0] == key and held[1] is self.focus and held[2] == size:
+            # Likely held down, and none of the app's own keys
+            _, _, _, panel, panel_size = held
+            return panel.keypress(panel_size, key)
+        self.held = None
+
         vim_insert_cache = self.vim_insert
         if self.vim_mode and key == "esc":
             self.vim_insert = False
         elif self.vim_mode and key == "i":
             self.vim_insert = True
             self.set_focus(self.search_input)
-        if key in controls["g_focus_next"]:
-            self.vim_insert = False
-            current_focus = self.focus
-            if current_focus == self.search_panel_wrapped:
-                self.set_focus(self.queue_panel_wrapped)
-            elif current_focus == self.queue_panel_wrapped:
-                self.set_focus(self.search_input)
-            else:
-                self.set_focus(self.search_panel_wrapped)
-        elif key in controls["g_focus_prev"]:
-            self.vim_insert = False
-            current_focus = self.focus
-            if current_focus == self.search_panel_wrapped:
-                self.set_focus(self.search_input)
-            elif current_focus == self.queue_panel_wrapped:
-                self.set_focus(self.search_panel_wrapped)
-            else:
-                self.set_focus(self.queue_panel_wrapped)
+
+        handler = self.focus_keys.get(key)
+        if handler is not None:
+            handler()
+
         if not self.vim_mode or not vim_insert_cache:
-            if key in controls["g_play_pause"]:
-                self.toggle_play()
-            elif key in controls["g_stop"]:
-                self.stop()
-            elif key in controls["g_play_next"]:
-                self.queue_panel.play_next()
-            elif key in controls["g_play_previous"]:
-            	self.queue_panel.play_previous()
-            elif key in controls["g_recent"]:
-                hist_songs = [item for item in self.history if isinstance(item, Song)]
-                hist_yt = [item for item in self.history if isinstance(item, YTVideo)]
-                self.search_panel.view_previous_songs(hist_songs, hist_yt)
-            elif key in controls["g_shuffle"]:
-                self.queue_panel.shuffle()
-            elif key in controls["g_rate_good"]:
-                self.rate_current_song(5)
-            elif key in controls["g_rate_bad"]:
-                self.rate_current_song(1)
-            elif key in controls["g_clear_queue"]:
-                self.queue_panel.clear()
-            elif key in controls["g_queue_all"]:
-                self.queue_panel.add_songs_to_queue(
-                    self.search_panel.search_results.songs
-                )
-            elif self.focus != self.search_input:
-                if key in controls["seek_pos"]:
-                    self.seek(10)
-                elif key in controls["seek_neg"]:
-                    self.seek(-10)
-                elif key in controls["vol_down"]:
-                    self.volume_down()
-                elif key in controls["vol_up"]:
-                    self.volume_up()
-                elif key in controls["focus_search"]:
-                    if self.vim_mode:
-                        self.vim_insert = True
-                    self.set_focus(self.search_input)
-                    return  # return here to avoid a "/" in the search input
+            handler = self.playback_keys.get(key)
+            if handler is None and self.focus != self.search_input:
+                handler = self.panel_keys.get(key)
+
+            if handler is not None:
+                handler()
+                if handler == self.focus_search:
+                    return  # to avoid a "/" in the search input
+
         if (
             not self.vim_mode
             or self.focus != self.search_input
             or (self.focus == self.search_input and vim_insert_cache)
         ):
-            return self.focus.keypress(size, key)
+            self.key_size = size
+            return self.focus.keypress(self.focus_size(size), key)
+
+    def focus_size(self, size):
+        """The size of the focused widget, within the app's own size."""
+        return self.get_item_size(size, self.focus_position, True)
+
+    def own_key(self, key):
+        """Whether key does anything before it reaches the focused panel."""
+        return (
+            key in self.focus_keys
+            or key in self.playback_keys
+            or key in self.panel_keys
+            or (self.vim_mode and key in ("esc", "i"))
+        )
 
-    def mouse_event(self, size, event, button, col, row, focus=True):
+    def hold(self, key, panel, size):
+        """
+        Called by the focused panel, at its size, when key moved its focus,
+        so repeats of key skip the app's own bindings and the panel's wrappers.
+        """
+        if not self.own_key(key):
+            self.held = (key, self.focus, self.key_size, panel, size)
+
+    def focused_panel(self):
+        if self.focus is self.search_panel_wrapped:
+            return self.search_panel, "search"
+        elif self.focus is self.queue_panel_wrapped and self.queue_panel.filter_pattern is None:
+            return self.queue_panel, "queue"
+        return None, None
+
+    def focus_step(self, key):
+        """
+        The rows a key or mouse event moves the focused panel's focus by, if
+        that is all it does, else None. See ui.MainLoop.process_input.
+        """
+        if not isinstance(key, str):
+            event, button, col, row = key
+            key = self.wheel_key(button) if event == "mouse press" else None
+
+        _, context = self.focused_panel()
+        if key is None or context is None or self.own_key(key):
+            return None
+
+        # Arrow keys bound to nothing else move the focus too
+        return NAVIGATION.get(bindings[context].get(key, key))
+
+    def move_focus(self, size, n):
+        """Moves the focused panel's focus n rows down, or up if n < 0."""
+        panel, _ = self.focused_panel()
+        if panel is None:
+            return
+
+        maxcol, maxrow = self.focus_size(size)
+        panel.move_focus((maxcol - 2, maxrow - 2), n)  # inside the LineBox
+
+    def wheel_key(self, button):
         up, down = [("up", "down"), ("down", "up")][self.reverse_scrolling]
-        if button == 5:
-            self.keypress(size, up)
-        elif button == 4:
-            self.keypress(size, down)
+        return {5: up, 4: down}.get(button)
+
+    def focus_next(self):
+        self.search_input.end_filter(accept=False, refocus=False)
+        self.vim_insert = False
+
+        current_focus = self.focus
+        if current_focus == self.search_panel_wrapped:
+            self.set_focus(self.queue_panel_wrapped)
+        elif current_focus == self.queue_panel_wrapped:
+            self.set_focus(self.search_input)
+        else:
+            self.set_focus(self.search_panel_wrapped)
+
+    def focus_prev(self):
+        self.search_input.end_filter(accept=False, refocus=False)
+        self.vim_insert = False
+
+        current_focus = self.focus
+        if current_focus == self.search_panel_wrapped:
+            self.set_focus(self.search_input)
+        elif current_focus == self.queue_panel_wrapped:
+            self.set_focus(self.search_panel_wrapped)
+        else:
+            self.set_focus(self.queue_panel_wrapped)
+
+    def focus_search(self):
+        if self.vim_mode:
+            self.vim_insert = True
+        self.set_focus(self.search_input)
+
+    def view_recent(self):
+        hist_songs = [item for item in self.history if isinstance(item, Song)]
+        hist_yt = [item for item in self.history if isinstance(item, YTVideo)]
+        hist_local = [item for item in self.history if isinstance(item, LocalTrack)]
+        self.search_panel.view_previous_songs(hist_songs, hist_yt, hist_local)
+
+    def queue_all(self):
+        self.queue_panel.add_songs_to_queue(self.search_panel.search_results.songs)
+
+    def mouse_event(self, size, event, button, col, row, focus=True):
+        key = self.wheel_key(button)
+        if key is not None:
+            self.keypress(size, key)
         else:
             super().mouse_event(size, event, button, col, row, focus=focus)
 
@@ -368,23 +708,24 @@ class App(urwid.Pile):
         radio_stations = []
         playlists = []
         yt_vids = []
+        local_tracks = []
 
         if isinstance(obj, Song):
-            album_info = self.g_api.get_album_info(obj.albumId)
+            album_info = self.get_album_info(obj.albumId)
 
             songs = [Song.from_dict(track) for track in album_info["tracks"]]
             albums = [Album.from_dict(album_info)]
             artists = [Artist(obj.artist, obj.artistId)]
 
         elif isinstance(obj, Album):
-            album_info = self.g_api.get_album_info(obj.id)
+            album_info = self.get_album_info(obj.id)
 
             songs = [Song.from_dict(track) for track in album_info["tracks"]]
             albums = [obj]
             artists = [Artist(obj.artist, obj.artistId)]
 
         elif isinstance(obj, Artist):
-            artist_info = self.g_api.get_artist_info(obj.id)
+            artist_info = self.get_artist_info(obj.id)
 
             songs = [
                 Song.from_dict(track) for track in artist_info.get("topTracks", [])
@@ -401,7 +742,7 @@ class App(urwid.Pile):
             situations = [obj]
 
         elif isinstance(obj, RadioStation):
-            station_id = obj.get_station_id(self.g_api)
+            station_id = self.get_station_id(obj)
             if no_limit:
                 songs = self.get_radio_songs(station_id,n=150)
             else:
@@ -409,109 +750,103 @@ class App(urwid.Pile):
             radio_stations = [obj]
 
         elif isinstance(obj, Playlist):
-            songs = obj.songs
+            songs = self.playlist_songs(obj)
             playlists = [obj]
 
         elif isinstance(obj, YTVideo):
             yt_vids = [obj]
 
-        self.search_panel.update_search_results(
-            songs, albums, artists, situations, radio_stations, playlists, yt_vids, no_limit=no_limit
-        )
+        elif isinstance(obj, LocalTrack):
+            local_tracks = self.local.album_tracks(obj) if self.local else [obj]
 
-    def youtube_search(
-        self,
-        q,
-        max_results=50,
-        order="relevance",
-        token=None,
-        location=None,
-        location_radius=None,
-    ):
-        """
-        Mostly stolen from: https://github.com/spnichol/youtube_tutorial/blob/master/youtube_videos.py
-        """
-        if self.youtube is None:
-            return None, []
-
-        search_response = (
-            self.youtube.search()
-            .list(
-                q=q,
-                type="video",
-                pageToken=token,
-                order=order,
-                part="id,snippet",
-                maxResults=max_results,
-                location=location,
-                locationRadius=location_radius,
-            )
-            .execute()
+        self.search_panel.update_search_results(
+            songs,
+            albums,
+            artists,
+            situations,
+            radio_stations,
+            playlists,
+            yt_vids,
+            local_tracks,
+            no_limit=no_limit,
         )
 
-        videos = []
-        for search_result in search_response.get("items", []):
+    def get_album_info(self, album_id):
+        return self.prefetcher.get("album", album_id)
 
-            if search_result["id"]["kind"] == "youtube#video":
-                videos.append(search_result)
+    def get_artist_info(self, artist_id):
+        return self.prefetcher.get("artist", artist_id)
 
-        nexttok = search_response.get("nextPageToken", None)
-        return nexttok, videos
+    def get_albums_info(self, album_ids):
+        return self.prefetcher.get_albums(album_ids)
 
+    @metrics.timed("search")
     def search(self, query):
-        results = self.g_api.search(query)
+        # All providers are searched at once, so a search takes as long as
+        # the slowest of them rather than all of them together
+        searches = [
+            (provider, provider.submit(provider.search, query))
+            for provider in self.providers
+        ]
 
-        songs = [Song.from_dict(hit["track"]) for hit in results["song_hits"]]
-        albums = [Album.from_dict(hit["album"]) for hit in results["album_hits"]]
-        artists = [Artist.from_dict(hit["artist"]) for hit in results["artist_hits"]]
-        ytvids = [YTVideo.from_dict(hit) for hit in self.youtube_search(query)[1]]
+        categories = []
+        for provider, search in searches:
+            try:
+                categories.extend(search.result())
+            except Exception as e:
+                logging.warning(f"{provider.name} search for {query!r} failed: {e}")
 
-        self.search_panel.update_search_results(
-            songs, albums, artists, [], [], [], ytvids
-        )
+        self.search_panel.update_search_results(*categories)
         self.set_focus(self.search_panel_wrapped)
 
     def listen_now(self):
-        situations = self.g_api.get_listen_now_situations()
-        items = self.g_api.get_listen_now_items()
-        playlists = self.g_api.get_all_user_playlist_contents()
-        liked = self.g_api.get_top_songs()
-
-        situations = [Situation.from_dict(hit) for hit in situations]
-        albums = [Album.from_dict(hit["album"]) for hit in items if "album" in hit]
-        radio_stations = [
-            RadioStation.from_dict(hit["radio_station"])
-            for hit in items
-            if "radio_station" in hit
-        ]
-        playlists = [Playlist.from_dict(playlist) for playlist in playlists]
+        # Only playlist metadata is synced here, see playlist_songs
+        sync = self.gmusic.submit(self.playlist_store.sync, self.gmusic)
+        situations, albums, radio_stations = self.gmusic.listen_now()
+
+        try:
+            playlists = sync.result()
+        except Exception as e:
+            logging.warning(f"Playlist sync failed, showing the stored playlists: {e}")
+            playlists = self.playlist_store.metadata()
 
-        liked = [Song.from_dict(song) for song in liked]
-        playlists.append(Playlist(_("Liked"), liked, None))
+        playlists = [Playlist.from_dict(playlist) for playlist in playlists]
+        playlists = [playlist for playlist in playlists if playlist is not None]
+        playlists.append(Playlist(_("Liked"), None, LIKED_ID))
 
         self.search_panel.update_search_results(
             [], albums, [], situations, radio_stations, playlists, []
         )
         self.set_focus(self.search_panel_wrapped)
 
+    def playlist_songs(self, playlist):
+        if playlist.songs is None:
+            tracks = self.playlist_store.tracks(self.gmusic, playlist.id)
+            playlist.songs = [song for song in map(Song.from_dict, tracks) if song]
+            playlist.size = len(playlist.songs)
+            playlist.invalidate_ui()
+
+        return playlist.songs
+
+    def get_station_id(self, obj):
+        return self.gmusic.station_id(obj, self.station_cache)
+
     def create_radio_station(self, obj):
-        if isinstance(obj, Song):
-            station_id = self.g_api.create_station(obj.title, track_id=obj.id)
-        elif isinstance(obj, Album):
-            station_id = self.g_api.create_station(obj.title, album_id=obj.id)
-        elif isinstance(obj, Artist):
-            station_id = self.g_api.create_station(obj.name, artist_id=obj.id)
-        elif isinstance(obj, RadioStation):
-            station_id = obj.get_station_id(self.g_api)
-        else:
+        station_id = self.get_station_id(obj)
+        if station_id is None:
             return
 
-        for song in self.get_radio_songs(station_id):
-            self.queue_panel.add_song_to_queue(song)
+        self.queue_panel.add_songs_to_queue(self.get_radio_songs(station_id))
 
     def get_radio_songs(self, station_id, n=50):
-        song_dicts = self.g_api.get_station_tracks(station_id, num_tracks=n)
-        return [Song.from_dict(song_dict) for song_dict in song_dicts]
+        songs = self.gmusic.station_songs(station_id, n)
+
+        if not songs:
+            # The cached station may have been deleted from the account, so
+            # forget it and let the next attempt create a fresh one.
+            self.station_cache.invalidate(station_id)
+
+        return songs
 
     def rate_current_song(self, rating):
         if type(self.current_song) != Song:
@@ -520,33 +855,35 @@ class App(urwid.Pile):
         if self.current_song.rating == rating:
             rating = 0
 
-        self.current_song.rating = rating
-        track = {}
-
-        if self.current_song.type == "library":
-            track["id"] = self.current_song.id
-
-        else:
-            track["nid"] = self.current_song.id
-            track["trackType"] = self.current_song.trackType
-
-        self.g_api.rate_songs(track, rating)
+        self.ratings.rate(self.current_song, rating)
         self.playbar.update()
-        self.loop.draw_screen()
 
     def cleanup(self, *args, **kwargs):
         self.player.quit()
         del self.player
 
-        self.g_api.logout()
+        self.prefetcher.shutdown()
+        self.art_cache.shutdown()
+        self.ratings.shutdown()
+        if self.control:
+            self.control.shutdown()
+        for provider in self.providers:
+            provider.shutdown()
+
+        self.gmusic.logout()
         self.loop.stop()
 
         if self.persist_queue:
             self.save_queue()
 
         self.save_history()
+        self.export_metrics()
+
+        if self.profiler:
+            self.profiler.stop()
         sys.exit()
 
+    @metrics.timed("persist.save_queue")
     def save_queue(self):
         print(_("saving queue"))
         queue = []
@@ -556,30 +893,34 @@ class App(urwid.Pile):
 
         queue.extend(self.queue_panel.queue)
 
-        with open(QUEUE_FILE, "w") as f:
+        with open(self.data_path(QUEUE_FILE), "w") as f:
             f.write(serialize(queue))
 
+    @metrics.timed("persist.restore_queue")
     def restore_queue(self):
         try:
-            with open(QUEUE_FILE, "r") as f:
-                self.queue_panel.add_songs_to_queue(deserialize(f.read()))
+            with open(self.data_path(QUEUE_FILE), "r") as f:
+                self.queue_panel.add_songs_to_queue(deserialize(f.read()), dedup="allow")
 
         except (AttributeError, FileNotFoundError) as e:
             logging.exception(e)
             print(_("failed to restore queue. :("))
             self.queue_panel.clear()
 
+    @metrics.timed("persist.save_history")
     def save_history(self):
         if self.current_song:
             self.pop_from_history()
     
-        with open(HISTORY_FILE, "w") as f:
+        with open(self.data_path(HISTORY_FILE), "w") as f:
             f.write(serialize(self.history))
 
+    @metrics.timed("persist.restore_history")
     def restore_history(self):
         try:
-            with open(HISTORY_FILE, "r") as f:
+            with open(self.data_path(HISTORY_FILE), "r") as f:
                 self.history = deserialize(f.read())
+                self.history_index.reset(self.history)
         except (AttributeError, FileNotFoundError) as e:
             logging.exception(e)
             print(_("failed to restore recently played. :("))
@@ -601,6 +942,29 @@ def load_locale():
         gettext.bindtextdomain('tuijam', LOCALE_DIR)
         gettext.textdomain('tuijam')
 
+def setup_loop(app, screen=None, event_loop=None):
+    loop = MainLoop(app, screen=screen, event_loop=event_loop)
+    loop.screen.set_terminal_properties(256)
+    app.loop = loop
+    app.register_palette()
+    app.wake_fd = loop.watch_pipe(app.run_main_calls)
+    app.run_main_calls()
+    app.ratings.start()
+    app.watch_config()
+
+    if app.local_library:
+        app.local_library.start(loop)
+
+    if app.control_socket:
+        if isinstance(app.control_socket, str):
+            app.control = ControlServer(app, expanduser(app.control_socket))
+        else:
+            app.control = ControlServer(app)
+        app.control.start(loop)
+
+    return loop
+
+
 def main():
     import argparse
 
@@ -612,14 +976,31 @@ def main():
     parser.add_argument(
         "action", choices=["", "configure_last_fm"], default="", nargs="?"
     )
-    parser.add_argument("-v", "--verbose", action="store_true")  # TODO: use this
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help=_("log more, -v for info and -vv for debug messages"),
+    )
+    parser.add_argument(
+        "--fake-backend",
+        metavar="FIXTURE",
+        nargs="?",
+        const="",
+        help=_("run against an offline stand-in for Google Music and YouTube"),
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=_("profile CPU and memory from startup, reports are written on exit"),
+    )
     args = parser.parse_args()
 
     print(_("starting up."))
     makedirs(CONFIG_DIR, exist_ok=True)
 
-    log_file = join(CONFIG_DIR, "log.txt")
-    logging.basicConfig(filename=log_file, filemode="w", level=logging.WARNING)
+    setup_logging(LOG_FILE, args.verbose)
 
     if args.action == "configure_last_fm":
         LastFMAPI.configure()
@@ -628,9 +1009,9 @@ def main():
         print(f"Unrecognized option: {args.action}")
         exit(0)
 
-    app = App()
+    app = App(CONFIG_DIR if args.fake_backend is None else FAKE_DATA_DIR)
     print(_("logging in."))
-    app.login()
+    app.login(fake_backend=args.fake_backend)
 
     if app.mpris_enabled:
         from .mpris import setup_mpris
@@ -654,12 +1035,24 @@ def main():
 
     signal.signal(signal.SIGINT, app.cleanup)
 
-    loop = urwid.MainLoop(app, event_loop=urwid.GLibEventLoop())
-    loop.screen.set_terminal_properties(256)
-    loop.screen.register_palette(
-        [(k.replace("-", " "), "", "", "", fg, bg) for k, (fg, bg) in palette.items()]
+    loop = setup_loop(app, event_loop=urwid.GLibEventLoop())
+
+    # Registered with GLib, like the profiling signals: a Python handler
+    # would only run once something else woke the loop. The reload goes
+    # through call_in_main so the screen is redrawn after it.
+    from gi.repository import GLib
+
+    GLib.unix_signal_add(
+        GLib.PRIORITY_HIGH, signal.SIGHUP, lambda: app.call_in_main(app.reload_config) or True
     )
-    app.loop = loop
+    app.schedule_metrics_export()
+
+    from .profiling import ProfilingHooks
+
+    app.profiler = ProfilingHooks()
+    app.profiler.install(use_glib=True)
+    if args.profile:
+        app.profiler.start()
 
     try:
         loop.run()
@@ -0,0 +1,165 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os import makedirs, replace, scandir, remove, utime
+from os.path import join, isfile
+import hashlib
+import logging
+import threading
+
+import requests
+
+from tuijam import ART_CACHE_DIR, ART_SIZES
+
+
+def remote_art_url(obj):
+    return getattr(obj, "albumArtRef", None) or getattr(obj, "thumbnail", None)
+
+
+class ArtCache:
+    """
+    Size-bounded on-disk cache of album artwork.
+
+    Artwork is downloaded once in the background and, when Pillow is
+    available, stored pre-resized in each of SIZES. Cached art is handed out
+    as file:// URLs so MPRIS clients do not each download it again.
+    """
+
+    SIZES = ART_SIZES
+
+    def __init__(self, app, path=ART_CACHE_DIR, max_bytes=100 * 2 ** 20, size=512):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = size
+
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.lock = threading.Lock()
+        self.pending = set()
+
+        makedirs(self.path, exist_ok=True)
+
+    def file_path(self, url, size):
+        digest = hashlib.sha1(url.encode()).hexdigest()
+        return join(self.path, f"{digest}_{size}")
+
+    def nearest_size(self, size):
+        """The size in SIZES closest to size, since only those are stored."""
+        return min(self.SIZES, key=lambda stored: abs(stored - size))
+
+    def cached_path(self, url, size=None):
+        size = self.nearest_size(size or self.size)
+
+        for path in (self.file_path(url, size), self.file_path(url, "orig")):
+            if isfile(path):
+                return path
+
+    def lookup(self, url, size=None, fetch=True):
+        """
+        Returns a file:// URL for url if it is cached. Otherwise a background
+        fetch is started (unless fetch is False) and the remote url is
+        returned for now.
+        """
+        if not url:
+            return ""
+
+        path = self.cached_path(url, size)
+
+        if path is None:
+            if fetch:
+                self.fetch(url)
+            return url
+
+        try:
+            utime(path)  # mtime doubles as last-use time for eviction
+        except OSError:
+            pass
+
+        return "file://" + path
+
+    def prefetch(self, objs):
+        for obj in objs:
+            url = remote_art_url(obj)
+            if url and self.cached_path(url) is None:
+                self.fetch(url)
+
+    def fetch(self, url):
+        with self.lock:
+            if url in self.pending:
+                return
+            self.pending.add(url)
+
+        self.executor.submit(self._fetch, url)
+
+    def _fetch(self, url):
+        try:
+            res = requests.get(url, timeout=10)
+            res.raise_for_status()
+            self.store(url, res.content)
+        except Exception as e:
+            logging.warning(f"Could not fetch artwork {url}: {e}")
+            return
+        finally:
+            with self.lock:
+                self.pending.discard(url)
+
+        self.app.call_in_main(self.app.art_fetched, url)
+
+    def _write(self, path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        replace(tmp_path, path)
+
+    def store(self, url, data):
+        try:
+            from PIL import Image
+        except ImportError:
+            self._write(self.file_path(url, "orig"), data)
+        else:
+            image = Image.open(BytesIO(data)).convert("RGB")
+
+            for size in self.SIZES:
+                resized = image.copy()
+                resized.thumbnail((size, size))
+
+                buf = BytesIO()
+                resized.save(buf, "JPEG", quality=90)
+                self._write(self.file_path(url, size), buf.getvalue())
+
+        self.evict()
+
+    def evict(self):
+        # All sizes of one image are evicted together, so an image is never
+        # left partly cached. Files still being written (*.tmp) are skipped.
+        images = {}
+        try:
+            for entry in scandir(self.path):
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                st = entry.stat()
+                digest = entry.name.split("_", 1)[0]
+                last_use, size, paths = images.get(digest, (0, 0, []))
+                images[digest] = (
+                    max(last_use, st.st_mtime),
+                    size + st.st_size,
+                    paths + [entry.path],
+                )
+        except OSError as e:
+            logging.warning(f"Could not scan artwork cache: {e}")
+            return
+
+        total = sum(size for _, size, _ in images.values())
+
+        for _, size, paths in sorted(images.values()):
+            if total <= self.max_bytes:
+                break
+
+            for path in paths:
+                try:
+                    remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
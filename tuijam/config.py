@@ -0,0 +1,199 @@
+"""
+config.yaml, parsed once and shared.
+
+`config` is read on first use and only re-read when the file's mtime or size
+changes, so looking an option up is a dict lookup. Options TUIJam knows of
+are checked against the types in OPTIONS: a bad value is logged and left
+out, so the default applies, and a file that doesn't parse keeps the last
+good configuration. Other entries, like API keys, are passed through as is.
+"""
+from os import replace, stat
+import logging
+import threading
+
+import yaml
+
+from tuijam import ART_SIZES, CONFIG_FILE
+
+NUMBER = (int, float)
+
+OPTIONS = dict(
+    controls=dict,
+    palette=dict,
+    lastfm_sk=str,
+    key_server=str,
+    mpris_enabled=bool,
+    persist_queue=bool,
+    reverse_scrolling=bool,
+    video=bool,
+    vim_mode=bool,
+    use_terminal_colors=bool,
+    prefetch=bool,
+    art_cache_size_mb=NUMBER,
+    art_size=int,
+    queue_dedup=str,
+    search_history_depth=int,
+    search_history_size_mb=NUMBER,
+    control_socket=(bool, str),
+    metrics_export=str,
+    metrics_export_interval=NUMBER,
+    local_music_dirs=list,
+    local_music_watch=bool,
+)
+
+# Options that only take one of a few values
+CHOICES = dict(
+    art_size=ART_SIZES,
+)
+
+DEFAULTS = dict(
+    mpris_enabled=True,
+    persist_queue=True,
+    reverse_scrolling=False,
+    video=False,
+    vim_mode=False,
+    use_terminal_colors=False,
+)
+
+
+def is_key_list(value):
+    return isinstance(value, str) or (
+        isinstance(value, list) and all(isinstance(key, str) for key in value)
+    )
+
+
+def is_color_pair(value):
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and all(isinstance(color, str) for color in value)
+    )
+
+
+def valid(key, value):
+    types = OPTIONS.get(key)
+    if types is None:
+        return True
+    if not isinstance(types, tuple):
+        types = (types,)
+
+    # bool is an int, but true isn't a size
+    if not isinstance(value, types) or (bool not in types and isinstance(value, bool)):
+        return False
+
+    return key not in CHOICES or value in CHOICES[key]
+
+
+def check_entries(name, entries, check):
+    good = {}
+    for key, value in entries.items():
+        if check(value):
+            good[key] = value
+        else:
+            logging.warning(f"Ignoring {name} entry {key}: {value!r}")
+    return good
+
+
+def validate(data):
+    config = {}
+    for key, value in data.items():
+        if valid(key, value):
+            config[key] = value
+        else:
+            logging.warning(f"Ignoring config option {key}: {value!r} is not valid")
+
+    if "controls" in config:
+        config["controls"] = check_entries("controls", config["controls"], is_key_list)
+    if "palette" in config:
+        config["palette"] = check_entries("palette", config["palette"], is_color_pair)
+
+    return config
+
+
+class Config:
+    poll_interval = 2  # seconds between checks of the file for changes
+
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        self.data = {}
+        self.stamp = None  # (mtime, size) of the file data was read from
+        self.generation = 0  # counts the times data was replaced
+        self.lock = threading.Lock()
+
+    def file_stamp(self):
+        try:
+            st = stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def changed(self):
+        return self.file_stamp() != self.stamp
+
+    def load(self):
+        """Re-reads the file if it changed. Returns whether it was re-read."""
+        with self.lock:
+            stamp = self.file_stamp()
+            if stamp == self.stamp:
+                return False
+
+            try:
+                with open(self.path) as f:
+                    data = yaml.safe_load(f) or {}
+                if not isinstance(data, dict):
+                    raise ValueError("expected a mapping of options")
+            except FileNotFoundError:
+                data = {}
+            except (OSError, ValueError, yaml.YAMLError) as e:
+                # Remember the stamp anyway, so a broken file is reported once
+                logging.warning(f"Could not read {self.path}, keeping the last configuration: {e}")
+                self.stamp = stamp
+                return False
+
+            self.data = validate(data)
+            self.stamp = stamp
+            self.generation += 1
+            return True
+
+    def use_file(self, path):
+        """Switches to another config file, read on next use."""
+        with self.lock:
+            self.path = path
+            self.data = {}
+            self.stamp = None
+
+    def get(self, key, default=None):
+        if self.stamp is None:
+            self.load()
+        return self.data.get(key, default)
+
+    def __contains__(self, key):
+        if self.stamp is None:
+            self.load()
+        return key in self.data
+
+    def write_defaults(self, **extra):
+        """Writes a config file with the default options, unless there is one."""
+        if self.file_stamp() is None:
+            self.write(dict(DEFAULTS, **extra))
+
+    def update(self, **values):
+        """Sets options in the file, keeping the rest of it as it is."""
+        try:
+            with open(self.path) as f:
+                data = yaml.safe_load(f) or {}
+        except FileNotFoundError:
+            data = {}
+
+        data.update(values)
+        self.write(data)
+        self.load()
+
+    def write(self, data):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            yaml.safe_dump(data, f, default_flow_style=False)
+        replace(tmp_path, self.path)
+
+
+config = Config()
@@ -0,0 +1,474 @@
+"""
+Local control of a running TUIJam through a Unix domain socket.
+
+Clients send one JSON object per line, like
+
+    {"cmd": "queue_move", "start": 4, "stop": 6, "dest": 0, "id": 1}
+
+and get one JSON line back per request, in order:
+
+    {"id": 1, "ok": true, "result": null}
+
+Requests may be pipelined: every complete line that has arrived is run in
+one go and the responses are written back together. The sockets are
+watched by the urwid loop itself, so commands run on the loop like
+keypresses do and never race the UI. Searches go out on the providers'
+thread pools; the connection's later requests wait for them to finish.
+
+From a shell, `python -m tuijam.control '{"cmd": "status"}'` sends the
+requests given as arguments (or on stdin) to the configured socket and
+prints the responses. A client may shut down its sending side once it has
+sent its requests: the responses are still written before the connection
+is closed.
+"""
+from collections import deque
+from concurrent.futures import Future
+from os import chmod, unlink
+from os.path import exists, expanduser
+import json
+import logging
+import socket
+import threading
+
+from tuijam import CONTROL_SOCKET
+from .config import config
+from .metrics import metrics
+from .music_objects import Song, Album, YTVideo, LocalTrack
+
+PLAYABLE = (Song, YTVideo, LocalTrack)
+DESCRIBED_FIELDS = ("id", "title", "name", "artist", "album", "channel", "length")
+
+
+class CommandError(Exception):
+    pass
+
+
+def describe(obj):
+    fields = {"type": type(obj).__name__}
+
+    for attr in DESCRIBED_FIELDS:
+        value = getattr(obj, attr, None)
+        if isinstance(value, (str, int, float)):
+            fields[attr] = value
+
+    return fields
+
+
+def gather(futures):
+    """A Future of the results of futures, in order. Failures give None."""
+    gathered = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.warning(f"Control search failed: {e}")
+                results.append(None)
+        gathered.set_result(results)
+
+    if not futures:
+        gathered.set_result([])
+
+    for future in futures:
+        future.add_done_callback(done)
+
+    return gathered
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.requests = deque()
+        self.waiting = False  # on a Future, see ControlServer.run
+        self.results = []  # of the last search, for queue_add
+        self.eof = False  # the client has sent all its requests
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class ControlServer:
+    max_line = 64 * 1024
+    max_output = 4 * 2 ** 20
+
+    def __init__(self, app, path=CONTROL_SOCKET):
+        self.app = app
+        self.path = path
+        self.sock = None
+        self.loop = None
+        self.connections = {}  # fd -> Connection
+
+    def start(self, loop):
+        self.loop = loop
+
+        if exists(self.path):
+            if self.in_use():
+                logging.warning(f"{self.path} is in use by another TUIJam, not listening")
+                return
+            unlink(self.path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            chmod(self.path, 0o600)
+            sock.listen(8)
+        except OSError as e:
+            logging.warning(f"Could not listen on {self.path}: {e}")
+            sock.close()
+            return
+
+        sock.setblocking(False)
+        self.sock = sock
+        loop.watch_file(sock.fileno(), self.accept)
+
+    def in_use(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+
+    def shutdown(self):
+        for conn in list(self.connections.values()):
+            self.close(conn)
+
+        if self.sock is not None:
+            self.loop.remove_watch_file(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            try:
+                unlink(self.path)
+            except OSError:
+                pass
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.warning(f"Control socket accept failed: {e}")
+                return
+
+            sock.setblocking(False)
+            conn = Connection(sock)
+            self.connections[conn.fileno()] = conn
+            self.loop.watch_file(conn.fileno(), lambda conn=conn: self.readable(conn))
+
+    def close(self, conn):
+        if conn.closed:
+            return
+
+        conn.closed = True
+        self.connections.pop(conn.fileno(), None)
+        self.loop.remove_watch_file(conn.fileno())
+        conn.sock.close()
+
+    def readable(self, conn):
+        while True:
+            try:
+                data = conn.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                data = b""
+
+            if not data:
+                conn.eof = True
+                self.loop.remove_watch_file(conn.fileno())
+                break
+
+            conn.inbuf += data
+
+        *lines, rest = conn.inbuf.split(b"\n")
+        if conn.eof:
+            # the end of the stream ends the last request too
+            lines.append(rest)
+            rest = b""
+
+        if len(rest) > self.max_line:
+            logging.warning("Dropping control client that sent an overlong line")
+            self.close(conn)
+            return
+
+        conn.inbuf = bytearray(rest)
+        conn.requests.extend(line for line in lines if line.strip())
+        self.run(conn)
+
+    def run(self, conn):
+        """Runs the connection's requests until one has to wait."""
+        while conn.requests and not conn.waiting:
+            line = conn.requests.popleft()
+
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise CommandError("a request is a JSON object")
+            except (ValueError, CommandError) as e:
+                self.respond(conn, None, error=str(e))
+                continue
+
+            with metrics.timer("control.command"):
+                result, error = self.execute(conn, request)
+
+            if isinstance(result, Future):
+                conn.waiting = True
+                result.add_done_callback(
+                    lambda future, request=request: self.app.call_in_main(
+                        self.resume, conn, request, future
+                    )
+                )
+            else:
+                self.respond(conn, request.get("id"), result, error)
+
+        self.flush(conn)
+
+    def resume(self, conn, request, future):
+        conn.waiting = False
+        if conn.closed:
+            return
+
+        try:
+            result, error = self.finish(conn, request, future.result()), None
+        except Exception as e:
+            result, error = None, str(e)
+
+        self.respond(conn, request.get("id"), result, error)
+        self.run(conn)
+
+    def execute(self, conn, request):
+        args = dict(request)
+        name = args.pop("cmd", None)
+        args.pop("id", None)
+
+        command = getattr(self, f"cmd_{name}", None)
+        if not isinstance(name, str) or command is None:
+            return None, f"unknown command {name!r}"
+
+        try:
+            return command(conn, **args), None
+        except TypeError as e:
+            return None, f"bad arguments for {name}: {e}"
+        except (CommandError, IndexError, ValueError) as e:
+            return None, str(e)
+        except Exception as e:
+            logging.exception(e)
+            return None, f"{name} failed: {e}"
+
+    def finish(self, conn, request, result):
+        """The response to a request that had to wait on a Future."""
+        cmd = request.get("cmd")
+        if cmd == "search":
+            return self.search_results(conn, result, request.get("limit", 20))
+        if cmd == "queue_add":
+            return self.queue_with_albums(conn, request, result)
+        if cmd == "queue_tracks":
+            return self.insert(result, request.get("position"), request.get("dedup"))
+        return result
+
+    def respond(self, conn, id_, result=None, error=None):
+        if error is None:
+            response = dict(id=id_, ok=True, result=result)
+        else:
+            response = dict(id=id_, ok=False, error=error)
+
+        conn.outbuf += json.dumps(response, ensure_ascii=False).encode() + b"\n"
+
+    def flush(self, conn, *args):
+        if conn.closed:
+            return
+
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+                del conn.outbuf[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self.close(conn)
+                return
+
+        if len(conn.outbuf) > self.max_output:
+            logging.warning("Dropping control client that doesn't read its responses")
+            self.close(conn)
+        elif conn.outbuf:
+            # The client's socket buffer is full, try again shortly
+            self.loop.set_alarm_in(0.01, lambda *_: self.flush(conn))
+        elif conn.eof and not conn.requests and not conn.waiting:
+            # A half-closed client has had every response
+            self.close(conn)
+
+    # Commands, each called as cmd_<name>(conn, **arguments)
+
+    def cmd_status(self, conn):
+        app = self.app
+        progress, total = app.playbar.get_prog_tot() if app.current_song else (0, 0)
+
+        return dict(
+            state=app.play_state,
+            song=describe(app.current_song) if app.current_song else None,
+            position=progress,
+            duration=total,
+            volume=app.volume,
+            queue_length=len(app.queue_panel.queue),
+        )
+
+    def cmd_play(self, conn):
+        if self.app.play_state != "play":
+            self.app.toggle_play()
+
+    def cmd_pause(self, conn):
+        if self.app.play_state == "play":
+            self.app.toggle_play()
+
+    def cmd_toggle(self, conn):
+        self.app.toggle_play()
+
+    def cmd_stop(self, conn):
+        self.app.stop()
+
+    def cmd_next(self, conn):
+        self.app.queue_panel.play_next()
+
+    def cmd_previous(self, conn):
+        self.app.queue_panel.play_previous()
+
+    def cmd_seek(self, conn, offset=None, position=None):
+        if position is not None:
+            self.app.seek_to(float(position))
+        elif offset is not None:
+            self.app.seek(float(offset))
+        else:
+            raise CommandError("seek needs an offset or a position")
+
+    def cmd_volume(self, conn, level=None, delta=None):
+        if level is not None:
+            self.app.set_volume(int(level))
+        elif delta is not None:
+            self.app.set_volume(self.app.volume + int(delta))
+        return self.app.volume
+
+    def cmd_queue(self, conn, start=0, stop=None):
+        return [describe(song) for song in self.app.queue_panel.queue[start:stop]]
+
+    def check_insert(self, position, dedup):
+        if position is not None:
+            int(position)
+        if dedup is not None and dedup not in self.app.queue_panel.DEDUP_POLICIES:
+            raise CommandError(
+                f"dedup is one of {', '.join(self.app.queue_panel.DEDUP_POLICIES)}"
+            )
+
+    def insert(self, songs, position=None, dedup=None):
+        queue_panel = self.app.queue_panel
+        if position is None:
+            position = len(queue_panel.queue)
+
+        queue_panel.insert_songs(int(position), songs, dedup)
+        return len(queue_panel.queue)
+
+    def gmusic(self):
+        if self.app.gmusic is None:
+            raise CommandError("Google Music is not available")
+        return self.app.gmusic
+
+    def cmd_queue_add(self, conn, results, position=None, dedup=None):
+        """Queues songs and albums of the last search, by their index in its results."""
+        objs = [conn.results[index] for index in results]
+        if not all(isinstance(obj, PLAYABLE + (Album,)) for obj in objs):
+            raise CommandError("only songs, videos and albums can be queued")
+        self.check_insert(position, dedup)
+
+        album_ids = [obj.id for obj in objs if isinstance(obj, Album)]
+        if album_ids:
+            # The albums' tracks are fetched in one batch, off the loop
+            return self.gmusic().submit(self.app.get_albums_info, album_ids)
+
+        return self.insert(objs, position, dedup)
+
+    def queue_with_albums(self, conn, request, album_infos):
+        """Finishes a queue_add of albums, in the order they were asked for."""
+        tracks = {
+            info["albumId"]: [Song.from_dict(track) for track in info["tracks"]]
+            for info in album_infos
+        }
+
+        songs = []
+        for index in request["results"]:
+            obj = conn.results[index]
+            songs.extend(tracks.get(obj.id, []) if isinstance(obj, Album) else [obj])
+
+        return self.insert(songs, request.get("position"), request.get("dedup"))
+
+    def cmd_queue_tracks(self, conn, ids, position=None, dedup=None):
+        """Queues Google Music songs by their store ids."""
+        if not isinstance(ids, list) or not all(isinstance(id_, str) for id_ in ids):
+            raise CommandError("ids is a list of store track ids")
+        self.check_insert(position, dedup)
+
+        gmusic = self.gmusic()
+        return gmusic.submit(gmusic.tracks, ids)
+
+    def cmd_queue_move(self, conn, start, stop, dest):
+        self.app.queue_panel.move_range(int(start), int(stop), int(dest))
+
+    def cmd_queue_remove(self, conn, start, stop=None):
+        start = int(start)
+        self.app.queue_panel.remove_range(start, start + 1 if stop is None else int(stop))
+        return len(self.app.queue_panel.queue)
+
+    def cmd_queue_clear(self, conn):
+        self.app.queue_panel.clear()
+
+    def cmd_search(self, conn, query, limit=20):
+        if not isinstance(query, str) or not query:
+            raise CommandError("search needs a query")
+
+        return gather(
+            [provider.submit(provider.search, query) for provider in self.app.providers]
+        )
+
+    def search_results(self, conn, provider_results, limit):
+        results = []
+        for categories in provider_results:
+            for category in categories or ():
+                results.extend(obj for obj in category[:limit] if obj is not None)
+
+        conn.results = results
+        return [dict(describe(obj), index=index) for index, obj in enumerate(results)]
+
+
+def main():
+    import sys
+
+    lines = sys.argv[1:] or [line for line in sys.stdin if line.strip()]
+    path = config.get("control_socket")
+    path = expanduser(path) if isinstance(path, str) else CONTROL_SOCKET
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall("".join(line.rstrip("\n") + "\n" for line in lines).encode())
+
+        with sock.makefile() as responses:
+            for _ in lines:
+                print(responses.readline(), end="")
+
+
+if __name__ == "__main__":
+    main()
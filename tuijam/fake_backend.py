@@ -0,0 +1,357 @@
+"""
+Offline stand-ins for gmusicapi.Mobileclient and the YouTube client.
+
+The fakes serve a fixture catalog (see synthetic.Catalog) through the same
+methods App calls on the real clients, with configurable latency, jitter and
+error rate, and stream local audio files (or a generated tone) instead of
+Google Music streams. Start TUIJam against them with
+
+    tuijam --fake-backend [FIXTURE.json]
+
+A fixture to edit can be written with `python -m tuijam.fake_backend OUT.json`.
+"""
+from os import listdir
+from os.path import join, isdir, splitext, abspath
+from zlib import crc32
+import json
+import logging
+import random
+import threading
+import time
+
+from .local_library import AUDIO_EXTENSIONS
+from .synthetic import Catalog
+
+DEFAULT_SETTINGS = dict(
+    seed=0,
+    latency=0.05,  # seconds, or {"default": ..., "<method name>": ...}
+    jitter=0.02,
+    error_rate=0.0,
+    audio_dir=None,
+    catalog={},  # keyword arguments for synthetic.Catalog
+)
+
+
+class FakeCallFailure(Exception):
+    def __init__(self, method):
+        super().__init__(f"injected failure in {method}")
+        self.method = method
+
+
+class FakeService:
+    """Latency, jitter and error injection shared by both fakes."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.rng = random.Random(settings["seed"])
+        self.rng_lock = threading.Lock()
+
+    def latency(self, method):
+        latency = self.settings["latency"]
+        if isinstance(latency, dict):
+            return latency.get(method, latency.get("default", 0))
+        return latency
+
+    def call(self, method):
+        with self.rng_lock:
+            jitter = self.rng.uniform(-1, 1) * self.settings["jitter"]
+            fail = self.rng.random() < self.settings["error_rate"]
+
+        time.sleep(max(0, self.latency(method) + jitter))
+
+        if fail:
+            logging.info(f"fake backend: injecting failure in {method}")
+            raise FakeCallFailure(method)
+
+
+class FakeMobileclient(FakeService):
+    FROM_MAC_ADDRESS = object()
+
+    def __init__(self, catalog, settings):
+        super().__init__(settings)
+        self.catalog = catalog
+        self.stations = {}
+        self.audio_files = self.find_audio_files(settings["audio_dir"])
+
+    @staticmethod
+    def find_audio_files(audio_dir):
+        if not audio_dir or not isdir(audio_dir):
+            return []
+
+        return sorted(
+            abspath(join(audio_dir, name))
+            for name in listdir(audio_dir)
+            if splitext(name)[1].lower() in AUDIO_EXTENSIONS
+        )
+
+    def stream_url_for(self, id_, duration=180):
+        if self.audio_files:
+            return self.audio_files[crc32(id_.encode()) % len(self.audio_files)]
+
+        # Without local files, let mpv synthesize a tone of the right length
+        frequency = 220 + crc32(id_.encode()) % 440
+        return f"av://lavfi:sine=frequency={frequency}:duration={duration}"
+
+    @staticmethod
+    def matches(query, *fields):
+        words = query.casefold().split()
+        text = " ".join(fields).casefold()
+        return all(word in text for word in words)
+
+    @staticmethod
+    def album_summary(album):
+        return {key: val for key, val in album.items() if key != "tracks"}
+
+    def search(self, query, max_results=50):
+        self.call("search")
+        catalog = self.catalog
+
+        tracks = [
+            t
+            for t in catalog.tracks
+            if self.matches(query, t["title"], t["album"], t["artist"])
+        ]
+        albums = [
+            a for a in catalog.albums if self.matches(query, a["name"], a["albumArtist"])
+        ]
+        artists = [a for a in catalog.artists if self.matches(query, a["name"])]
+
+        return {
+            "song_hits": [{"track": t} for t in tracks[:max_results]],
+            "album_hits": [{"album": self.album_summary(a)} for a in albums[:max_results]],
+            "artist_hits": [{"artist": a} for a in artists[:max_results]],
+        }
+
+    def get_album_info(self, album_id, include_tracks=True):
+        self.call("get_album_info")
+        album = self.catalog.albums_by_id[album_id]
+        return album if include_tracks else self.album_summary(album)
+
+    def get_artist_info(
+        self, artist_id, include_albums=True, max_top_tracks=5, max_rel_artist=5
+    ):
+        self.call("get_artist_info")
+        artist = self.catalog.artists_by_id[artist_id]
+        albums = [a for a in self.catalog.albums if a["artistId"] == [artist_id]]
+        tracks = [t for a in albums for t in a["tracks"]]
+
+        rng = random.Random(artist_id)
+        related = rng.sample(self.catalog.artists, min(max_rel_artist, len(self.catalog.artists)))
+
+        info = dict(artist)
+        info["topTracks"] = rng.sample(tracks, min(max_top_tracks, len(tracks)))
+        info["related_artists"] = [a for a in related if a is not artist]
+        if include_albums:
+            info["albums"] = [self.album_summary(a) for a in albums]
+        return info
+
+    def get_track_info(self, store_track_id):
+        self.call("get_track_info")
+        return self.catalog.tracks_by_id[store_track_id]
+
+    def get_stream_url(self, song_id, device_id=None, quality="hi"):
+        self.call("get_stream_url")
+        track = self.catalog.tracks_by_id.get(song_id)
+        duration = int(track["durationMillis"]) // 1000 if track else 180
+        return self.stream_url_for(song_id, duration)
+
+    def create_station(
+        self,
+        name,
+        track_id=None,
+        artist_id=None,
+        album_id=None,
+        genre_id=None,
+        playlist_token=None,
+        curated_station_id=None,
+    ):
+        self.call("create_station")
+        station_id = f"station-{len(self.stations)}"
+        self.stations[station_id] = name
+        return station_id
+
+    def get_station_tracks(self, station_id, num_tracks=25, recently_played_ids=None):
+        self.call("get_station_tracks")
+        if station_id not in self.stations:
+            return []
+
+        rng = random.Random(station_id)
+        return rng.sample(self.catalog.tracks, min(num_tracks, len(self.catalog.tracks)))
+
+    def get_listen_now_situations(self):
+        self.call("get_listen_now_situations")
+        return self.catalog.situations
+
+    def get_listen_now_items(self):
+        self.call("get_listen_now_items")
+        items = [
+            {
+                "album": {
+                    "title": album["name"],
+                    "artist_name": album["albumArtist"],
+                    "artist_metajam_id": album["artistId"][0],
+                    "id": {"metajamCompactKey": album["albumId"]},
+                }
+            }
+            for album in self.catalog.albums[:10]
+        ]
+        items.extend(
+            {
+                "radio_station": {
+                    "title": artist["name"] + " Radio",
+                    "id": {"seeds": [{"artistId": artist["artistId"], "seedType": "3"}]},
+                }
+            }
+            for artist in self.catalog.artists[:5]
+        )
+        return items
+
+    @staticmethod
+    def microseconds(dt):
+        # The conversion gmusicapi applies to updated_after
+        return int(time.mktime(dt.timetuple()) * 10 ** 6) + dt.microsecond
+
+    def get_all_playlists(self, incremental=False, include_deleted=None, updated_after=None):
+        self.call("get_all_playlists")
+        since = self.microseconds(updated_after) if updated_after else None
+
+        return [
+            {key: val for key, val in playlist.items() if key != "tracks"}
+            for playlist in self.catalog.playlists
+            if (
+                int(playlist.get("lastModifiedTimestamp", 0)) > since
+                if since is not None
+                else not playlist.get("deleted", False)
+            )
+        ]
+
+    def get_shared_playlist_contents(self, share_token):
+        self.call("get_shared_playlist_contents")
+        for playlist in self.catalog.playlists:
+            if playlist.get("shareToken") == share_token:
+                return playlist["tracks"]
+        return []
+
+    def get_all_user_playlist_contents(self):
+        self.call("get_all_user_playlist_contents")
+        return self.catalog.playlists
+
+    def get_top_songs(self):
+        self.call("get_top_songs")
+        return [t for t in self.catalog.tracks if t["rating"] == "5"]
+
+    def rate_songs(self, songs, rating):
+        self.call("rate_songs")
+        if isinstance(songs, dict):
+            songs = [songs]
+
+        rated = []
+        for song in songs:
+            id_ = song.get("nid") or song.get("id")
+            track = self.catalog.tracks_by_id.get(id_)
+            if track is not None:
+                track["rating"] = str(rating)
+                rated.append(id_)
+        return rated
+
+    def logout(self):
+        return True
+
+
+class FakeYouTube(FakeService):
+    class Request:
+        def __init__(self, fn):
+            self.fn = fn
+
+        def execute(self):
+            return self.fn()
+
+    class Search:
+        def __init__(self, youtube):
+            self.youtube = youtube
+
+        def list(self, q="", maxResults=50, **kwargs):
+            return FakeYouTube.Request(lambda: self.youtube.list_videos(q, maxResults))
+
+    def __init__(self, catalog, mobileclient, settings):
+        super().__init__(settings)
+        self.catalog = catalog
+        self.mobileclient = mobileclient
+
+    def search(self):
+        return self.Search(self)
+
+    def list_videos(self, query, max_results):
+        self.call("youtube.search")
+        items = [
+            v
+            for v in self.catalog.videos
+            if FakeMobileclient.matches(query, v["snippet"]["title"], v["snippet"]["channelTitle"])
+        ]
+        return {"items": items[:max_results], "nextPageToken": None}
+
+    def stream_url(self, video_id):
+        return self.mobileclient.stream_url_for(video_id)
+
+
+def load_settings(fixture_file=None):
+    settings = dict(DEFAULT_SETTINGS)
+    data = {}
+
+    if fixture_file:
+        with open(fixture_file) as f:
+            data = json.load(f)
+        settings.update(data.get("settings", {}))
+
+    return settings, data
+
+
+def build_catalog(settings, data):
+    catalog = Catalog(settings["seed"], **settings["catalog"])
+
+    # Fixture data, where present, replaces the synthetic parts of the catalog
+    for key in ("artists", "albums", "playlists", "situations", "videos"):
+        if key in data:
+            setattr(catalog, key, data[key])
+
+    catalog.tracks = [track for album in catalog.albums for track in album["tracks"]]
+    catalog.artists_by_id = {a["artistId"]: a for a in catalog.artists}
+    catalog.albums_by_id = {a["albumId"]: a for a in catalog.albums}
+    catalog.tracks_by_id = {t["storeId"]: t for t in catalog.tracks}
+    return catalog
+
+
+def setup_fake_backend(fixture_file=None):
+    """Returns a (Mobileclient, YouTube) pair of fakes."""
+    settings, data = load_settings(fixture_file)
+    catalog = build_catalog(settings, data)
+
+    mobileclient = FakeMobileclient(catalog, settings)
+    youtube = FakeYouTube(catalog, mobileclient, settings)
+    return mobileclient, youtube
+
+
+def dump_fixture(path, **catalog_args):
+    catalog = Catalog(**catalog_args)
+    settings = {k: v for k, v in DEFAULT_SETTINGS.items() if k != "catalog"}
+
+    with open(path, "w") as f:
+        json.dump(
+            dict(
+                settings=settings,
+                artists=catalog.artists,
+                albums=catalog.albums,
+                playlists=catalog.playlists,
+                situations=catalog.situations,
+                videos=catalog.videos,
+            ),
+            f,
+            indent=1,
+            ensure_ascii=False,
+        )
+
+
+if __name__ == "__main__":
+    import sys
+
+    dump_fixture(sys.argv[1])
@@ -0,0 +1,330 @@
+"""
+Headless, scripted driver for soak and frame-time tests.
+
+Runs App against the fake backend on an in-memory screen and replays a
+script of keypresses through the real urwid main loop for as long as asked,
+recording keypress-to-draw latency, render time, RSS and object counts as
+JSON lines. For example, to run the default script for two hours:
+
+    python -m tuijam.headless --duration 7200 --output soak.jsonl
+
+Script lines are one of
+
+    search <text>          type <text> into the search input and press enter
+    key <key> [xN]         press an urwid key, optionally N times
+    action <name> [xN]     press the first key bound to a control
+    focus search|queue|input
+    wait <seconds>         pause before the next line
+
+and the script is repeated until the duration is over.
+"""
+from os import makedirs, sysconf
+from os.path import join
+from tempfile import TemporaryDirectory
+from statistics import median
+import argparse
+import gc
+import json
+import logging
+import re
+import resource
+import time
+
+import urwid
+
+from tuijam import CONFIG_DIR
+from tuijam.config import config
+
+DEFAULT_SCRIPT = """
+search love
+key down x3
+action expand
+action g_queue_all
+action g_shuffle
+focus queue
+action down x20
+action swap_up x5
+action g_play_next
+focus search
+action expand
+action back
+action back
+action g_recent
+action back
+search night
+action expand_full
+action g_queue_all
+action g_clear_queue
+wait 0.2
+"""
+
+
+class HeadlessScreen(urwid.BaseScreen):
+    """An urwid screen of fixed size that renders to nowhere."""
+
+    def __init__(self, cols=120, rows=40):
+        super().__init__()
+        self.size = (cols, rows)
+        self.frames = 0
+        self.last_canvas = None
+
+    def get_cols_rows(self):
+        return self.size
+
+    def draw_screen(self, size, canvas):
+        self.frames += 1
+        self.last_canvas = canvas
+
+    def clear(self):
+        pass
+
+    def set_terminal_properties(self, colors=None, bright_is_bold=None, has_underline=None):
+        pass
+
+    def set_mouse_tracking(self, enable=True):
+        pass
+
+    def get_input_descriptors(self):
+        return []
+
+    def get_input(self, raw_keys=False):
+        return ([], []) if raw_keys else []
+
+    def get_input_nonblocking(self):
+        return None, [], []
+
+    def hook_event_loop(self, event_loop, callback):
+        pass
+
+    def unhook_event_loop(self, event_loop):
+        pass
+
+
+def parse_script(text):
+    steps = []
+
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+
+        command, _, arg = line.partition(" ")
+        repeat = 1
+
+        if command in ("key", "action"):
+            arg, times = re.match(r"^(.*?)(?: x(\d+))?$", arg).groups()
+            repeat = int(times or 1)
+
+        steps.append((command, arg, repeat))
+
+    return steps
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentiles(values):
+    if not values:
+        return {}
+
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]  # noqa: E731
+    return dict(p50=median(values), p95=pick(0.95), p99=pick(0.99), max=values[-1])
+
+
+class Driver:
+    def __init__(self, app, loop, steps, duration, output, sample_every=10.0, step_delay=0.05):
+        self.app = app
+        self.loop = loop
+        self.steps = steps
+        self.duration = duration
+        self.output = output
+        self.sample_every = sample_every
+        self.step_delay = step_delay
+
+        self.position = 0
+        self.start_time = None
+        self.last_sample = None
+        self.latencies = []
+        self.draw_times = []
+        self.memory = []
+
+    def write(self, record):
+        self.output.write(json.dumps(record) + "\n")
+
+    def start(self):
+        self.loop.set_alarm_in(0, self.step)
+
+    def press(self, key, label):
+        start = time.perf_counter()
+        self.loop.process_input([key])
+        pressed = time.perf_counter()
+        self.loop.draw_screen()
+        drawn = time.perf_counter()
+
+        latency, draw = drawn - start, drawn - pressed
+        self.latencies.append(latency)
+        self.draw_times.append(draw)
+        self.write(
+            dict(
+                type="key",
+                t=time.time() - self.start_time,
+                step=label,
+                key=key,
+                latency_ms=latency * 1000,
+                draw_ms=draw * 1000,
+            )
+        )
+
+    def focus(self, target):
+        app = self.app
+        app.set_focus(
+            dict(
+                search=app.search_panel_wrapped,
+                queue=app.queue_panel_wrapped,
+                input=app.search_input,
+            )[target]
+        )
+
+    def run(self, command, arg, repeat):
+        from .ui import controls
+
+        label = f"{command} {arg}".strip()
+
+        if command == "search":
+            self.focus("input")
+            for char in arg:
+                self.press(char, label)
+            self.press("enter", label)
+        elif command == "key":
+            for _ in range(repeat):
+                self.press(arg, label)
+        elif command == "action":
+            for _ in range(repeat):
+                self.press(controls[arg][0], label)
+        elif command == "focus":
+            self.focus(arg)
+        elif command == "wait":
+            return float(arg)
+        else:
+            raise ValueError(f"Unknown script command: {command}")
+
+        return self.step_delay
+
+    def sample(self):
+        self.last_sample = time.time()
+        search_panel = self.app.search_panel
+
+        record = dict(
+            type="memory",
+            t=self.last_sample - self.start_time,
+            rss=rss_bytes(),
+            objects=len(gc.get_objects()),
+            search_history=len(search_panel.search_history),
+            history=len(self.app.history),
+            queue=len(self.app.queue_panel.queue),
+            frames=self.loop.screen.frames,
+        )
+        self.memory.append(record)
+        self.write(record)
+
+    def step(self, loop=None, user_data=None):
+        if self.start_time is None:
+            self.start_time = time.time()
+            self.sample()
+
+        if time.time() - self.start_time > self.duration:
+            self.finish()
+            raise urwid.ExitMainLoop()
+
+        command = self.steps[self.position % len(self.steps)]
+        self.position += 1
+
+        try:
+            delay = self.run(*command)
+        except urwid.ExitMainLoop:
+            raise
+        except Exception as e:
+            logging.exception(e)
+            self.write(dict(type="error", step=" ".join(map(str, command)), error=str(e)))
+            delay = self.step_delay
+
+        if time.time() - self.last_sample >= self.sample_every:
+            self.sample()
+
+        self.loop.set_alarm_in(delay, self.step)
+
+    def finish(self):
+        self.sample()
+        first, last = self.memory[0], self.memory[-1]
+
+        summary = dict(
+            type="summary",
+            duration=last["t"],
+            steps=self.position,
+            keys=len(self.latencies),
+            latency_ms={k: v * 1000 for k, v in percentiles(self.latencies).items()},
+            draw_ms={k: v * 1000 for k, v in percentiles(self.draw_times).items()},
+            rss_growth=last["rss"] - first["rss"],
+            object_growth=last["objects"] - first["objects"],
+        )
+        self.write(summary)
+        print(json.dumps(summary, indent=2))
+
+
+def main():
+    from .app import App, setup_loop
+
+    parser = argparse.ArgumentParser(description="Drive TUIJam without a terminal.")
+    parser.add_argument("--script", help="script file (default: built-in soak script)")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run for")
+    parser.add_argument("--fixture", default="", help="fake backend fixture")
+    parser.add_argument("--output", default="headless.jsonl")
+    parser.add_argument("--size", default="120x40", help="screen size as COLSxROWS")
+    parser.add_argument("--sample-every", type=float, default=10.0)
+    parser.add_argument("--audio", action="store_true", help="play audio instead of muting mpv")
+    args = parser.parse_args()
+
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script) as f:
+            script = f.read()
+
+    makedirs(CONFIG_DIR, exist_ok=True)
+
+    # The run's queue, history, caches and configuration go in a scratch
+    # directory. The default configuration has no control socket, MPRIS,
+    # local library or Last.fm session, and the script's default controls.
+    with TemporaryDirectory(prefix="tuijam-headless-") as data_dir:
+        config.use_file(join(data_dir, "config.yaml"))
+        config.write_defaults(mpris_enabled=False)
+
+        app = App(data_dir)
+        app.login(fake_backend=args.fixture)
+        if not args.audio:
+            app.player["ao"] = "null"
+
+        cols, rows = map(int, args.size.split("x"))
+        loop = setup_loop(app, screen=HeadlessScreen(cols, rows))
+
+        with open(args.output, "w") as output:
+            driver = Driver(
+                app, loop, parse_script(script), args.duration, output, args.sample_every
+            )
+            driver.start()
+
+            try:
+                loop.run()
+            finally:
+                app.player.quit()
+                app.prefetcher.shutdown()
+                app.art_cache.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,10 @@ import logging
 from datetime import datetime
 
 import requests
-import yaml
 
-from tuijam import __version__, CONFIG_DIR, _
-from tuijam.utility import lookup_keys
+from tuijam import __version__, _
+from tuijam.utility import lookup_keys, short_repr
+from tuijam.metrics import metrics
 
 
 class LastFMAPI:
@@ -46,11 +46,12 @@ class LastFMAPI:
         # Shame on you, Last.fm!
         api_params.update({"format": "json"})
 
-        r = requests.post(
-            LastFMAPI.API_ROOT_URL,
-            params=api_params,
-            headers={"User-Agent": LastFMAPI.USER_AGENT},
-        )
+        with metrics.timer("lastfm." + method_name):
+            r = requests.post(
+                LastFMAPI.API_ROOT_URL,
+                params=api_params,
+                headers={"User-Agent": LastFMAPI.USER_AGENT},
+            )
         return r.json()
 
     def get_token(self):
@@ -69,7 +70,7 @@ class LastFMAPI:
 
     def auth_by_token(self, token):
         response = self.call_method("auth.getSession", {"token": token})
-        logging.warning("LASTFM: auth_by_token: " + response.__str__())
+        logging.debug("LASTFM: auth_by_token: " + short_repr(response))
         if response.get("error", False):
             return False
         self.sk = response.get("session").get("key")
@@ -88,7 +89,7 @@ class LastFMAPI:
                 "sk": self.sk,
             },
         )
-        logging.warning("LASTFM: updateNowPlaying: " + response.__str__())
+        logging.debug("LASTFM: updateNowPlaying: " + short_repr(response))
         # TODO error handle
 
     def update_now_playing_song(self, song):
@@ -122,7 +123,7 @@ class LastFMAPI:
                 "sk": self.sk,
             },
         )
-        logging.warning("LASTFM: scrobble: response = " + response.__str__())
+        logging.debug("LASTFM: scrobble: response = " + short_repr(response))
 
     def scrobble_song(self, song, progress):
         # See: https://www.last.fm/api/scrobbling#when-is-a-scrobble-a-scrobble
@@ -144,11 +145,12 @@ class LastFMAPI:
 
     @staticmethod
     def configure():
-        from os.path import join, isfile
+        from os.path import isfile
         from getpass import getpass
 
-        config_file = join(CONFIG_DIR, "config.yaml")
-        if not isfile(config_file):
+        from .config import config
+
+        if not isfile(config.path):
             print(_("It seems that you haven't run tuijam yet."))
             print(_("Please run it first, then authorize to Last.fm."))
             return
@@ -173,12 +175,5 @@ class LastFMAPI:
         if not api.auth_by_token(token):
             print(_("Failed to get a session key. Have you authorized?"))
         else:
-            with open(config_file, "r+") as f:
-                lastfm_sk = api.sk
-                config = yaml.safe_load(f.read())
-                config.update({"lastfm_sk": lastfm_sk})
-                f.seek(0)
-                yaml.safe_dump(config, f, default_flow_style=False)
-                f.truncate()
-                f.close()
+            config.update(lastfm_sk=api.sk)
             print(_("Successfully authenticated."))
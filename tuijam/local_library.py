@@ -0,0 +1,380 @@
+"""
+Local music directories as a source of tracks.
+
+The configured directories are scanned into a persistent index of tags
+(LIBRARY_FILE). Rescans only read the tags of files whose size or mtime
+changed, reading them on a thread pool, and with inotify_simple installed,
+changes are picked up as they happen. Tags are read with mutagen if it is
+installed, and guessed from the file and directory names otherwise.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import scandir, replace, stat
+from os.path import join, dirname, basename, splitext, abspath, expanduser
+import json
+import logging
+import re
+import threading
+import time
+
+from tuijam import LIBRARY_FILE
+from .metrics import metrics
+from .music_objects import LocalTrack
+from .text_index import TokenIndex
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+AUDIO_EXTENSIONS = {".mp3", ".flac", ".ogg", ".opus", ".m4a", ".wav", ".aac"}
+COVER_NAMES = {"cover", "folder", "front", "album"}
+COVER_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+INDEX_VERSION = 1
+
+
+def guess_tags(path):
+    """Tags from a .../Artist/Album/01 - Title.ext layout."""
+    stem = splitext(basename(path))[0]
+    album_dir = dirname(path)
+    tags = dict(
+        title=stem,
+        album=basename(album_dir),
+        artist=basename(dirname(album_dir)),
+        track=0,
+        duration=0,
+    )
+
+    match = re.match(r"^(\d{1,3})[\s._-]+(.+)$", stem)
+    if match:
+        tags["track"], tags["title"] = int(match.group(1)), match.group(2)
+
+    return tags
+
+
+def read_tags(path):
+    tags = guess_tags(path)
+
+    if mutagen is None:
+        return tags
+
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception as e:
+        logging.debug(f"Could not read tags of {path}: {e}")
+        return tags
+
+    if audio is None:
+        return tags
+
+    found = audio.tags or {}
+
+    def first(key):
+        values = found.get(key)
+        return str(values[0]) if values else None
+
+    tags["title"] = first("title") or tags["title"]
+    tags["album"] = first("album") or tags["album"]
+    tags["artist"] = first("artist") or first("albumartist") or tags["artist"]
+
+    try:
+        tags["track"] = int((first("tracknumber") or "").split("/")[0])
+    except ValueError:
+        pass
+
+    if audio.info is not None:
+        tags["duration"] = int(getattr(audio.info, "length", 0) or 0)
+
+    return tags
+
+
+def walk(directories):
+    """
+    Returns ({path: (mtime_ns, size)} of the audio files, {directory: cover
+    image}, [directories]) under directories.
+    """
+    files, covers, seen = {}, {}, []
+    stack = list(directories)
+
+    while stack:
+        directory = stack.pop()
+        seen.append(directory)
+
+        try:
+            with scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                            continue
+
+                        stem, ext = splitext(entry.name)
+                        ext = ext.lower()
+
+                        if ext in AUDIO_EXTENSIONS:
+                            st = entry.stat()
+                            files[entry.path] = (st.st_mtime_ns, st.st_size)
+                        elif ext in COVER_EXTENSIONS and stem.lower() in COVER_NAMES:
+                            covers[directory] = entry.path
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.warning(f"Could not scan {directory}: {e}")
+
+    return files, covers, seen
+
+
+class LocalLibrary:
+    WATCH_FLAGS = 0
+    if INotify is not None:
+        WATCH_FLAGS = (
+            flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE | flags.CREATE
+        )
+
+    def __init__(self, app, directories, path=LIBRARY_FILE, watch=True, max_workers=8):
+        self.app = app
+        self.directories = [abspath(expanduser(d)) for d in directories]
+        self.path = path
+        self.watch = watch and INotify is not None
+
+        self.entries = {}  # path -> index entry
+        self.tracks = {}  # path -> LocalTrack
+        self.by_id = {}  # id(LocalTrack) -> LocalTrack, to resolve index matches
+        self.index = TokenIndex()
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.loop = None
+        self.scanning = False
+        self.save_lock = threading.Lock()
+
+        self.inotify = None
+        self.watches = {}  # watch descriptor -> directory
+        self.dirty = set()
+        self.dirty_alarm = None
+
+    def start(self, loop):
+        """Loads the saved index and rescans in the background."""
+        self.loop = loop
+        threading.Thread(target=self.refresh, args=(True,), daemon=True).start()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Discarding unreadable local library index: {e}")
+            return {}
+
+        if data.get("version") != INDEX_VERSION:
+            return {}
+
+        return {entry["path"]: entry for entry in data.get("entries", [])}
+
+    def save(self, entries):
+        with self.save_lock:
+            tmp_path = self.path + ".tmp"
+            try:
+                # json.dumps uses the C encoder, json.dump to a file doesn't
+                data = json.dumps(
+                    dict(version=INDEX_VERSION, entries=list(entries.values())),
+                    ensure_ascii=False,
+                )
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                replace(tmp_path, self.path)
+            except OSError as e:
+                logging.warning(f"Could not save local library index: {e}")
+
+    def scan(self, known):
+        """
+        The index entries of all files under the directories, reusing those
+        in known whose files didn't change, the scanned directories, and
+        whether anything changed.
+        """
+        files, covers, directories = walk(self.directories)
+        entries, changed = {}, []
+        modified = len(files) != len(known)
+
+        for path, (mtime, size) in files.items():
+            entry = known.get(path)
+            if entry is not None and entry["mtime"] == mtime and entry["size"] == size:
+                entries[path] = entry
+            else:
+                changed.append(path)
+
+        for path, tags in zip(changed, self.executor.map(read_tags, changed)):
+            mtime, size = files[path]
+            entries[path] = dict(tags, path=path, mtime=mtime, size=size)
+
+        for path, entry in entries.items():
+            cover = covers.get(dirname(path))
+            if entry.get("cover") != cover:
+                entry["cover"] = cover
+                modified = True
+
+        logging.info(
+            f"Scanned {len(entries)} local files, read the tags of {len(changed)}"
+        )
+        return entries, directories, modified or bool(changed)
+
+    def refresh(self, initial=False):
+        """Rescans the directories. Runs in a background thread."""
+        if self.scanning:
+            return
+        self.scanning = True
+
+        try:
+            start = time.perf_counter()
+            known = self.load() if initial else dict(self.entries)
+
+            if initial and known:
+                # Show the saved library right away, then update it
+                self.app.call_in_main(self.set_entries, known, None)
+
+            entries, directories, modified = self.scan(known)
+            self.app.call_in_main(self.set_entries, entries, directories)
+            if modified:
+                self.save(entries)
+
+            metrics.observe("local.scan", time.perf_counter() - start)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self.scanning = False
+
+    def set_entries(self, entries, directories):
+        tracks = {}
+        for path, entry in entries.items():
+            track = self.tracks.get(path)
+            if track is None or self.entries.get(path) is not entry:
+                track = LocalTrack.from_dict(entry)
+            if track is not None:
+                tracks[path] = track
+
+        self.entries = entries
+        self.tracks = tracks
+        self.by_id = {id(track): track for track in tracks.values()}
+        self.index.reset(tracks.values())
+
+        if directories is not None and self.watch:
+            self.watch_directories(directories)
+
+    def update(self, entries, removed):
+        """Applies the changes to single files found through inotify."""
+        for path in removed:
+            self.entries.pop(path, None)
+            track = self.tracks.pop(path, None)
+            if track is not None:
+                self.by_id.pop(id(track), None)
+                self.index.remove([track])
+
+        for path, entry in entries.items():
+            old = self.tracks.get(path)
+            if old is not None:
+                self.by_id.pop(id(old), None)
+                self.index.remove([old])
+
+            track = LocalTrack.from_dict(entry)
+            if track is None:
+                continue
+
+            self.entries[path] = entry
+            self.tracks[path] = track
+            self.by_id[id(track)] = track
+            self.index.add([track])
+
+        self.executor.submit(self.save, dict(self.entries))
+
+    def watch_directories(self, directories):
+        if self.inotify is None:
+            try:
+                self.inotify = INotify()
+            except OSError as e:
+                logging.warning(f"Could not watch local music directories: {e}")
+                self.watch = False
+                return
+            self.loop.watch_file(self.inotify.fileno(), self.inotify_ready)
+
+        watched = set(self.watches.values())
+        for directory in directories:
+            if directory in watched:
+                continue
+            try:
+                self.watches[self.inotify.add_watch(directory, self.WATCH_FLAGS)] = directory
+            except OSError as e:
+                # Most likely out of inotify watches (fs.inotify.max_user_watches)
+                logging.warning(f"Could not watch {directory}: {e}")
+                break
+
+    def inotify_ready(self):
+        rescan = False
+
+        for event in self.inotify.read(timeout=0):
+            directory = self.watches.get(event.wd)
+            if directory is None:
+                continue
+
+            path = join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                rescan = True
+            elif splitext(event.name)[1].lower() in AUDIO_EXTENSIONS:
+                self.dirty.add(path)
+
+        if rescan:
+            threading.Thread(target=self.refresh, daemon=True).start()
+            self.dirty.clear()
+        elif self.dirty and self.dirty_alarm is None:
+            # Files are often written in several steps, so wait for a pause
+            self.dirty_alarm = self.loop.set_alarm_in(1, self.update_dirty)
+
+    def update_dirty(self, *args):
+        self.dirty_alarm = None
+        paths, self.dirty = self.dirty, set()
+        self.executor.submit(self.read_files, paths)
+
+    def read_files(self, paths):
+        entries, removed = {}, []
+
+        for path in paths:
+            try:
+                st = stat(path)
+            except OSError:
+                removed.append(path)
+                continue
+
+            cover = self.entries.get(path, {}).get("cover")
+            entries[path] = dict(
+                read_tags(path), path=path, mtime=st.st_mtime_ns, size=st.st_size, cover=cover
+            )
+
+        self.app.call_in_main(self.update, entries, removed)
+
+    def search(self, query):
+        matches = self.index.search(query)
+        if not matches:
+            return []
+
+        return sorted(
+            (self.by_id[key] for key in matches if key in self.by_id),
+            key=lambda track: (track.artist, track.album, track.track, track.title),
+        )
+
+    def album_tracks(self, track):
+        """The tracks in the same directory as track, in track order."""
+        directory = dirname(track.path)
+        return sorted(
+            (t for path, t in self.tracks.items() if dirname(path) == directory),
+            key=lambda t: (t.track, t.title),
+        )
@@ -0,0 +1,119 @@
+"""
+Logging that never blocks the UI thread.
+
+Records are handed to a background thread through a bounded queue and
+written to a size-rotated log file there. When the queue is full, records
+are dropped (and counted) rather than waiting on the disk, and bursts of the
+same message are rate limited.
+"""
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from tuijam.metrics import metrics
+
+VERBOSITY = (logging.WARNING, logging.INFO, logging.DEBUG)
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class DroppingQueueHandler(QueueHandler):
+    """A QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.count("log.dropped")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `burst` records from the same logging call per
+    `period` seconds. The next record let through notes how many were
+    suppressed in between.
+    """
+
+    def __init__(self, burst=10, period=10.0):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.lock = threading.Lock()
+        self.windows = {}  # (pathname, lineno) -> [window start, count, suppressed]
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+
+        with self.lock:
+            window = self.windows.get(key)
+
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+
+                if len(self.windows) > 1024:
+                    self.prune(now)
+
+                if suppressed:
+                    record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+                return True
+
+            window[1] += 1
+            if window[1] <= self.burst:
+                return True
+
+            window[2] += 1
+            metrics.count("log.suppressed")
+            return False
+
+    def prune(self, now):
+        self.windows = {
+            key: window for key, window in self.windows.items() if now - window[0] < self.period
+        }
+
+
+def setup_logging(
+    log_file, verbosity=0, max_bytes=5 * 2 ** 20, backup_count=3, queue_size=10000
+):
+    """
+    Routes the root logger through a DroppingQueueHandler to a rotating file
+    handler on a background thread. Returns the QueueListener, which is
+    stopped (flushing the queue) at exit.
+    """
+    file_handler = RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+    )
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+
+    # Keep the previous run's log around as log.txt.1 instead of appending to it
+    try:
+        file_handler.doRollover()
+    except OSError:
+        pass
+
+    queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(VERBOSITY[min(verbosity, len(VERBOSITY) - 1)])
+
+    # Chatty third party loggers only get to log at -vvv
+    if verbosity < 3:
+        for name in ("urllib3", "googleapiclient", "gmusicapi"):
+            logging.getLogger(name).setLevel(max(root.level, logging.INFO))
+
+    listener = QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,142 @@
+from collections import defaultdict, deque, Counter
+from contextlib import contextmanager
+from functools import wraps
+from os import replace
+import json
+import threading
+import time
+
+
+class Histogram:
+    """Latency samples over a rolling window, plus running totals."""
+
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return dict(count=0, total=0.0)
+
+        def quantile(q):
+            return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+        return dict(
+            count=self.count,
+            total=self.total,
+            last=self.samples[-1],
+            p50=quantile(0.5),
+            p90=quantile(0.9),
+            p99=quantile(0.99),
+            max=samples[-1],
+        )
+
+
+class Metrics:
+    """
+    Process-wide registry of latency histograms (in seconds) and event
+    counters. Safe to use from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(Histogram)
+        self.counters = Counter()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms[name].observe(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count("errors." + name)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                timestamp=time.time(),
+                latency={name: h.summary() for name, h in sorted(self.histograms.items())},
+                counters=dict(sorted(self.counters.items())),
+            )
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = ["# TYPE tuijam_latency_seconds summary"]
+
+        for name, summary in snapshot["latency"].items():
+            label = f'name="{name}"'
+            for q in ("p50", "p90", "p99"):
+                if q in summary:
+                    quantile = int(q[1:]) / 100
+                    lines.append(
+                        f'tuijam_latency_seconds{{{label},quantile="{quantile}"}} {summary[q]:.6f}'
+                    )
+            lines.append(f"tuijam_latency_seconds_sum{{{label}}} {summary['total']:.6f}")
+            lines.append(f"tuijam_latency_seconds_count{{{label}}} {summary['count']}")
+
+        lines.append("# TYPE tuijam_events_total counter")
+        for name, value in snapshot["counters"].items():
+            lines.append(f'tuijam_events_total{{name="{name}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, fmt="json"):
+        """Atomically writes the metrics to path, as JSON or a Prometheus textfile."""
+        data = self.to_prometheus() if fmt == "prometheus" else self.to_json()
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        replace(tmp_path, path)
+
+
+class Instrumented:
+    """Proxy that times every method call on obj as "<prefix>.<method>"."""
+
+    def __init__(self, obj, prefix, registry=None):
+        self._obj = obj
+        self._prefix = prefix
+        self._registry = registry or metrics
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+
+        if not callable(value):
+            return value
+
+        return self._registry.timed(f"{self._prefix}.{attr}")(value)
+
+
+metrics = Metrics()
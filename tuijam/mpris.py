@@ -1,11 +1,22 @@
+from itertools import count
+from urllib.parse import quote
 import logging
 
-from .music_objects import Song, YTVideo
+from .music_objects import Song, YTVideo, LocalTrack
+from .art_cache import remote_art_url
 
 """
 """
 
+NO_TRACK = "/org/mpris/MediaPlayer2/TrackList/NoTrack"
+
+# pydbus answers a failed call with the error name of the exception's class
+# name, when that has a dot in it
+NotSupported = type("org.freedesktop.DBus.Error.NotSupported", (Exception,), {})
+
+
 def setup_mpris(app):
+    from gi.repository import GLib
     from pydbus import SessionBus, Variant
     from pydbus.generic import signal
 
@@ -55,6 +66,43 @@ def setup_mpris(app):
     <method name="OpenUri">
       <arg type="s" direction="in" />
     </method>
+    <signal name="Seeked">
+      <arg name="Position" type="x" />
+    </signal>
+  </interface>
+  <interface name="org.mpris.MediaPlayer2.TrackList">
+    <property name="Tracks" type="ao" access="read" />
+    <property name="CanEditTracks" type="b" access="read" />
+    <method name="GetTracksMetadata">
+      <arg name="TrackIds" type="ao" direction="in" />
+      <arg name="Metadata" type="aa{sv}" direction="out" />
+    </method>
+    <method name="AddTrack">
+      <arg name="Uri" type="s" direction="in" />
+      <arg name="AfterTrack" type="o" direction="in" />
+      <arg name="SetAsCurrent" type="b" direction="in" />
+    </method>
+    <method name="RemoveTrack">
+      <arg name="TrackId" type="o" direction="in" />
+    </method>
+    <method name="GoTo">
+      <arg name="TrackId" type="o" direction="in" />
+    </method>
+    <signal name="TrackListReplaced">
+      <arg name="Tracks" type="ao" />
+      <arg name="CurrentTrack" type="o" />
+    </signal>
+    <signal name="TrackAdded">
+      <arg name="Metadata" type="a{sv}" />
+      <arg name="AfterTrack" type="o" />
+    </signal>
+    <signal name="TrackRemoved">
+      <arg name="TrackId" type="o" />
+    </signal>
+    <signal name="TrackMetadataChanged">
+      <arg name="TrackId" type="o" />
+      <arg name="Metadata" type="a{sv}" />
+    </signal>
   </interface>
   <interface name="org.bluez.Media1">
     <method name="RegisterEndpoint">
@@ -75,14 +123,145 @@ def setup_mpris(app):
 </node>
         """
         PropertiesChanged = signal()
+        Seeked = signal()
+        TrackListReplaced = signal()
+        TrackAdded = signal()
+        TrackRemoved = signal()
+        TrackMetadataChanged = signal()
+
+        # Changes touching more tracks than this are announced with a single
+        # TrackListReplaced instead of one signal per track.
+        max_incremental_changes = 64
+        # Upper bound on the number of tracks answered by GetTracksMetadata.
+        max_metadata_batch = 512
 
         def __init__(self, app):
             self.app = app
+            self.changed = set()
+            self.metadata = None
+            self.metadata_song = None
+
+            # TrackList ids, kept parallel to the queue. The current song
+            # comes first in Tracks and keeps the id it had in the queue.
+            self.track_counter = count()
+            self.track_ids = []
+            self.tracks = {}
+            self.current = (None, NO_TRACK)  # (song, track id)
+            self.retired = []  # (song, track id) removed from the queue, not yet announced
+            self.sync_scheduled = False
+            self.queue_reset(announce=False)
 
         def emit_property_changed(self, attr):
-            self.PropertiesChanged(
-                "org.mpris.MediaPlayer2.Player", {attr: getattr(self, attr)}, []
-            )
+            """
+            Queues a change of attr. Every change made during one main loop
+            iteration goes out in a single PropertiesChanged signal.
+            """
+            if attr == "Metadata":
+                self.metadata = None
+
+            if not self.changed:
+                GLib.idle_add(self.flush_property_changes)
+
+            self.changed.add(attr)
+
+        def flush_property_changes(self):
+            self.sync_tracks()
+            changed, self.changed = self.changed, set()
+
+            if changed:
+                self.PropertiesChanged(
+                    "org.mpris.MediaPlayer2.Player",
+                    {attr: getattr(self, attr) for attr in changed},
+                    [],
+                )
+
+            return False  # run once
+
+        def seeked(self):
+            self.Seeked(self.Position)
+
+        def new_track_id(self):
+            return f"/org/tuijam/track/{next(self.track_counter)}"
+
+        def queue_inserted(self, idx, songs):
+            new_ids = [self.new_track_id() for _ in songs]
+            self.track_ids[idx:idx] = new_ids
+            self.tracks.update(zip(new_ids, songs))
+
+            if len(songs) > self.max_incremental_changes:
+                self.announce_track_list()
+                return
+
+            for pos, (track_id, song) in enumerate(zip(new_ids, songs), idx):
+                after = self.track_ids[pos - 1] if pos > 0 else self.current[1]
+                self.TrackAdded(self.build_metadata(song, track_id, False), after)
+
+        def queue_removed(self, idx, songs):
+            removed = self.track_ids[idx:idx + len(songs)]
+            del self.track_ids[idx:idx + len(songs)]
+
+            for track_id in removed:
+                self.tracks.pop(track_id, None)
+
+            # Announced once the loop is idle: by then a song taken off the
+            # queue to be played has become the current track, keeping its id
+            self.retired.extend(zip(songs, removed))
+            if not self.sync_scheduled:
+                self.sync_scheduled = True
+                GLib.idle_add(self.sync_tracks)
+
+        def sync_tracks(self):
+            """
+            Announces the tracks retired from the queue and a change of the
+            current song, which is moved to the front of the track list.
+            """
+            self.sync_scheduled = False
+            retired, self.retired = self.retired, []
+            song = self.app.current_song
+            added = None
+
+            if song is not self.current[0]:
+                if self.current[1] != NO_TRACK:
+                    retired.append(self.current)
+
+                if song is None:
+                    self.current = (None, NO_TRACK)
+                else:
+                    track_id = next((tid for s, tid in retired if s is song), None)
+                    if track_id is None:
+                        track_id = added = self.new_track_id()
+                    self.current = (song, track_id)
+
+            removed = [tid for _, tid in retired if tid != self.current[1]]
+
+            if len(removed) > self.max_incremental_changes:
+                self.announce_track_list()
+                return False
+
+            for track_id in removed:
+                self.TrackRemoved(track_id)
+            if added is not None:
+                self.TrackAdded(self.build_metadata(song, added, False), NO_TRACK)
+
+            return False  # run once
+
+        def queue_reset(self, announce=True):
+            self.track_ids = [self.new_track_id() for _ in self.app.queue_panel.queue]
+            self.tracks = dict(zip(self.track_ids, self.app.queue_panel.queue))
+
+            if announce:
+                self.announce_track_list()
+
+        def announce_track_list(self):
+            self.TrackListReplaced(self.Tracks, self.current[1])
+
+        def art_fetched(self, url, window=8):
+            for track_id in self.track_ids[:window]:
+                song = self.tracks[track_id]
+                if remote_art_url(song) == url:
+                    self.TrackMetadataChanged(
+                        track_id, self.build_metadata(song, track_id, False)
+                    )
 
         @property
         def CanQuit(self):
@@ -94,7 +273,7 @@ def setup_mpris(app):
 
         @property
         def HasTrackList(self):
-            return False
+            return True
 
         @property
         def Identity(self):
@@ -130,17 +309,27 @@ def setup_mpris(app):
 
         @property
         def Metadata(self):
+            self.sync_tracks()
             song = self.app.current_song
 
+            if self.metadata is None or self.metadata_song is not song:
+                self.metadata = self.build_metadata(song, self.current[1])
+                self.metadata_song = song
+
+            return self.metadata
+
+        def build_metadata(self, song, track_id, fetch_art=True):
+            art_url = self.app.art_cache.lookup(remote_art_url(song), fetch=fetch_art)
+
             if type(song) == Song:
 
                 logging.info("New song ID: " + str(song.id))
+                minutes, seconds = song.length
 
                 return {
-                    "mpris:trackid": Variant(
-                        "o", "/org/tuijam/GM_" + str(song.id).replace("-", "_")
-                    ),
-                    "mpris:artUrl": Variant("s", song.albumArtRef),
+                    "mpris:trackid": Variant("o", track_id),
+                    "mpris:length": Variant("x", (minutes * 60 + seconds) * 1000000),
+                    "mpris:artUrl": Variant("s", art_url),
                     "xesam:title": Variant("s", song.title),
                     "xesam:artist": Variant("as", [song.artist]),
                     "xesam:album": Variant("s", song.album),
@@ -150,16 +339,29 @@ def setup_mpris(app):
             elif type(song) == YTVideo:
 
                 return {
-                    "mpris:trackid": Variant(
-                        "o", "/org/tuijam/YT_" + str(song.id).replace("-", "_")
-                    ),
-                    "mpris:artUrl": Variant("s", song.thumbnail),
+                    "mpris:trackid": Variant("o", track_id),
+                    "mpris:artUrl": Variant("s", art_url),
                     "xesam:title": Variant("s", song.title),
                     "xesam:artist": Variant("as", [song.channel]),
                     "xesam:album": Variant("s", ""),
                     "xesam:url": Variant("s", song.stream_url),
                 }
 
+            elif type(song) == LocalTrack:
+                minutes, seconds = song.length
+                url = "file://" + quote(song.path)
+
+                return {
+                    "mpris:trackid": Variant("o", track_id),
+                    "mpris:length": Variant("x", (minutes * 60 + seconds) * 1000000),
+                    "mpris:artUrl": Variant("s", "file://" + quote(song.cover) if song.cover else ""),
+                    "xesam:title": Variant("s", song.title),
+                    "xesam:artist": Variant("as", [song.artist]),
+                    "xesam:album": Variant("s", song.album),
+                    "xesam:trackNumber": Variant("i", song.track),
+                    "xesam:url": Variant("s", url),
+                }
+
             else:
                 return {}
 
@@ -253,14 +455,61 @@ def setup_mpris(app):
                 self.app.toggle_play()
 
         def Seek(self, offset):
-            pass
+            if self.app.current_song is not None:
+                self.app.seek(offset / 1000000)
 
         def SetPosition(self, track_id, position):
-            pass
+            song = self.app.current_song
+
+            if song is None or track_id != self.current[1] or position < 0:
+                return
+
+            self.app.seek_to(position / 1000000)
 
         def OpenUri(self, uri):
             pass
 
+        @property
+        def Tracks(self):
+            if self.current[0] is None:
+                return list(self.track_ids)
+            return [self.current[1]] + self.track_ids
+
+        @property
+        def CanEditTracks(self):
+            return False
+
+        def GetTracksMetadata(self, track_ids):
+            self.sync_tracks()
+            tracks = dict(self.tracks)
+            if self.current[0] is not None:
+                tracks[self.current[1]] = self.current[0]
+
+            return [
+                self.build_metadata(tracks[track_id], track_id, False)
+                for track_id in track_ids[:self.max_metadata_batch]
+                if track_id in tracks
+            ]
+
+        def AddTrack(self, uri, after_track, set_as_current):
+            raise NotSupported("The track list can't be edited (CanEditTracks is false)")
+
+        def RemoveTrack(self, track_id):
+            raise NotSupported("The track list can't be edited (CanEditTracks is false)")
+
+        def GoTo(self, track_id):
+            self.sync_tracks()
+            if track_id == self.current[1] and self.current[0] is not None:
+                self.app.seek_to(0)
+                return
+
+            if track_id not in self.tracks:
+                return
+
+            queue_panel = self.app.queue_panel
+            queue_panel.to_top(self.track_ids.index(track_id))
+            queue_panel.play_next()
+
         def RegisterEndpoint(self, endpoint, properties):
             pass
 
@@ -277,6 +526,7 @@ def setup_mpris(app):
         mpris = MPRIS(app)
         bus = SessionBus()
         bus.publish("org.mpris.MediaPlayer2.tuijam", ("/org/mpris/MediaPlayer2", mpris))
+        app.queue_panel.add_listener(mpris)
         return mpris
     except Exception as e:
         logging.exception(e)
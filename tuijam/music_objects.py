@@ -1,3 +1,4 @@
+from functools import wraps
 from itertools import zip_longest
 import logging
 import json
@@ -5,10 +6,79 @@ import json
 import urwid
 
 from tuijam import _
-from .utility import sec_to_min_sec
+from .utility import sec_to_min_sec, short_repr
+
+
+class CachedRow(urwid.WidgetWrap):
+    """
+    Wraps a row widget and keeps its canvases and heights, keyed by size and
+    focus, so scrolling over it again skips measuring and laying out its text.
+    Only a few sizes are kept, which is enough across terminal resizes.
+    """
+
+    max_sizes = 4
+
+    def __init__(self, widget):
+        super().__init__(widget)
+        self.canvases = {}
+        self.heights = {}
+
+    def selectable(self):
+        return self._w.selectable()
+
+    def replace(self, widget):
+        """Shows widget instead, dropping what was kept of the old one."""
+        self._w = widget
+        self.canvases.clear()
+        self.heights.clear()
+
+    def rows(self, size, focus=False):
+        key = (size, focus)
+        height = self.heights.get(key)
+
+        if height is None:
+            if len(self.heights) >= self.max_sizes:
+                self.heights.clear()
+            height = self.heights[key] = self._w.rows(size, focus)
+
+        return height
+
+    def render(self, size, focus=False):
+        key = (size, focus)
+        canvas = self.canvases.get(key)
+
+        if canvas is None:
+            if len(self.canvases) >= self.max_sizes:
+                self.canvases.clear()
+            canvas = self.canvases[key] = self._w.render(size, focus)
+
+        return urwid.CompositeCanvas(canvas)
+
+
+def cached_ui(ui):
+    """
+    Memoizes the row widget of a MusicObject, so each object is laid out once
+    however often it is listed. Call invalidate_ui() after changing anything
+    the row shows; the row is rebuilt in place, so every panel listing the
+    object shows the change.
+    """
+
+    @wraps(ui)
+    def wrapper(self):
+        row = self.__dict__.get("_ui")
+        if row is None:
+            row = self._ui = CachedRow(ui(self))
+        return row
+
+    return wrapper
 
 
 class MusicObject:
+    def invalidate_ui(self):
+        row = self.__dict__.get("_ui")
+        if row is not None:
+            row.replace(type(self).ui.__wrapped__(self))
+
     @staticmethod
     def to_ui(*txts, weights=()):
         first, *rest = [
@@ -75,6 +145,7 @@ class Song(MusicObject):
     def fmt_str(self):
         return [("np_song", f"{self.title} "), _("by "), ("np_artist", f"{self.artist}")]
 
+    @cached_ui
     def ui(self):
         from .ui import RATE_UI
 
@@ -137,7 +208,7 @@ class Song(MusicObject):
             )
 
         except KeyError as e:
-            logging.exception(f"Missing Key {e} in dict \n{d}")
+            logging.warning(f"Missing Key {e} in dict {short_repr(d)}")
 
 
 class YTVideo(MusicObject):
@@ -160,6 +231,7 @@ class YTVideo(MusicObject):
     def fmt_str(self):
         return [("np_song", f"{self.title} "), _("by "), ("np_artist", f"{self.channel}")]
 
+    @cached_ui
     def ui(self):
         return self.to_ui(self.title, self.channel, weights=self.ui_weights)
 
@@ -179,7 +251,64 @@ class YTVideo(MusicObject):
             return YTVideo(title, channel, thumbnail, id_)
 
         except KeyError as e:
-            logging.exception(f"Missing Key {e} in dict \n{d}")
+            logging.warning(f"Missing Key {e} in dict {short_repr(d)}")
+
+
+class LocalTrack(MusicObject):
+    ui_weights = (1, 2, 1, 0.2)
+
+    def __init__(self, title, album, artist, path, length, track=0, cover=None):
+        self.title = title
+        self.album = album
+        self.artist = artist
+        self.path = path
+        self.id = path
+        self.length = length
+        self.track = track
+        self.cover = cover
+        self.stream_url = path
+
+    def __repr__(self):
+        return f"<LocalTrack title:{self.title}, album:{self.album}, artist:{self.artist}>"
+
+    def __str__(self):
+        return "{} {}{}".format(self.title, _("by "), self.artist)
+
+    def fmt_str(self):
+        return [("np_song", f"{self.title} "), _("by "), ("np_artist", f"{self.artist}")]
+
+    @cached_ui
+    def ui(self):
+        return self.to_ui(
+            self.title,
+            self.album,
+            self.artist,
+            "{:d}:{:02d}".format(*self.length),
+            weights=self.ui_weights,
+        )
+
+    @classmethod
+    def header(cls):
+        return MusicObject.header_ui(
+            _("Local"), _("Album"), _("Artist"), _("Length"), weights=cls.ui_weights
+        )
+
+    @staticmethod
+    def from_dict(d):
+        """From an entry of the local library index."""
+        try:
+            return LocalTrack(
+                d["title"],
+                d["album"],
+                d["artist"],
+                d["path"],
+                sec_to_min_sec(d["duration"]),
+                d.get("track", 0),
+                d.get("cover"),
+            )
+
+        except KeyError as e:
+            logging.warning(f"Missing Key {e} in dict {short_repr(d)}")
 
 
 class Album(MusicObject):
@@ -194,6 +323,7 @@ class Album(MusicObject):
     def __repr__(self):
         return f"<Album title:{self.title}, artist:{self.artist}, year:{self.year}>"
 
+    @cached_ui
     def ui(self):
         return self.to_ui(self.title, self.artist, self.year)
 
@@ -229,7 +359,7 @@ class Album(MusicObject):
             return Album(title, artist, artistId, year, id_)
 
         except KeyError as e:
-            logging.exception(f"Missing Key {e} in dict \n{d}")
+            logging.warning(f"Missing Key {e} in dict {short_repr(d)}")
 
 
 class Artist(MusicObject):
@@ -240,6 +370,7 @@ class Artist(MusicObject):
     def __repr__(self):
         return f"<Artist name:{self.name}>"
 
+    @cached_ui
     def ui(self):
         return self.to_ui(self.name)
 
@@ -257,7 +388,7 @@ class Artist(MusicObject):
 
         except KeyError as e:
 
-            logging.exception(f"Missing Key {e} in dict \n{d}")
+            logging.warning(f"Missing Key {e} in dict {short_repr(d)}")
 
 
 class Situation(MusicObject):
@@ -272,6 +403,7 @@ class Situation(MusicObject):
     def __repr__(self):
         return f"<Situation title:{self.title}>"
 
+    @cached_ui
     def ui(self):
         return self.to_ui(self.title, self.description)
 
@@ -311,7 +443,7 @@ class Situation(MusicObject):
             return Situation(title, description, id_, stations)
 
         except KeyError as e:
-            logging.exception(f"Missing Key {e} in dict \n{d}")
+            logging.warning(f"Missing Key {e} in dict {short_repr(d)}")
 
 
 class RadioStation(MusicObject):
@@ -323,15 +455,20 @@ class RadioStation(MusicObject):
     def __repr__(self):
         return f"<RadioStation title:{self.title}>"
 
+    @cached_ui
     def ui(self):
         return self.to_ui(self.title)
 
-    def get_station_id(self, api):
+    def get_station_id(self, api, cache=None):
         if self.id:
-            return api.create_station(self.title, curated_station_id=self.id)
+            seed = dict(curated_station_id=self.id)
+        else:
+            seed = dict(artist_id=self.seeds[0]["artistId"])
 
-        seed = self.seeds[0]
-        return api.create_station(self.title, artist_id=seed["artistId"])
+        if cache is None:
+            return api.create_station(self.title, **seed)
+
+        return cache.get_or_create(api, self.title, **seed)
 
     @staticmethod
     def header():
@@ -347,22 +484,25 @@ class RadioStation(MusicObject):
             return RadioStation(title, seeds)
 
         except KeyError as e:
-            logging.exception(f"Missing Key {e} in dict \n{d}")
+            logging.warning(f"Missing Key {e} in dict {short_repr(d)}")
 
 
 class Playlist(MusicObject):
     ui_weights = (0.4, 1)
 
-    def __init__(self, name, songs=None, id_=None):
+    def __init__(self, name, songs=None, id_=None, size=None):
         self.name = name
-        self.songs = songs
+        self.songs = songs  # None until fetched, see App.playlist_songs
         self.id = id_
+        self.size = size if songs is None else len(songs)
 
     def __repr__(self):
         return f"<Playlist name:{self.name}>"
 
+    @cached_ui
     def ui(self):
-        return self.to_ui(self.name, str(len(self.songs)), weights=self.ui_weights)
+        size = "" if self.size is None else str(self.size)
+        return self.to_ui(self.name, size, weights=self.ui_weights)
 
     @classmethod
     def header(cls):
@@ -374,6 +514,13 @@ class Playlist(MusicObject):
         try:
             name = d["name"]
             id_ = d["id"]
+
+            if "tracks" not in d:
+                # Just the metadata, the songs are fetched when needed
+                if d.get("size") != 0:
+                    return Playlist(name, None, id_, d.get("size"))
+                return None
+
             songs = [
                 Song.from_dict(song["track"]) for song in d["tracks"] if "track" in song
             ]
@@ -382,15 +529,18 @@ class Playlist(MusicObject):
                 return Playlist(name, songs, id_)
 
         except KeyError as e:
-            logging.exception(f"Missing Key {e} in dict \n{d}")
+            logging.warning(f"Missing Key {e} in dict {short_repr(d)}")
 
 
 def serialize(music_objects: list) -> str:
     class CustomEncoder(json.JSONEncoder):
         def default(self, obj):
-            if isinstance(obj, (Song, YTVideo)):
+            if isinstance(obj, (Song, YTVideo, LocalTrack)):
                 key = "__%s__" % obj.__class__.__name__
-                return {key: obj.__dict__}
+                # underscored attributes, like cached widgets, aren't persisted
+                return {
+                    key: {k: v for k, v in obj.__dict__.items() if not k.startswith("_")}
+                }
             return json.JSONEncoder.default(self, obj)
 
     return json.dumps(music_objects, cls=CustomEncoder)
@@ -0,0 +1,207 @@
+"""
+Local store of the user's Google Music playlists.
+
+Playlist metadata is synced incrementally: each sync only asks for the
+playlists changed since the newest change seen before. The tracks of a
+playlist are fetched the first time it is expanded or queued and kept in a
+file of their own, until the playlist changes or they get old, so opening
+Listen Now never downloads the contents of every playlist.
+"""
+from datetime import datetime
+from os import makedirs, replace, remove
+from os.path import join
+import json
+import logging
+import threading
+import time
+
+from tuijam import PLAYLIST_DIR
+
+INDEX_VERSION = 1
+LIKED_ID = "tuijam:liked"
+
+
+def modified(meta):
+    return int(meta.get("lastModifiedTimestamp") or 0), int(meta.get("recentTimestamp") or 0)
+
+
+class PlaylistStore:
+    """
+    The index file holds the metadata of all playlists (with the number of
+    tracks of those fetched) and the sync watermark, and every playlist whose
+    tracks were fetched has a <id>.json next to it with the track dicts.
+    """
+
+    # The server does not reliably bump a playlist's timestamps when its
+    # entries change, so cached tracks are refetched after this long anyway
+    max_age = 24 * 3600
+
+    # Timestamps go through mktime in gmusicapi, which is off by an hour
+    # around DST changes, so syncs overlap the previous one by this much
+    sync_overlap = 3600 * 10 ** 6
+
+    def __init__(self, path=PLAYLIST_DIR):
+        self.path = path
+        self.playlists = {}  # id -> metadata
+        self.synced = 0  # newest lastModifiedTimestamp seen, in microseconds
+        self.contents = {}  # id -> {"modified", "fetched", "tracks"}, as loaded
+        self.lock = threading.Lock()
+        self.load()
+
+    @property
+    def index_path(self):
+        return join(self.path, "index.json")
+
+    def contents_path(self, playlist_id):
+        return join(self.path, f"{playlist_id}.json")
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Discarding unreadable playlist file {path}: {e}")
+            return None
+
+    @staticmethod
+    def write(path, data):
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(data, ensure_ascii=False))
+            replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not save {path}: {e}")
+
+    def load(self):
+        index = self.read(self.index_path)
+
+        if not isinstance(index, dict) or index.get("version") != INDEX_VERSION:
+            return
+
+        self.playlists = index.get("playlists", {})
+        self.synced = index.get("synced", 0)
+
+    def save(self):
+        makedirs(self.path, exist_ok=True)
+        self.write(
+            self.index_path,
+            dict(version=INDEX_VERSION, synced=self.synced, playlists=self.playlists),
+        )
+
+    def metadata(self):
+        with self.lock:
+            return [dict(meta) for meta in self.playlists.values()]
+
+    def sync(self, provider):
+        """
+        Merges in the playlists that changed since the last sync, dropping
+        the tracks of changed and deleted ones. Returns metadata().
+        """
+        since = None
+        if self.synced:
+            since = datetime.fromtimestamp(max(0, self.synced - self.sync_overlap) / 10 ** 6)
+
+        changed = provider.playlists(updated_after=since)
+
+        with self.lock:
+            dirty = False
+
+            for meta in changed:
+                id_ = meta.get("id")
+                if id_ is None or meta.get("type") == "SHARED":
+                    continue
+
+                self.synced = max(self.synced, modified(meta)[0])
+                old = self.playlists.get(id_)
+
+                if meta.get("deleted"):
+                    if old is not None:
+                        del self.playlists[id_]
+                        self.forget(id_)
+                        dirty = True
+                elif old is None or modified(old) != modified(meta):
+                    self.playlists[id_] = meta
+                    self.forget(id_)
+                    dirty = True
+
+            if dirty or since is None:
+                self.save()
+
+        logging.info(f"Synced playlists: {len(changed)} changed since {since}")
+        return self.metadata()
+
+    def forget(self, playlist_id):
+        self.contents.pop(playlist_id, None)
+        try:
+            remove(self.contents_path(playlist_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not remove stale playlist tracks: {e}")
+
+    def cached(self, playlist_id):
+        """The stored tracks of the playlist, if they are still current."""
+        meta = self.playlists.get(playlist_id)
+        if meta is None:
+            return None
+
+        contents = self.contents.get(playlist_id)
+        if contents is None:
+            contents = self.read(self.contents_path(playlist_id))
+
+        if (
+            not isinstance(contents, dict)
+            or tuple(contents.get("modified", ())) != modified(meta)
+            or time.time() - contents.get("fetched", 0) > self.max_age
+        ):
+            return None
+
+        self.contents[playlist_id] = contents
+        return contents["tracks"]
+
+    def store(self, playlist_id, entries):
+        meta = self.playlists.get(playlist_id)
+        if meta is None:
+            return
+
+        contents = dict(
+            modified=modified(meta),
+            fetched=time.time(),
+            tracks=[entry["track"] for entry in entries if "track" in entry],
+        )
+        self.contents[playlist_id] = contents
+        meta["size"] = len(contents["tracks"])
+
+        makedirs(self.path, exist_ok=True)
+        self.write(self.contents_path(playlist_id), contents)
+
+    def tracks(self, provider, playlist_id):
+        """The track dicts of the playlist, fetching them if needed."""
+        if playlist_id == LIKED_ID:
+            # Ratings change locally all the time, so this one isn't stored
+            return provider.liked()
+
+        with self.lock:
+            tracks = self.cached(playlist_id)
+            if tracks is not None:
+                return tracks
+
+            token = self.playlists.get(playlist_id, {}).get("shareToken")
+
+        if token:
+            fetched = {playlist_id: provider.playlist_entries(token)}
+        else:
+            # Only the feed of all playlists' entries can tell, so store them all
+            fetched = provider.all_playlist_contents()
+
+        with self.lock:
+            for id_, entries in fetched.items():
+                self.store(id_, entries)
+            self.save()
+
+            contents = self.contents.get(playlist_id)
+            return contents["tracks"] if contents else []
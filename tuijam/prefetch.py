@@ -0,0 +1,176 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from .music_objects import Song, Album, Artist
+
+
+class Prefetcher:
+    """
+    Speculatively fetches the expansion data of the focused search result.
+
+    A fetch only starts once the focus has rested on an item for `dwell`
+    seconds, and at most `max_workers` fetches are in flight at a time, so
+    scrolling quickly through results does not hammer the API. Fetched data
+    is kept for `ttl` seconds, for at most `max_entries` items.
+    """
+
+    def __init__(self, app, dwell=0.4, max_workers=2, max_entries=64, ttl=600):
+        self.app = app
+        self.dwell = dwell
+        self.max_workers = max_workers
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = True
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.results = OrderedDict()  # request -> (time stored, result)
+        self.pending = {}
+        self.alarm = None
+
+    @staticmethod
+    def request_for(obj):
+        if isinstance(obj, Song):
+            return "album", obj.albumId
+        elif isinstance(obj, Album):
+            return "album", obj.id
+        elif isinstance(obj, Artist):
+            return "artist", obj.id
+
+    def fetch(self, request):
+        kind, id_ = request
+
+        if kind == "album":
+            return self.app.gmusic.album_info(id_)
+        elif kind == "artist":
+            return self.app.gmusic.artist_info(id_)
+
+    def focus_changed(self, obj):
+        loop = self.app.loop
+        if loop is None or not self.enabled:
+            return
+
+        if self.alarm is not None:
+            loop.remove_alarm(self.alarm)
+            self.alarm = None
+
+        request = self.request_for(obj)
+        if request is None or request[1] is None:
+            return
+
+        self.alarm = loop.set_alarm_in(self.dwell, self._dwell_elapsed, request)
+
+    def _dwell_elapsed(self, loop, request):
+        self.alarm = None
+
+        with self.lock:
+            if self._cached(request) is not None or request in self.pending:
+                return
+
+            if len(self.pending) >= self.max_workers:
+                return  # busy, this one is not worth queueing up
+
+            self.pending[request] = self.executor.submit(self._prefetch, request)
+
+    def _prefetch(self, request):
+        try:
+            result = self.fetch(request)
+        except Exception as e:
+            logging.warning(f"Prefetch of {request} failed: {e}")
+            result = None
+
+        with self.lock:
+            self.pending.pop(request, None)
+            if result is not None:
+                self._store(request, result)
+
+        return result
+
+    def _store(self, request, result):
+        self.results[request] = (time.monotonic(), result)
+        self.results.move_to_end(request)
+
+        while len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+
+    def _cached(self, request):
+        """The stored result for request, unless it is missing or expired."""
+        entry = self.results.get(request)
+        if entry is None:
+            return None
+
+        stored, result = entry
+        if time.monotonic() - stored > self.ttl:
+            del self.results[request]
+            return None
+
+        self.results.move_to_end(request)
+        return result
+
+    def get(self, kind, id_):
+        """
+        Returns the expansion data for (kind, id_), from the prefetched
+        results if available, otherwise fetching it in the foreground.
+        """
+        request = (kind, id_)
+
+        with self.lock:
+            result = self._cached(request)
+            if result is not None:
+                return result
+
+            future = self.pending.get(request)
+
+        if future is not None:
+            result = future.result()
+            if result is not None:
+                return result
+
+        result = self.fetch(request)
+
+        with self.lock:
+            self._store(request, result)
+
+        return result
+
+    def get_albums(self, album_ids):
+        """
+        The album infos of album_ids, in order, leaving out failed ones.
+        Prefetched albums are used as they are, and the rest is fetched in
+        one batched call.
+        """
+        infos, waiting, missing = {}, {}, []
+
+        with self.lock:
+            for id_ in album_ids:
+                request = ("album", id_)
+                result = self._cached(request)
+                if result is not None:
+                    infos[id_] = result
+                elif request in self.pending:
+                    waiting[id_] = self.pending[request]
+                elif id_ not in missing:
+                    missing.append(id_)
+
+        for id_, future in waiting.items():
+            result = future.result()
+            if result is None:
+                missing.append(id_)
+            else:
+                infos[id_] = result
+
+        if missing:
+            fetched = {info["albumId"]: info for info in self.app.gmusic.albums_info(missing)}
+            infos.update(fetched)
+
+            with self.lock:
+                for id_, info in fetched.items():
+                    self._store(("album", id_), info)
+
+        return [infos[id_] for id_ in album_ids if id_ in infos]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,196 @@
+"""
+On-demand CPU and memory profiling of the running player.
+
+    kill -USR1 <pid>   start a sampling CPU profile of the main loop, or stop
+                       it and write the report
+    kill -USR2 <pid>   start tracing allocations, or stop tracing and write
+                       the top allocators (and the growth since the previous
+                       dump)
+
+Reports are written to PROFILE_DIR. CPU profiles come as a plain text
+summary and as collapsed stacks that flamegraph.pl or speedscope can load.
+"""
+from collections import Counter
+from datetime import datetime
+from os import makedirs
+from os.path import join, basename
+import logging
+import signal
+import sys
+import threading
+import tracemalloc
+
+from tuijam import PROFILE_DIR
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval from a background thread."""
+
+    def __init__(self, thread_id=None, interval=0.005, max_depth=64):
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        self.stacks.clear()
+        self.samples = 0
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="tuijam-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.items())
+
+    def summary(self, top=40):
+        own = Counter()
+        total = Counter()
+
+        for stack, count in self.stacks.items():
+            if stack:
+                own[stack[-1]] += count
+            for func in set(stack):
+                total[func] += count
+
+        samples = max(self.samples, 1)
+        lines = [f"{self.samples} samples every {self.interval * 1000:.1f} ms", ""]
+
+        for title, counter in (("own time", own), ("cumulative time", total)):
+            lines.append(f"top {top} by {title}:")
+            lines.extend(
+                f"{count / samples * 100:6.1f}%  {count:7d}  {func}"
+                for func, count in counter.most_common(top)
+            )
+            lines.append("")
+
+        return "\n".join(lines)
+
+
+class ProfilingHooks:
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self.cpu = SamplingProfiler()
+        self.last_snapshot = None
+
+    def install(self, use_glib=False):
+        """
+        Hooks SIGUSR1/SIGUSR2. Under the GLib event loop the handlers have to
+        be registered with GLib, since Python signal handlers would only run
+        the next time the loop happens to call back into Python.
+        """
+        if use_glib:
+            from gi.repository import GLib
+
+            for signum, handler in ((signal.SIGUSR1, self.toggle_cpu), (signal.SIGUSR2, self.dump_memory)):
+                GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, lambda h=handler: h() or True)
+        else:
+            signal.signal(signal.SIGUSR1, lambda *args: self.toggle_cpu())
+            signal.signal(signal.SIGUSR2, lambda *args: self.dump_memory())
+
+    def report_path(self, kind, ext):
+        makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        return join(self.directory, f"{kind}-{stamp}.{ext}")
+
+    @staticmethod
+    def write_report(path, make_text, background=True):
+        """Formats and writes a report, by default off the UI thread."""
+
+        def write():
+            try:
+                with open(path, "w") as f:
+                    f.write(make_text())
+            except Exception as e:
+                logging.exception(e)
+
+        if background:
+            threading.Thread(target=write, daemon=True).start()
+        else:
+            write()
+
+    def start(self):
+        if not self.cpu.running:
+            self.cpu.start()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+
+    def stop(self):
+        """Writes out whatever is being profiled, e.g. at exit."""
+        if self.cpu.running:
+            self.toggle_cpu(background=False)
+        if tracemalloc.is_tracing():
+            self.dump_memory(background=False)
+
+    def toggle_cpu(self, background=True):
+        if not self.cpu.running:
+            self.cpu.start()
+            logging.info("CPU profiling started")
+            return
+
+        profile, self.cpu = self.cpu, SamplingProfiler(self.cpu.thread_id, self.cpu.interval)
+        profile.stop()
+
+        self.write_report(self.report_path("cpu", "collapsed"), profile.collapsed, background)
+        self.write_report(self.report_path("cpu", "txt"), profile.summary, background)
+        logging.info("CPU profiling stopped")
+
+    def dump_memory(self, top=40, background=True):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            logging.info("allocation tracing started")
+            return
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        previous, self.last_snapshot = self.last_snapshot, snapshot
+
+        # Tracing slows every allocation down, so it only runs between signals
+        tracemalloc.stop()
+        logging.info("allocation tracing stopped")
+
+        def report():
+            lines = [f"traced: {current / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB", ""]
+
+            lines.append(f"top {top} allocators:")
+            lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:top])
+
+            if previous is not None:
+                lines.extend(["", f"top {top} growth since previous dump:"])
+                lines.extend(str(stat) for stat in snapshot.compare_to(previous, "lineno")[:top])
+
+            lines.extend(["", "largest allocation tracebacks:"])
+            for stat in snapshot.statistics("traceback")[:5]:
+                lines.append(f"{stat.count} blocks, {stat.size / 1024:.1f} KiB")
+                lines.extend(stat.traceback.format())
+                lines.append("")
+
+            return "\n".join(lines)
+
+        self.write_report(self.report_path("memory", "txt"), report, background)
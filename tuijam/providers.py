@@ -0,0 +1,292 @@
+"""
+The music sources that App, QueuePanel and RadioStation get their data from.
+
+Each provider wraps one backend client and turns its responses into music
+objects. Next to the single item calls, a provider has batched calls, like
+resolving many track ids or fetching several albums at once, and `submit`,
+which runs any of its calls on the provider's own thread pool and returns a
+Future. How many requests are in flight at a time, and how a batch is split
+up, is thereby decided per backend in one place.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+
+from .metrics import metrics
+from .music_objects import (
+    Song,
+    Album,
+    Artist,
+    Situation,
+    RadioStation,
+    Playlist,
+    YTVideo,
+    LocalTrack,
+)
+
+
+class Provider:
+    """
+    A source of music objects. Subclasses set the object types they play,
+    implement stream_url and search, and size their thread pools.
+
+    Calls made through submit and the fan-out of batched calls use separate
+    pools, so a submitted batch can never wait on a pool it occupies itself.
+    """
+
+    name = None
+    object_types = ()
+    max_workers = 2
+    max_batch_workers = 4
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix=f"tuijam-{self.name}"
+        )
+        self.batch_executor = ThreadPoolExecutor(
+            max_workers=self.max_batch_workers,
+            thread_name_prefix=f"tuijam-{self.name}-batch",
+        )
+
+    def __repr__(self):
+        return f"<{type(self).__name__}>"
+
+    def plays(self, obj):
+        return isinstance(obj, self.object_types)
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) in the background, returning a Future."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def map(self, fn, items):
+        """
+        fn(item) for each of items, run concurrently and returned in order.
+        Items that fail are logged and left out.
+        """
+
+        def call(item):
+            try:
+                return fn(item)
+            except Exception as e:
+                logging.warning(f"{self.name}: {fn.__name__}({item!r}) failed: {e}")
+
+        return [
+            result
+            for result in self.batch_executor.map(call, items)
+            if result is not None
+        ]
+
+    def search(self, query):
+        """The categories (lists of music objects) matching query."""
+        return []
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.batch_executor.shutdown(wait=False)
+
+
+class GoogleMusicProvider(Provider):
+    name = "gmusic"
+    object_types = (Song, Album, Artist, Situation, RadioStation, Playlist)
+    max_workers = 4
+    max_batch_workers = 8
+
+    def __init__(self, api):
+        super().__init__()
+        self.api = api
+
+    def stream_url(self, song):
+        return self.api.get_stream_url(song.id)
+
+    def search(self, query):
+        results = self.api.search(query)
+
+        songs = [Song.from_dict(hit["track"]) for hit in results["song_hits"]]
+        albums = [Album.from_dict(hit["album"]) for hit in results["album_hits"]]
+        artists = [Artist.from_dict(hit["artist"]) for hit in results["artist_hits"]]
+        return [songs, albums, artists]
+
+    def listen_now(self):
+        """
+        The (situations, albums, radio stations) of the listen now page. The
+        requests behind it are made concurrently. Playlists come from a
+        PlaylistStore.
+        """
+        calls = [
+            self.batch_executor.submit(fn)
+            for fn in (self.api.get_listen_now_situations, self.api.get_listen_now_items)
+        ]
+        situations, items = [call.result() for call in calls]
+
+        situations = [Situation.from_dict(hit) for hit in situations]
+        albums = [Album.from_dict(hit["album"]) for hit in items if "album" in hit]
+        radio_stations = [
+            RadioStation.from_dict(hit["radio_station"])
+            for hit in items
+            if "radio_station" in hit
+        ]
+
+        return situations, albums, radio_stations
+
+    def playlists(self, updated_after=None):
+        """The metadata of the playlists changed after updated_after, or of all."""
+        return self.api.get_all_playlists(updated_after=updated_after)
+
+    def playlist_entries(self, share_token):
+        return self.api.get_shared_playlist_contents(share_token)
+
+    def all_playlist_contents(self):
+        """{playlist id: entries} of all the user's playlists."""
+        return {
+            playlist["id"]: playlist["tracks"]
+            for playlist in self.api.get_all_user_playlist_contents()
+        }
+
+    def liked(self):
+        return self.api.get_top_songs()
+
+    def album_info(self, album_id):
+        return self.api.get_album_info(album_id)
+
+    def artist_info(self, artist_id):
+        return self.api.get_artist_info(artist_id)
+
+    def albums_info(self, album_ids):
+        """The album infos of album_ids, in order, leaving out failed ones."""
+        return self.map(self.album_info, album_ids)
+
+    def tracks(self, track_ids):
+        """The songs with the given store ids, in order, leaving out failed ones."""
+        with metrics.timer("gmusic.tracks"):
+            infos = self.map(self.api.get_track_info, track_ids)
+        return [song for song in map(Song.from_dict, infos) if song is not None]
+
+    def create_station(self, title, **seed):
+        return self.api.create_station(title, **seed)
+
+    def station_id(self, obj, cache=None):
+        if isinstance(obj, RadioStation):
+            return obj.get_station_id(self, cache)
+
+        if isinstance(obj, Song):
+            title, seed = obj.title, dict(track_id=obj.id)
+        elif isinstance(obj, Album):
+            title, seed = obj.title, dict(album_id=obj.id)
+        elif isinstance(obj, Artist):
+            title, seed = obj.name, dict(artist_id=obj.id)
+        else:
+            return None
+
+        if cache is None:
+            return self.create_station(title, **seed)
+
+        return cache.get_or_create(self, title, **seed)
+
+    def station_songs(self, station_id, n=50):
+        song_dicts = self.api.get_station_tracks(station_id, num_tracks=n)
+        return [Song.from_dict(song_dict) for song_dict in song_dicts]
+
+    @staticmethod
+    def rating_track(song):
+        if song.type == "library":
+            return {"id": song.id}
+
+        return {"nid": song.id, "trackType": song.trackType}
+
+    def rate(self, songs, rating):
+        """Gives all of songs the same rating in a single request."""
+        if songs:
+            self.api.rate_songs([self.rating_track(song) for song in songs], rating)
+
+    def logout(self):
+        self.api.logout()
+
+
+class YouTubeProvider(Provider):
+    name = "youtube"
+    object_types = (YTVideo,)
+
+    def __init__(self, client=None, stream_url_for=None):
+        super().__init__()
+        self.client = client  # without one (no API key), videos only play
+        # mpv resolves youtu.be links itself (through youtube-dl)
+        self.stream_url_for = stream_url_for or (lambda id_: f"https://youtu.be/{id_}")
+
+    def stream_url(self, video):
+        return self.stream_url_for(video.id)
+
+    def search_videos(
+        self,
+        q,
+        max_results=50,
+        order="relevance",
+        token=None,
+        location=None,
+        location_radius=None,
+    ):
+        """
+        Mostly stolen from: https://github.com/spnichol/youtube_tutorial/blob/master/youtube_videos.py
+        """
+        with metrics.timer("youtube.search"):
+            search_response = (
+                self.client.search()
+                .list(
+                    q=q,
+                    type="video",
+                    pageToken=token,
+                    order=order,
+                    part="id,snippet",
+                    maxResults=max_results,
+                    location=location,
+                    locationRadius=location_radius,
+                )
+                .execute()
+            )
+
+        videos = []
+        for search_result in search_response.get("items", []):
+
+            if search_result["id"]["kind"] == "youtube#video":
+                videos.append(search_result)
+
+        nexttok = search_response.get("nextPageToken", None)
+        return nexttok, videos
+
+    def search(self, query):
+        if self.client is None:
+            return []
+
+        videos = [YTVideo.from_dict(hit) for hit in self.search_videos(query)[1]]
+        return [[video for video in videos if video is not None]]
+
+
+class LocalProvider(Provider):
+    name = "local"
+    object_types = (LocalTrack,)
+    max_workers = 1
+    max_batch_workers = 1
+
+    def __init__(self, library):
+        super().__init__()
+        self.library = library
+
+    def submit(self, fn, *args, **kwargs):
+        # The library is in memory, a thread would only add latency
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def stream_url(self, track):
+        return track.path
+
+    def search(self, query):
+        return [self.library.search(query)]
+
+    def album_tracks(self, track):
+        return self.library.album_tracks(track) or [track]
+
+    def shutdown(self):
+        super().shutdown()
+        self.library.shutdown()
@@ -0,0 +1,186 @@
+"""
+Optimistic, batched song ratings.
+
+A rating shows up on the song right away and is sent in the background. The
+changes made within `delay` seconds of each other are sent together, one
+rate_songs request per rating value, and changing the rating of a song that
+wasn't sent yet just replaces it. Unsent ratings are kept in RATINGS_FILE, so
+they survive a restart, and a rating the server refuses is rolled back.
+"""
+from collections import OrderedDict
+from os import replace
+import json
+import logging
+
+from tuijam import RATINGS_FILE
+from .metrics import metrics
+from .music_objects import serialize, deserialize
+
+FILE_VERSION = 1
+
+
+class RatingQueue:
+    def __init__(self, app, path=RATINGS_FILE, delay=1.0, max_batch=100):
+        self.app = app
+        self.path = path
+        self.delay = delay
+        self.max_batch = max_batch
+
+        self.pending = OrderedDict()  # song id -> {"song", "rating", "previous"}
+        self.sending = {}  # the same, for the ratings of the request in flight
+        self.alarm = None
+
+    def __len__(self):
+        return len(self.pending) + len(self.sending)
+
+    def start(self):
+        """Picks up the ratings left unsent last time and sends them."""
+        self.load()
+        if self.pending:
+            self.schedule(0)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Discarding unreadable pending ratings: {e}")
+            return
+
+        if data.get("version") != FILE_VERSION:
+            return
+
+        entries = data.get("entries", [])
+        songs = deserialize(json.dumps([entry["song"] for entry in entries]))
+
+        for song, entry in zip(songs, entries):
+            self.pending[song.id] = dict(
+                song=song, rating=entry["rating"], previous=entry["previous"]
+            )
+
+        logging.info(f"Restored {len(self.pending)} unsent ratings")
+
+    def save(self):
+        # A newer rating of the same song comes later, and wins on load
+        entries = [
+            entry for key, entry in self.sending.items() if key not in self.pending
+        ] + list(self.pending.values())
+        songs = json.loads(serialize([entry["song"] for entry in entries]))
+
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(
+                    json.dumps(
+                        dict(
+                            version=FILE_VERSION,
+                            entries=[
+                                dict(song=song, rating=entry["rating"], previous=entry["previous"])
+                                for song, entry in zip(songs, entries)
+                            ],
+                        )
+                    )
+                )
+            replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save pending ratings: {e}")
+
+    @staticmethod
+    def show(song, rating):
+        song.rating = rating
+        song.invalidate_ui()
+
+    def rate(self, song, rating):
+        """Rates song now, and sends the rating with the next batch."""
+        entry = self.pending.get(song.id)
+        previous = entry["previous"] if entry else song.rating
+        self.show(song, rating)
+
+        if rating == previous:
+            # Changed back before it was sent, so there is nothing to send
+            self.pending.pop(song.id, None)
+        else:
+            self.pending[song.id] = dict(song=song, rating=rating, previous=previous)
+
+        # The file is written with the flush too, once per burst of ratings
+        self.schedule(self.delay)
+
+    def schedule(self, delay):
+        """(Re)starts the countdown to the next flush, so a burst of ratings goes out together."""
+        loop = self.app.loop
+        if loop is None:
+            return
+
+        if self.alarm is not None:
+            loop.remove_alarm(self.alarm)
+        self.alarm = loop.set_alarm_in(delay, self.flush)
+
+    def flush(self, *args):
+        self.alarm = None
+        self.save()
+
+        # One request at a time, so a song's ratings reach the server in order
+        if self.sending or not self.pending:
+            return
+
+        provider = self.app.gmusic
+        if provider is None:
+            # Not logged in yet, try again later
+            self.schedule(self.delay)
+            return
+
+        self.sending, self.pending = self.pending, OrderedDict()
+
+        batches = {}
+        for entry in self.sending.values():
+            batches.setdefault(entry["rating"], []).append(entry)
+
+        provider.submit(self.send, provider, list(batches.items()))
+
+    def send(self, provider, batches):
+        """Runs on the provider's thread pool."""
+        sent, failed = [], []
+
+        for rating, entries in batches:
+            for start in range(0, len(entries), self.max_batch):
+                batch = entries[start : start + self.max_batch]
+                try:
+                    with metrics.timer("ratings.send"):
+                        provider.rate([entry["song"] for entry in batch], rating)
+                    sent.extend(batch)
+                except Exception as e:
+                    logging.warning(f"Could not rate {len(batch)} songs {rating}: {e}")
+                    failed.extend(batch)
+
+        metrics.count("ratings.sent", len(sent))
+        self.app.call_in_main(self.sent, failed)
+
+    def sent(self, failed):
+        self.sending = {}
+
+        for entry in failed:
+            song = entry["song"]
+            newer = self.pending.get(song.id)
+
+            if newer is not None:
+                # The server still has the rating from before the failed one
+                newer["previous"] = entry["previous"]
+                if newer["rating"] == newer["previous"]:
+                    del self.pending[song.id]
+            elif song.rating == entry["rating"]:
+                self.show(song, entry["previous"])
+
+        if failed:
+            metrics.count("ratings.rolled_back", len(failed))
+            self.app.playbar.update()
+
+        self.save()
+
+        if self.pending:
+            self.schedule(self.delay)
+
+    def shutdown(self):
+        # Whatever is unsent is in the file already and goes out next time
+        self.save()
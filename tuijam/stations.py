@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import time
+
+from tuijam import STATION_CACHE_FILE
+
+
+class StationCache:
+    """
+    Persistent mapping from a radio seed (curated station, artist, album or
+    track) to the id of the station that was created for it. Reusing the id
+    avoids a create_station round trip and keeps duplicate stations from
+    piling up on the account.
+    """
+
+    SEED_KINDS = (
+        ("curated", "curated_station_id"),
+        ("artist", "artist_id"),
+        ("album", "album_id"),
+        ("track", "track_id"),
+    )
+
+    def __init__(self, path=STATION_CACHE_FILE, max_age=30 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self.stations = {}
+        self.load()
+
+    @classmethod
+    def seed_key(cls, **seed):
+        for kind, arg in cls.SEED_KINDS:
+            if seed.get(arg):
+                return f"{kind}:{seed[arg]}"
+
+    def is_valid(self, entry, now=None):
+        now = time.time() if now is None else now
+
+        try:
+            station_id = entry["id"]
+            created = float(entry["created"])
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        return (
+            isinstance(station_id, str)
+            and bool(station_id)
+            and 0 <= now - created < self.max_age
+        )
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                stations = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Discarding unreadable station cache: {e}")
+            return
+
+        if not isinstance(stations, dict):
+            return
+
+        now = time.time()
+        self.stations = {
+            key: entry for key, entry in stations.items() if self.is_valid(entry, now)
+        }
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.stations, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save station cache: {e}")
+
+    def get(self, key):
+        entry = self.stations.get(key)
+
+        if entry is None:
+            return None
+
+        if not self.is_valid(entry):
+            del self.stations[key]
+            return None
+
+        return entry["id"]
+
+    def put(self, key, station_id):
+        if not isinstance(station_id, str) or not station_id:
+            return
+
+        self.stations[key] = {"id": station_id, "created": time.time()}
+        self.save()
+
+    def invalidate(self, station_id):
+        stale = [key for key, entry in self.stations.items() if entry.get("id") == station_id]
+
+        for key in stale:
+            del self.stations[key]
+
+        if stale:
+            self.save()
+
+    def get_or_create(self, api, title, **seed):
+        key = self.seed_key(**seed)
+        station_id = self.get(key) if key else None
+
+        if station_id is None:
+            station_id = api.create_station(title, **seed)
+            if key:
+                self.put(key, station_id)
+
+        return station_id
@@ -0,0 +1,134 @@
+"""
+Seeded generator of synthetic Google Music and YouTube payloads.
+
+The dicts produced here have the same shape as the responses of the real
+APIs, so they can be fed through the from_dict constructors, the offline
+backend and the benchmarks without any network access.
+"""
+import random
+
+WORDS = (
+    "love night blue fire heart dream light summer rain road home city gold "
+    "wild river moon shadow echo glass ocean stone winter star velvet electric "
+    "東京 夜 光 사랑 하늘 ночь любовь café señor naïve"
+).split()
+
+
+class Catalog:
+    """
+    A coherent, deterministic catalog of artists, albums, tracks, playlists,
+    listen-now situations and YouTube videos.
+    """
+
+    def __init__(
+        self,
+        seed=0,
+        n_artists=50,
+        albums_per_artist=4,
+        tracks_per_album=12,
+        n_playlists=20,
+        playlist_size=50,
+        n_videos=200,
+    ):
+        self.rng = random.Random(seed)
+
+        self.artists = [self.make_artist(i) for i in range(n_artists)]
+        self.albums = [
+            self.make_album(artist, j, tracks_per_album)
+            for artist in self.artists
+            for j in range(albums_per_artist)
+        ]
+        self.tracks = [track for album in self.albums for track in album["tracks"]]
+        self.playlists = [self.make_playlist(i, playlist_size) for i in range(n_playlists)]
+        self.situations = [self.make_situation(i) for i in range(4)]
+        self.videos = [self.make_video(i) for i in range(n_videos)]
+
+        self.artists_by_id = {artist["artistId"]: artist for artist in self.artists}
+        self.albums_by_id = {album["albumId"]: album for album in self.albums}
+        self.tracks_by_id = {track["storeId"]: track for track in self.tracks}
+
+    def words(self, lo=1, hi=4):
+        return " ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(lo, hi)))
+
+    def make_id(self, prefix):
+        return prefix + "".join(self.rng.choice("abcdefghijklmnopqrstuvwxyz234567") for _ in range(26))
+
+    def make_artist(self, i):
+        return {"name": self.words(1, 3).title(), "artistId": self.make_id("A")}
+
+    def make_album(self, artist, i, n_tracks):
+        album = {
+            "name": self.words(1, 4).title(),
+            "albumArtist": artist["name"],
+            "artistId": [artist["artistId"]],
+            "year": self.rng.randint(1960, 2020),
+            "albumId": self.make_id("B"),
+            "albumArtRef": f"https://art.example/{artist['artistId']}/{i}.jpg",
+        }
+        album["tracks"] = [self.make_track(album, artist, n) for n in range(n_tracks)]
+        return album
+
+    def make_track(self, album, artist, n):
+        return {
+            "title": self.words(1, 5).title(),
+            "album": album["name"],
+            "albumId": album["albumId"],
+            "albumArtRef": [{"url": album["albumArtRef"]}],
+            "artist": artist["name"],
+            "artistId": [artist["artistId"]],
+            "storeId": self.make_id("T"),
+            "nid": None,
+            "trackType": "7",
+            "trackNumber": n + 1,
+            "durationMillis": str(self.rng.randint(90, 420) * 1000),
+            "rating": self.rng.choice(("0", "0", "0", "1", "5")),
+        }
+
+    def make_playlist(self, i, size):
+        tracks = self.rng.sample(self.tracks, min(size, len(self.tracks)))
+        id_ = self.make_id("P")
+        return {
+            "name": self.words(1, 3).title(),
+            "id": id_,
+            "shareToken": "AM" + id_,
+            "type": "USER_GENERATED",
+            "lastModifiedTimestamp": str(1500000000000000 + i),
+            "tracks": [
+                {"id": self.make_id("E"), "trackId": track["storeId"], "track": track}
+                for track in tracks
+            ],
+        }
+
+    def make_situation(self, i):
+        def stations(n):
+            return [
+                {"name": self.words().title(), "seed": {"curatedStationId": self.make_id("L")}}
+                for _ in range(n)
+            ]
+
+        return {
+            "title": self.words().title(),
+            "description": self.words(4, 10),
+            "id": self.make_id("S"),
+            "situations": [
+                {"title": self.words(), "stations": stations(4)} for _ in range(3)
+            ],
+        }
+
+    def make_video(self, i):
+        video_id = self.make_id("")[:11]
+        return {
+            "id": {"kind": "youtube#video", "videoId": video_id},
+            "snippet": {
+                "title": self.words(2, 8).title(),
+                "channelTitle": self.words(1, 2).title(),
+                "thumbnails": {"medium": {"url": f"https://i.ytimg.example/{video_id}.jpg"}},
+            },
+        }
+
+
+def track_dicts(n, seed=0):
+    """n track dicts, from a catalog just large enough to hold them."""
+    n_artists = max(1, -(-n // 48))
+    catalog = Catalog(seed, n_artists=n_artists, n_playlists=0, n_videos=0)
+    return catalog.tracks[:n]
@@ -0,0 +1,191 @@
+"""
+An incrementally maintained word index over music objects, for filtering the
+queue and the play history as the user types.
+"""
+from bisect import bisect_left
+from collections import Counter
+from functools import lru_cache
+import re
+import unicodedata
+
+FIELDS = ("title", "artist", "album", "channel", "name")
+WORD = re.compile(r"\w+")
+
+
+def normalize(text):
+    """Case-folds text and strips accents, so "Beyoncé" matches "beyonce"."""
+    if text.isascii():
+        return text.lower()
+
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+# Artists and albums repeat a lot across a queue
+@lru_cache(maxsize=16384)
+def words(text):
+    return tuple(WORD.findall(normalize(text)))
+
+
+def object_words(obj):
+    found = set()
+
+    for field in FIELDS:
+        value = getattr(obj, field, None)
+        if isinstance(value, str):
+            found.update(words(value))
+
+    return found
+
+
+class TokenIndex:
+    """
+    Maps the words of each indexed object's title, artist, album (etc.) to
+    the objects, with a sorted vocabulary so a prefix lookup is a bisection.
+    Objects are tracked by identity and counted, since the same object can
+    be queued more than once.
+
+    Removals and the sorting of new words are applied lazily, on the next
+    search, so moving songs around the queue (a removal and an insertion of
+    the same objects) or queueing them one by one costs next to nothing.
+
+    The queue_* methods let it listen to a QueuePanel; `items` is called to
+    re-index everything when the queue is reset.
+    """
+
+    def __init__(self, items=None):
+        self.items = items
+        self.postings = {}  # word -> set of id(obj)
+        self.vocabulary = []  # words, sorted unless new ones were added since
+        self.vocabulary_sorted = True
+        self.counts = Counter()  # id(obj) -> how many times it is indexed
+        self.words = {}  # id(obj) -> its words
+        self.removed = {}  # id(obj) -> [obj, count] of pending removals
+
+    def __len__(self):
+        self.flush()
+        return len(self.counts)
+
+    def add(self, objs):
+        new_words = set()
+
+        for obj in objs:
+            key = id(obj)
+
+            pending = self.removed.get(key)
+            if pending is not None:
+                pending[1] -= 1
+                if not pending[1]:
+                    del self.removed[key]
+                continue
+
+            self.counts[key] += 1
+            if self.counts[key] > 1:
+                continue
+
+            obj_words = self.words[key] = object_words(obj)
+            for word in obj_words:
+                posting = self.postings.get(word)
+                if posting is None:
+                    posting = self.postings[word] = set()
+                    new_words.add(word)
+                posting.add(key)
+
+        if new_words:
+            self.vocabulary.extend(new_words)
+            self.vocabulary_sorted = False
+
+    def remove(self, objs):
+        for obj in objs:
+            key = id(obj)
+            if key in self.counts:
+                self.removed.setdefault(key, [obj, 0])[1] += 1
+
+    def flush(self):
+        """Applies the pending removals and sorts the vocabulary."""
+        if not self.vocabulary_sorted:
+            self.vocabulary.sort()
+            self.vocabulary_sorted = True
+
+        if not self.removed:
+            return
+
+        dead_words = set()
+
+        for key, (obj, count) in self.removed.items():
+            self.counts[key] -= count
+            if self.counts[key] > 0:
+                continue
+
+            del self.counts[key]
+            for word in self.words.pop(key):
+                posting = self.postings[word]
+                posting.discard(key)
+                if not posting:
+                    del self.postings[word]
+                    dead_words.add(word)
+
+        self.removed.clear()
+        if dead_words:
+            self.vocabulary = [word for word in self.vocabulary if word not in dead_words]
+
+    def reset(self, objs=()):
+        objs = list(objs)
+        self.flush()
+
+        # Reordering, like a shuffle, needs no re-indexing
+        if Counter(map(id, objs)) == self.counts:
+            return
+
+        self.postings.clear()
+        self.vocabulary = []
+        self.vocabulary_sorted = True
+        self.counts.clear()
+        self.words.clear()
+        self.add(objs)
+
+    def prefixed(self, prefix):
+        """The ids of all objects with a word starting with prefix. Needs a flush first."""
+        matches = set()
+        pos = bisect_left(self.vocabulary, prefix)
+
+        while pos < len(self.vocabulary) and self.vocabulary[pos].startswith(prefix):
+            matches.update(self.postings[self.vocabulary[pos]])
+            pos += 1
+
+        return matches
+
+    def search(self, pattern):
+        """
+        The ids of the objects matching every word of pattern, each word as a
+        prefix of one of theirs. Returns None for an empty pattern.
+        """
+        self.flush()
+        matches = None
+
+        # Look up the longest (most selective) words first
+        for word in sorted(words(pattern), key=len, reverse=True):
+            found = self.prefixed(word)
+            matches = found if matches is None else matches & found
+            if not matches:
+                break
+
+        return matches
+
+    def filter(self, objs, pattern):
+        """The objects in objs that match pattern, in order, with their positions."""
+        matches = self.search(pattern)
+
+        if matches is None:
+            return list(enumerate(objs))
+
+        return [(pos, obj) for pos, obj in enumerate(objs) if id(obj) in matches]
+
+    def queue_inserted(self, idx, songs):
+        self.add(songs)
+
+    def queue_removed(self, idx, songs):
+        self.remove(songs)
+
+    def queue_reset(self):
+        self.reset(self.items() if self.items else ())
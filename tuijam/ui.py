@@ -1,6 +1,10 @@
+from bisect import bisect_left
+from collections import deque, Counter
+
 import urwid
 
 from tuijam import _
+from .metrics import metrics
 from .music_objects import (
     Song,
     Artist,
@@ -9,7 +13,9 @@ from .music_objects import (
     Situation,
     RadioStation,
     Playlist,
+    LocalTrack,
 )
+from .text_index import TokenIndex
 from .utility import sec_to_min_sec
 
 WELCOME = """
@@ -54,6 +60,9 @@ controls = dict(
     to_top=["U", "ctrl up"],
     to_bottom=["D", "ctrl down"],
     remove=["delete", "x"],
+    mark="m",
+    filter="f",
+    remove_duplicates="X",
     play_pause=" ",
     # search and queue panel
     down="j",
@@ -79,16 +88,336 @@ controls = dict(
     g_rate_bad="ctrl d",
     g_clear_queue="ctrl w",
     g_queue_all="ctrl q",
+    g_stats="ctrl t",
+)
+
+# What the palette and controls of the config file are applied over
+DEFAULT_PALETTE = dict(palette)
+DEFAULT_CONTROLS = dict(controls)
+
+# The actions of each context, in order of precedence for a key bound to
+# several. The app's contexts see a key first, then the focused panel does.
+CONTEXTS = dict(
+    focus=("g_focus_next", "g_focus_prev"),
+    # Not while the search input has focus
+    playback=(
+        "g_play_pause",
+        "g_stop",
+        "g_play_next",
+        "g_play_previous",
+        "g_recent",
+        "g_shuffle",
+        "g_rate_good",
+        "g_rate_bad",
+        "g_clear_queue",
+        "g_queue_all",
+        "g_stats",
+    ),
+    panels=("seek_pos", "seek_neg", "vol_down", "vol_up", "focus_search"),
+    search=("queue", "queue_next", "expand", "expand_full", "back", "radio", "filter", "down", "up"),
+    queue=(
+        "mark",
+        "filter",
+        "remove_duplicates",
+        "swap_up",
+        "swap_down",
+        "to_top",
+        "to_bottom",
+        "remove",
+        "down",
+        "up",
+        "expand",
+        "play_pause",
+    ),
 )
+APP_CONTEXTS = ("focus", "playback", "panels")
+PANEL_CONTEXTS = ("search", "queue")
+NAVIGATION = dict(up=-1, down=1)  # actions that move a panel's focus, by rows
+
+bindings = {}  # context -> {key: action}, compiled from controls
+bindings_generation = 0
+
+
+def bound_keys(action):
+    keys = controls.get(action, ())
+    return [keys] if isinstance(keys, str) else keys
+
+
+def compile_bindings():
+    """
+    Compiles controls into bindings. Returns the keys bound to more than one
+    action that can be reached at the same time, as (key, actions) pairs.
+    """
+    global bindings_generation
+
+    for context, actions in CONTEXTS.items():
+        table = {}
+        for action in actions:
+            for key in bound_keys(action):
+                table.setdefault(key, action)
+        bindings[context] = table
+
+    bindings_generation += 1
+
+    conflicts = {}
+    for panel in PANEL_CONTEXTS:
+        bound = {}
+        for context in APP_CONTEXTS + (panel,):
+            for action in CONTEXTS[context]:
+                for key in bound_keys(action):
+                    bound.setdefault(key, set()).add(action)
+
+        for key, actions in bound.items():
+            if len(actions) > 1:
+                conflicts.setdefault(key, set()).update(actions)
+
+    return sorted((key, sorted(actions)) for key, actions in conflicts.items())
+
+
+compile_bindings()
+
+
+class KeyDispatch:
+    """
+    A context's keys mapped straight to handlers, given per action. The
+    table is rebuilt on first use after controls are recompiled.
+    """
+
+    def __init__(self, context, handlers):
+        self.context = context
+        self.handlers = handlers
+        self.table = {}
+        self.generation = None
+
+    def get(self, key):
+        if self.generation != bindings_generation:
+            self.table = {
+                key: self.handlers[action] for key, action in bindings[self.context].items()
+            }
+            self.generation = bindings_generation
+
+        return self.table.get(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class MainLoop(urwid.MainLoop):
+    def draw_screen(self):
+        with metrics.timer("ui.draw_screen"):
+            super().draw_screen()
+
+    def process_input(self, keys):
+        """
+        Input that only moves the focused panel's focus, like a held j or a
+        spun mouse wheel, is applied as one move per run of keys going the
+        same way, rather than row by row. A change of direction starts a new
+        run, since the edges of a list stop the focus: up up down from the
+        first row ends on the second, not the first.
+        """
+        focus_step = getattr(self.widget, "focus_step", None)
+        if focus_step is None or len(keys) < 2:
+            return super().process_input(keys)
+
+        handled = False
+        run, steps = [], 0
+
+        for key in keys:
+            step = focus_step(key)
+            if step is not None and (not run or (step > 0) == (steps > 0)):
+                run.append(key)
+                steps += step
+                continue
+
+            handled |= self.process_run(run, steps)
+            run, steps = [], 0
+
+            if step is not None:
+                run.append(key)
+                steps += step
+                continue
+
+            handled |= super().process_input([key])
+            if key == "window resize":
+                self.screen_size = None
+
+        return self.process_run(run, steps) or handled
+
+    def process_run(self, run, steps):
+        if len(run) < 2:
+            return super().process_input(run) if run else False
+
+        if not self.screen_size:
+            self.screen_size = self.screen.get_cols_rows()
+
+        metrics.count("input.coalesced", len(run) - 1)
+        self.widget.move_focus(self.screen_size, steps)
+        return True
+
+
+def snap_focus(rows, offset, maxrow, coming_from):
+    """
+    The offset ListBox.change_focus settles a selectable focus of the given
+    rows at, when it is asked to put it at offset.
+    """
+    snap_rows = maxrow - 1
+    align_bottom = maxrow - rows
+
+    if coming_from == "above" and offset > align_bottom:
+        if snap_rows >= offset - align_bottom:
+            return align_bottom
+        if snap_rows >= offset:
+            return 0
+        return offset - snap_rows
+
+    if coming_from == "below" and offset < 0:
+        if snap_rows >= -offset:
+            return 0
+        if snap_rows >= align_bottom - offset:
+            return align_bottom
+        return offset + snap_rows
+
+    return offset
+
+
+def move_list_focus(listbox, size, n):
+    """
+    Moves the focus of listbox as n presses of down (up, for a negative n)
+    would, in one go. Each press follows ListBox: it focuses the next
+    selectable row in view, or else scrolls one row, which at the edge of
+    the view may only bring a heading into view and leave the focus be.
+    """
+    maxcol, maxrow = size
+    walker = listbox.body
+    middle, _, _ = listbox.calculate_visible(size, focus=True)
+    if middle is None or not n:
+        return
+
+    offset, _, position, _, _ = middle
+    heights = {}
+
+    def rows(pos):
+        if pos not in heights:
+            heights[pos] = walker[pos].rows((maxcol,))
+        return heights[pos]
+
+    def selectable(pos):
+        return rows(pos) and walker[pos].selectable()
+
+    def down(pos, offset):
+        row_offset = offset + rows(pos)
+        last, last_rows = None, rows(pos)
+
+        # a selectable row already in view below the focus
+        below = pos + 1
+        while below < len(walker) and row_offset < maxrow:
+            last, last_rows = below, rows(below)
+            if selectable(below):
+                return below, snap_focus(last_rows, row_offset, maxrow, "above")
+            row_offset += last_rows
+            below += 1
+
+        # otherwise scroll a row, to a selectable row if that brings one in
+        row_offset -= 1
+        while row_offset < maxrow:
+            if below >= len(walker):
+                return None
+            last, last_rows = below, rows(below)
+            if selectable(below):
+                return below, snap_focus(last_rows, row_offset, maxrow, "above")
+            row_offset += last_rows
+            below += 1
+
+        if not selectable(pos) or offset + rows(pos) - 1 <= 0:
+            return (pos if last is None else last), row_offset - last_rows
+        return pos, offset - 1
+
+    def up(pos, offset):
+        row_offset = offset
+        last = None
+
+        above = pos - 1
+        while above >= 0 and row_offset > 0:
+            last = above
+            row_offset -= rows(above)
+            if selectable(above):
+                return above, snap_focus(rows(above), row_offset, maxrow, "below")
+            above -= 1
+
+        row_offset += 1
+        while row_offset > 0:
+            if above < 0:
+                return None
+            last = above
+            row_offset -= rows(above)
+            if selectable(above):
+                return above, snap_focus(rows(above), row_offset, maxrow, "below")
+            above -= 1
+
+        if not selectable(pos) or offset + 1 >= maxrow:
+            return (pos if last is None else last), row_offset
+        return pos, offset + 1
+
+    press = down if n > 0 else up
+    for _ in range(abs(n)):
+        moved = press(position, offset)
+        if moved is None:
+            break
+        position, offset = moved
+
+    listbox.change_focus(
+        size, position, offset_inset=offset, coming_from="above" if n > 0 else "below"
+    )
 
 
 class SearchInput(urwid.Edit):
     def __init__(self, app):
         self.app = app
+        self.filter_target = None
+        self.filter_return_focus = None
         super().__init__(_("search > "), multiline=False, allow_tab=False)
 
+    def start_filter(self, target):
+        """
+        Makes the input filter target, a panel with set_filter(pattern),
+        move_filter_focus(delta) and end_filter(accept), until enter accepts
+        the focused match or esc cancels.
+        """
+        self.filter_target = target
+        self.filter_return_focus = self.app.focus
+        self.set_caption(_("filter > "))
+        self.set_edit_text("")
+
+        if self.app.vim_mode:
+            self.app.vim_insert = True
+        self.app.set_focus(self)
+
+    def end_filter(self, accept, refocus=True):
+        target, self.filter_target = self.filter_target, None
+        if target is None:
+            return
+
+        self.set_caption(_("search > "))
+        self.set_edit_text("")
+        target.end_filter(accept)
+
+        if refocus:
+            if self.app.vim_mode:
+                self.app.vim_insert = False
+            self.app.set_focus(self.filter_return_focus)
+
     def keypress(self, size, key):
-        if key == "enter":
+        if self.filter_target is not None:
+            if key in ("enter", "esc"):
+                self.end_filter(accept=key == "enter")
+            elif key in ("up", "down"):
+                self.filter_target.move_filter_focus(-1 if key == "up" else 1)
+            else:
+                key = super().keypress((size[0],), key)
+                self.filter_target.set_filter(self.edit_text)
+                return key
+
+        elif key == "enter":
             txt = self.edit_text
             if txt:
                 self.set_edit_text("")
@@ -100,6 +429,73 @@ class SearchInput(urwid.Edit):
             return super().keypress(size, key)
 
 
+class SearchHistory:
+    """
+    The back-stack of SearchPanel, bounded by depth and by an estimate of its
+    memory use, evicting the oldest entries first. The `keep_rendered` most
+    recent entries keep their row widgets so going back to them is instant;
+    older ones keep only their results and are rendered again when needed.
+    """
+
+    # Rough per-row costs, measured on typical search results
+    OBJECT_BYTES = 1024
+    ROW_BYTES = 4096
+
+    class Entry:
+        def __init__(self, focus, search_results, rows):
+            self.focus = focus
+            self.search_results = search_results
+            self.rows = rows
+            self.n_objects = sum(len(category) for category in search_results)
+
+        def size(self):
+            per_row = SearchHistory.OBJECT_BYTES
+            if self.rows is not None:
+                per_row += SearchHistory.ROW_BYTES
+            return self.n_objects * per_row
+
+    def __init__(self, max_depth=50, max_bytes=32 * 2 ** 20, keep_rendered=3):
+        self.entries = deque()
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.keep_rendered = keep_rendered
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def push(self, focus, search_results, rows):
+        entry = self.Entry(focus, search_results, rows)
+        self.entries.append(entry)
+        self.size += entry.size()
+
+        if len(self.entries) > self.keep_rendered:
+            self.unrender(self.entries[-self.keep_rendered - 1])
+
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.max_depth or self.size > self.max_bytes
+        ):
+            self.size -= self.entries.popleft().size()
+
+    def pop(self):
+        entry = self.entries.pop()
+        self.size -= entry.size()
+        return entry
+
+    def unrender(self, entry):
+        if entry.rows is not None:
+            self.size -= entry.size()
+            entry.rows = None
+            self.size += entry.size()
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
 class SearchPanel(urwid.ListBox):
     class SearchResults:
         def __init__(self, categories):
@@ -110,6 +506,7 @@ class SearchPanel(urwid.ListBox):
             self.radio_stations = []
             self.playlists = []
             self.yt_vids = []
+            self.local_tracks = []
             for category in categories:
                 if not category:
                     continue
@@ -127,11 +524,14 @@ class SearchPanel(urwid.ListBox):
                     self.playlists = category
                 elif isinstance(category[0], YTVideo):
                     self.yt_vids = category
+                elif isinstance(category[0], LocalTrack):
+                    self.local_tracks = category
 
         def __iter__(self):
             yield self.artists
             yield self.albums
             yield self.songs
+            yield self.local_tracks
             yield self.situations
             yield self.radio_stations
             yield self.playlists
@@ -140,70 +540,105 @@ class SearchPanel(urwid.ListBox):
     def __init__(self, app):
         self.app = app
         self.walker = urwid.SimpleFocusListWalker([])
-        self.search_history = []
+        self.search_history = SearchHistory()
         self.search_results = self.SearchResults([])
         self.line_box = None
         self.viewing_previous_songs = False
         self.no_limit = False
+        self.last_focus = None
+        self.filter_restore = None
+        self.keys = KeyDispatch(
+            "search",
+            dict(
+                queue=lambda size, key: self.queue_selected(),
+                queue_next=lambda size, key: self.queue_selected(to_front=True),
+                expand=lambda size, key: self.expand_selected(),
+                expand_full=lambda size, key: self.expand_selected(no_limit=True),
+                back=lambda size, key: self.back(),
+                radio=lambda size, key: self.radio_selected(),
+                filter=self.filter_keypress,
+                down=lambda size, key: self.navigate(size, key, "down"),
+                up=lambda size, key: self.navigate(size, key, "up"),
+            ),
+        )
 
         super().__init__(self.walker)
 
         self.walker.append(urwid.Text(WELCOME, align="center"))
+        urwid.connect_signal(self.walker, "modified", self.walker_modified)
+
+    def walker_modified(self):
+        focus = (self.walker.get_focus()[1], id(self.search_results))
+
+        if focus != self.last_focus:
+            self.last_focus = focus
+            self.app.prefetcher.focus_changed(self.selected_search_obj())
 
     def keypress(self, size, key):
-        if key in controls["queue"] or key in controls["queue_next"]:
+        handler = self.keys.get(key)
 
-            add_to_front = key in controls["queue_next"]
-            selected = self.selected_search_obj()
+        if handler is not None:
+            handler(size, key)
+        else:
+            super().keypress(size, key)
 
-            if not selected:
-                return
+    def navigate(self, size, key, direction):
+        self.app.hold(key, self, size)
+        super().keypress(size, direction)
 
-            if isinstance(selected, (Song, YTVideo)):
-                self.app.queue_panel.add_song_to_queue(selected, add_to_front)
-            elif type(selected) == Album:
-                self.app.queue_panel.add_album_to_queue(selected, add_to_front)
-            elif type(selected) == RadioStation:
-                radio_song_list = self.app.get_radio_songs(
-                    selected.get_station_id(self.app.g_api)
-                )
+    def move_focus(self, size, n):
+        move_list_focus(self, size, n)
+
+    def queue_selected(self, to_front=False):
+        selected = self.selected_search_obj()
+
+        if not selected:
+            return
 
-                if add_to_front:
-                    radio_song_list = reversed(radio_song_list)
-
-                for song in radio_song_list:
-                    self.app.queue_panel.add_song_to_queue(song, add_to_front)
-            elif type(selected) == Playlist:
-                self.app.queue_panel.add_songs_to_queue(selected.songs, add_to_front)
-
-        elif key in controls["expand"]:
-            if self.selected_search_obj() is not None:
-                self.app.expand(self.selected_search_obj())
-        elif key in controls["expand_full"]:
-            if self.selected_search_obj() is not None:
-                self.app.expand(self.selected_search_obj(),no_limit=True)
-        elif key in controls["back"]:
-            self.back()
-        elif key in controls["radio"]:
-            if self.selected_search_obj() is not None:
-                self.app.create_radio_station(self.selected_search_obj())
-        elif key in controls["down"]:
-            super().keypress(size, "down")
-        elif key in controls["up"]:
-            super().keypress(size, "up")
+        if isinstance(selected, (Song, YTVideo, LocalTrack)):
+            self.app.queue_panel.add_song_to_queue(selected, to_front)
+        elif type(selected) == Album:
+            self.app.queue_panel.add_album_to_queue(selected, to_front)
+        elif type(selected) == RadioStation:
+            radio_song_list = self.app.get_radio_songs(
+                self.app.get_station_id(selected)
+            )
+            self.app.queue_panel.add_songs_to_queue(radio_song_list, to_front)
+        elif type(selected) == Playlist:
+            self.app.queue_panel.add_songs_to_queue(
+                self.app.playlist_songs(selected), to_front
+            )
+
+    def expand_selected(self, no_limit=False):
+        if self.selected_search_obj() is not None:
+            self.app.expand(self.selected_search_obj(), no_limit=no_limit)
+
+    def radio_selected(self):
+        if self.selected_search_obj() is not None:
+            self.app.create_radio_station(self.selected_search_obj())
+
+    def filter_keypress(self, size, key):
+        if self.viewing_previous_songs:
+            self.app.search_input.start_filter(self)
         else:
             super().keypress(size, key)
 
     def back(self):
         if self.search_history:
-            prev_focus, search_history = self.search_history.pop()
+            entry = self.search_history.pop()
 
-            self.set_search_results(list(search_history))
+            # The stored results are already filtered, only re-render them
+            self.search_results = entry.search_results
+            rows = entry.rows
+            if rows is None:
+                rows = self.render_rows(entry.search_results)
+
+            self.walker[:] = rows
             self.viewing_previous_songs = False
             self.line_box.set_title(_("Search Results"))
 
             try:
-                self.set_focus(prev_focus)
+                self.set_focus(entry.focus)
             except:
                 pass
 
@@ -214,7 +649,9 @@ class SearchPanel(urwid.ListBox):
             title = _("Search Results")
 
         if not self.viewing_previous_songs:  # only remember search history
-            self.search_history.append((self.get_focus()[1], self.search_results))
+            self.search_history.push(
+                self.get_focus()[1], self.search_results, list(self.walker)
+            )
 
         self.viewing_previous_songs = isprevsong
         self.no_limit = no_limit
@@ -222,9 +659,68 @@ class SearchPanel(urwid.ListBox):
         self.set_search_results(categories)
         self.line_box.set_title(title)
 
-    def view_previous_songs(self, songs, yt_vids):
+    def set_filter(self, pattern):
+        """Narrows the recently played view to the songs and videos matching pattern."""
+        if self.filter_restore is None:
+            self.filter_restore = (self.search_results, list(self.walker), self.get_focus()[1])
+
+        objs = [obj for _, obj in self.app.history_index.filter(self.app.history, pattern)]
+        self.set_search_results(
+            [
+                [obj for obj in objs if isinstance(obj, Song)],
+                [obj for obj in objs if isinstance(obj, YTVideo)],
+                [obj for obj in objs if isinstance(obj, LocalTrack)],
+            ]
+        )
+
+    def move_filter_focus(self, delta):
+        """Moves the focus delta rows, skipping the category headings."""
+        focus = self.get_focus()[1]
+        if focus is None:
+            return
+
+        step = 1 if delta > 0 else -1
+        pos, remaining = focus, abs(delta)
+        while remaining and 0 <= pos + step < len(self.walker):
+            pos += step
+            if self.walker[pos].selectable():
+                focus = pos
+                remaining -= 1
+
+        self.walker.set_focus(focus)
+
+    def end_filter(self, accept):
+        if self.filter_restore is None:
+            return
+
+        chosen = self.selected_search_obj() if accept else None
+        self.search_results, rows, focus = self.filter_restore
+        self.filter_restore = None
+        self.walker[:] = rows
+
+        if chosen is not None:
+            focus = self.position_of(chosen, focus)
+        if focus is not None and focus < len(self.walker):
+            self.walker.set_focus(focus)
+
+    def position_of(self, obj, default=None):
+        """The walker position of obj in the current results."""
+        pos = 0
+
+        for category in self.search_results:
+            if category:
+                pos += 1
+
+                for item in category:
+                    if item is obj:
+                        return pos
+                    pos += 1
+
+        return default
+
+    def view_previous_songs(self, songs, yt_vids, local_tracks=()):
         self.update_search_results(
-            songs, yt_vids, title=_("Previous Songs"), isprevsong=True
+            songs, yt_vids, list(local_tracks), title=_("Previous Songs"), isprevsong=True
         )
 
     def set_search_results(self, categories):
@@ -239,17 +735,22 @@ class SearchPanel(urwid.ListBox):
 
         categories = [filter_none(cat) for cat in categories]
         self.search_results = self.SearchResults(categories)
-        self.walker.clear()
+        self.walker[:] = self.render_rows(self.search_results)
 
-        for category in self.search_results:
+        if self.walker:
+            self.walker.set_focus(1)
+
+    @staticmethod
+    def render_rows(search_results):
+        rows = []
+
+        for category in search_results:
             if category:
-                self.walker.append(type(category[0]).header())
+                rows.append(type(category[0]).header())
 
-            for item in category:
-                self.walker.append(item.ui())
+            rows.extend(item.ui() for item in category)
 
-        if self.walker:
-            self.walker.set_focus(1)
+        return rows
 
     def selected_search_obj(self):
         focus_id = self.walker.get_focus()[1]
@@ -268,6 +769,47 @@ class SearchPanel(urwid.ListBox):
             pass
 
 
+class StatsPanel(urwid.WidgetWrap):
+    def __init__(self, app):
+        self.app = app
+        self.text = urwid.Text("")
+        listbox = urwid.ListBox(urwid.SimpleListWalker([self.text]))
+        super().__init__(
+            urwid.AttrMap(urwid.LineBox(listbox, title=_("Stats")), "region_bg select")
+        )
+
+    def update(self):
+        snapshot = metrics.snapshot()
+        lines = [
+            "{:<34}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+                _("Latency (ms)"), _("Count"), "p50", "p90", "p99", _("Max")
+            )
+        ]
+
+        for name, summary in snapshot["latency"].items():
+            if not summary["count"]:
+                continue
+            lines.append(
+                "{:<34}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                    name,
+                    summary["count"],
+                    *(summary[q] * 1000 for q in ("p50", "p90", "p99", "max"))
+                )
+            )
+
+        if snapshot["counters"]:
+            lines.extend(["", _("Events")])
+            lines.extend(f"{name:<34}{value:>8}" for name, value in snapshot["counters"].items())
+
+        self.text.set_text("\n".join(lines))
+
+    def keypress(self, size, key):
+        if key == "esc" or key in controls["g_stats"]:
+            self.app.toggle_stats()
+        else:
+            return super().keypress(size, key)
+
+
 class PlayBar(urwid.ProgressBar):
     vol_inds = [" ", "▁", "▂", "▃", "▄", "▅", "▆", "▇", "█"]
 
@@ -298,6 +840,9 @@ class PlayBar(urwid.ProgressBar):
             if song.rating in (1, 5):
                 rating = "(" + RATE_UI[song.rating] + ")"
 
+        elif isinstance(song, LocalTrack):
+            artist = song.artist
+
         else:  # YTVideo
             artist = song.channel
 
@@ -322,53 +867,284 @@ class PlayBar(urwid.ProgressBar):
             self.set_completion(0)
 
 
+def queue_key(song):
+    return type(song).__name__, song.id
+
+
+class QueueMembership(Counter):
+    """
+    How many times each song, by queue_key, is in the queue, for O(1)
+    duplicate checks. Kept up to date as a QueuePanel listener.
+    """
+
+    def __init__(self, items):
+        super().__init__()
+        self.items = items
+
+    def queue_inserted(self, idx, songs):
+        for song in songs:
+            self[queue_key(song)] += 1
+
+    def queue_removed(self, idx, songs):
+        for song in songs:
+            key = queue_key(song)
+            self[key] -= 1
+            if self[key] <= 0:
+                del self[key]
+
+    def queue_reset(self):
+        self.clear()
+        self.queue_inserted(0, self.items())
+
+
 class QueuePanel(urwid.ListBox):
+    DEDUP_POLICIES = ("allow", "skip", "move")
+
+    # Beyond this many scattered removals, listeners get one queue_reset
+    max_notifications = 64
+
     def __init__(self, app):
 
         self.app = app
         self.walker = urwid.SimpleFocusListWalker([])
         self.queue = []
+        self.index = TokenIndex(lambda: self.queue)
+        self.members = QueueMembership(lambda: self.queue)
+        self.listeners = [self.index, self.members]
+        self.dedup = "allow"  # what to do when queueing a song that already is
+        self.line_box = None
+        self.filter_pattern = None  # set while the queue is being filtered
+        self.filter_positions = None  # queue positions of the rows shown then
+        self.filter_focus = None
+        self.mark = None  # anchor of the selected range, if one is being selected
+        self.keys = KeyDispatch(
+            "queue",
+            dict(
+                mark=lambda size, key: self.toggle_mark(),
+                filter=lambda size, key: self.app.search_input.start_filter(self),
+                remove_duplicates=lambda size, key: self.remove_duplicates(),
+                swap_up=lambda size, key: self.edit_keypress(size, "swap_up"),
+                swap_down=lambda size, key: self.edit_keypress(size, "swap_down"),
+                to_top=lambda size, key: self.edit_keypress(size, "to_top"),
+                to_bottom=lambda size, key: self.edit_keypress(size, "to_bottom"),
+                remove=lambda size, key: self.edit_keypress(size, "remove"),
+                down=lambda size, key: self.navigate(size, key, "down"),
+                up=lambda size, key: self.navigate(size, key, "up"),
+                expand=lambda size, key: self.app.expand(self.selected_queue_obj()),
+                play_pause=lambda size, key: self.play_pause(),
+            ),
+        )
         super().__init__(self.walker)
 
-    def add_song_to_queue(self, song, to_front=False):
+    def add_listener(self, listener):
+        """
+        Registers an object to be told about every change to the queue via
+        its queue_inserted(idx, songs), queue_removed(idx, songs) and
+        queue_reset() methods.
+        """
+        self.listeners.append(listener)
+
+    def notify(self, event, *args):
+        for listener in self.listeners:
+            getattr(listener, event)(*args)
+
+        if self.filter_pattern is not None:
+            self.set_filter(self.filter_pattern)
+
+    def set_filter(self, pattern):
+        """Shows only the songs matching pattern, focusing the first at or after the focus."""
+        if self.filter_pattern is None:
+            self.filter_focus = self.walker.get_focus()[1]
+        self.filter_pattern = pattern
+
+        matches = self.index.filter(self.queue, pattern)
+        self.filter_positions = [pos for pos, _ in matches]
+        self.body = urwid.SimpleFocusListWalker([self.walker[pos] for pos in self.filter_positions])
+
+        if self.filter_positions:
+            start = bisect_left(self.filter_positions, self.filter_focus or 0)
+            self.body.set_focus(min(start, len(self.filter_positions) - 1))
+
+    def move_filter_focus(self, delta):
+        focus = self.body.get_focus()[1]
+        if focus is not None and 0 <= focus + delta < len(self.body):
+            self.body.set_focus(focus + delta)
+
+    def end_filter(self, accept):
+        if self.filter_pattern is None:
+            return
 
-        if song:
+        focus = self.filter_focus
+        if accept and self.filter_positions:
+            focus = self.filter_positions[self.body.get_focus()[1]]
+
+        self.filter_pattern = self.filter_positions = self.filter_focus = None
+        self.body = self.walker
+
+        if focus is not None and focus < len(self.walker):
+            self.walker.set_focus(focus)
+
+    # The range operations below change the queue and the walker with slice
+    # assignments, whatever the size of the range, and send one notification
+    # per change.
+
+    def contains(self, song):
+        return self.members[queue_key(song)] > 0
+
+    def insert_songs(self, idx, songs, dedup=None):
+        """
+        Inserts songs at idx. Songs already in the queue are queued again,
+        skipped or moved to idx, depending on dedup (by default self.dedup).
+        """
+        dedup = dedup or self.dedup
+        songs = [song for song in songs if song]
+
+        if dedup != "allow":
+            seen = set()
+            songs = [
+                song for song in songs
+                if queue_key(song) not in seen and not seen.add(queue_key(song))
+            ]
+
+            if dedup == "skip":
+                songs = [song for song in songs if not self.contains(song)]
+            elif dedup == "move":
+                queued = {queue_key(song) for song in songs if self.contains(song)}
+                if queued:
+                    positions = [
+                        pos for pos, song in enumerate(self.queue) if queue_key(song) in queued
+                    ]
+                    self.remove_positions(positions)
+                    idx -= bisect_left(positions, idx)
+
+        if songs:
+            idx = max(0, min(idx, len(self.queue)))
+            self.queue[idx:idx] = songs
+            self.walker[idx:idx] = [song.ui() for song in songs]
+            self.notify("queue_inserted", idx, songs)
+
+    def remove_range(self, start, stop):
+        start, stop = max(0, start), min(stop, len(self.queue))
+
+        if start < stop:
+            removed = self.queue[start:stop]
+            del self.queue[start:stop]
+            del self.walker[start:stop]
+            self.notify("queue_removed", start, removed)
+
+    def remove_positions(self, positions):
+        """Removes the songs at the given (ascending) positions in one pass."""
+        if len(positions) <= 1:
+            for pos in positions:
+                self.remove_range(pos, pos + 1)
+            return
 
-            if to_front:
-                self.queue.insert(0, song)
-                self.walker.insert(0, song.ui())
+        drop = set(positions)
+        removed = [self.queue[pos] for pos in positions]
+        self.queue[:] = [song for pos, song in enumerate(self.queue) if pos not in drop]
+        self.walker[:] = [row for pos, row in enumerate(self.walker) if pos not in drop]
 
+        if len(positions) > self.max_notifications:
+            self.notify("queue_reset")
+        else:
+            for pos, song in reversed(list(zip(positions, removed))):
+                self.notify("queue_removed", pos, [song])
+
+    def remove_duplicates(self):
+        """Keeps only the first occurrence of every song, in one pass."""
+        seen = set()
+        duplicates = []
+
+        for pos, song in enumerate(self.queue):
+            key = queue_key(song)
+            if key in seen:
+                duplicates.append(pos)
             else:
-                self.queue.append(song)
-                self.walker.append(song.ui())
+                seen.add(key)
 
-    def add_songs_to_queue(self, songs, to_front=False):
+        self.remove_positions(duplicates)
+        return len(duplicates)
 
-        song_list = reversed(songs) if to_front else songs
+    def move_range(self, start, stop, dest):
+        """Moves queue[start:stop] so that it starts at dest once moved."""
+        start, stop = max(0, start), min(stop, len(self.queue))
+        dest = max(0, min(dest, len(self.queue) - (stop - start)))
 
-        for song in song_list:
-            self.add_song_to_queue(song, to_front)
+        if start >= stop or start == dest:
+            return
 
-    def add_album_to_queue(self, album, to_front=False):
+        # Cutting and pasting the block are two memmoves, which beats
+        # rebuilding the span in between for all but tiny queues.
+        songs, rows = self.queue[start:stop], self.walker[start:stop]
+        del self.queue[start:stop]
+        self.queue[dest:dest] = songs
+        del self.walker[start:stop]
+        self.walker[dest:dest] = rows
 
-        album_info = self.app.g_api.get_album_info(album.id)
-        track_list = (
-            reversed(album_info["tracks"]) if to_front else album_info["tracks"]
-        )
+        self.notify("queue_removed", start, songs)
+        self.notify("queue_inserted", dest, songs)
 
-        for track in track_list:
-            song = Song.from_dict(track)
-            self.add_song_to_queue(song, to_front)
+    def add_song_to_queue(self, song, to_front=False, dedup=None):
+        self.add_songs_to_queue([song], to_front, dedup)
 
-    def drop(self, idx):
+    def add_songs_to_queue(self, songs, to_front=False, dedup=None):
+        self.insert_songs(0 if to_front else len(self.queue), songs, dedup)
 
-        if 0 <= idx < len(self.queue):
-            self.queue.pop(idx)
-            self.walker.pop(idx)
+    def add_album_to_queue(self, album, to_front=False):
+        self.add_albums_to_queue([album], to_front)
+
+    def add_albums_to_queue(self, albums, to_front=False):
+        songs = [
+            Song.from_dict(track)
+            for album_info in self.app.get_albums_info([album.id for album in albums])
+            for track in album_info["tracks"]
+        ]
+        self.add_songs_to_queue(songs, to_front)
+
+    def drop(self, idx):
+        self.remove_range(idx, idx + 1)
 
     def clear(self):
         self.queue.clear()
         self.walker.clear()
+        self.set_mark(None)
+        self.notify("queue_reset")
+
+    def selection(self):
+        """The (start, stop) of the selected range, or of just the focused song."""
+        focus_id = self.walker.get_focus()[1]
+
+        if focus_id is None:
+            return None
+
+        anchor = focus_id if self.mark is None else min(self.mark, len(self.queue) - 1)
+        return min(anchor, focus_id), max(anchor, focus_id) + 1
+
+    def set_mark(self, mark):
+        self.mark = mark
+        self.update_title()
+
+    def update_title(self):
+        if self.line_box is None:
+            return
+
+        selection = self.selection() if self.mark is not None else None
+        if selection:
+            start, stop = selection
+            self.line_box.set_title(_("Queue ({} selected)").format(stop - start))
+        else:
+            self.line_box.set_title(_("Queue"))
+
+    def move_selection(self, start, stop, dest):
+        """Moves the selected range and keeps it selected (and focused) where it lands."""
+        dest = max(0, min(dest, len(self.queue) - (stop - start)))
+        focus_at_end = self.walker.get_focus()[1] == stop - 1
+
+        self.move_range(start, stop, dest)
+
+        if self.mark is not None:
+            self.mark = dest if focus_at_end else dest + stop - start - 1
+        self.walker.set_focus(dest + stop - start - 1 if focus_at_end else dest)
 
     def swap(self, idx1, idx2):
 
@@ -380,47 +1156,45 @@ class QueuePanel(urwid.ListBox):
             ui1, ui2 = self.walker[idx1], self.walker[idx2]
             self.walker[idx1], self.walker[idx2] = ui2, ui1
 
+            if idx1 != idx2:
+                lo, hi = sorted((idx1, idx2))
+                lo_obj, hi_obj = self.queue[hi], self.queue[lo]
+
+                self.notify("queue_removed", hi, [hi_obj])
+                self.notify("queue_inserted", lo, [hi_obj])
+                if hi > lo + 1:
+                    self.notify("queue_removed", lo + 1, [lo_obj])
+                    self.notify("queue_inserted", hi, [lo_obj])
+
     def to_top(self, idx):
 
         if 0 <= idx < len(self.queue):
-            obj = self.queue[idx]
-            del self.queue[idx]
-            self.queue = [obj] + self.queue
-
-            ui = self.walker[idx]
-            del self.walker[idx]
-            self.walker.insert(0, ui)
+            self.move_range(idx, idx + 1, 0)
 
     def to_bottom(self, idx):
 
         if 0 <= idx < len(self.queue):
-            obj = self.queue[idx]
-            del self.queue[idx]
-            self.queue.append(obj)
-
-            ui = self.walker[idx]
-            del self.walker[idx]
-            self.walker.append(ui)
+            self.move_range(idx, idx + 1, len(self.queue) - 1)
 
     def shuffle(self):
         from random import shuffle
 
         shuffle(self.queue)
+        self.walker[:] = [s.ui() for s in self.queue]
 
-        self.walker.clear()
-        for s in self.queue:
-            self.walker.append(s.ui())
+        self.notify("queue_reset")
 
     def play_next(self):
 
         while self.walker:
             self.walker.pop(0)
             next_song = self.queue.pop(0)
+            self.notify("queue_removed", 0, [next_song])
 
             if self.app.play(next_song):
                 
                 next_song.lastfm_scrobbled = False
-                if self.app.lastfm and isinstance(next_song, Song):
+                if self.app.lastfm and isinstance(next_song, (Song, LocalTrack)):
                     self.app.lastfm.update_now_playing_song(next_song)
                 break
         else:
@@ -429,14 +1203,14 @@ class QueuePanel(urwid.ListBox):
 
     def play_previous(self):
 
-        self.add_song_to_queue(self.app.current_song, to_front=True)
+        self.add_song_to_queue(self.app.current_song, to_front=True, dedup="allow")
 
         if self.app.current_song:
             self.app.pop_from_history()
 
         s = self.app.pop_from_history()
         if s:
-            self.add_song_to_queue(s, to_front=True)
+            self.add_song_to_queue(s, to_front=True, dedup="allow")
 
         self.play_next()
 
@@ -450,45 +1224,86 @@ class QueuePanel(urwid.ListBox):
             return
 
     def keypress(self, size, key):
+        if self.filter_pattern is not None:
+            # e.g. focused with the mouse while filtering
+            self.app.search_input.end_filter(accept=True, refocus=False)
+
         focus_id = self.walker.get_focus()[1]
 
         if focus_id is None:
             return super().keypress(size, key)
 
-        if key in controls["swap_up"]:
-            self.swap(focus_id, focus_id - 1)
-            self.keypress(size, "up")
+        handler = self.keys.get(key)
 
-        elif key in controls["swap_down"]:
-            self.swap(focus_id, focus_id + 1)
-            self.keypress(size, "down")
-
-        elif key in controls["to_top"]:
-            self.to_top(focus_id)
-            self.walker.set_focus(0)
+        if handler is not None:
+            handler(size, key)
 
-        elif key in controls["to_bottom"]:
-            self.to_bottom(focus_id)
-            self.walker.set_focus(len(self.walker) - 1)
+        elif key == "esc" and self.mark is not None:
+            self.set_mark(None)
 
-        elif key in controls["remove"]:
-            self.drop(focus_id)
+        else:
+            key = super().keypress(size, key)
+            self.update_title()
+            return key
 
-        elif key in controls["down"]:
-            super().keypress(size, "down")
+    def navigate(self, size, key, direction):
+        self.app.hold(key, self, size)
+        super().keypress(size, direction)
 
-        elif key in controls["up"]:
-            super().keypress(size, "up")
+        # Without a mark the title stays the same, so held keys skip it
+        if self.mark is not None:
+            self.update_title()
 
-        elif key in controls["expand"]:
-            self.app.expand(self.selected_queue_obj())
+    def move_focus(self, size, n):
+        move_list_focus(self, size, n)
 
-        elif key in controls["play_pause"]:
+        if self.mark is not None:
+            self.update_title()
 
-            if self.app.play_state == "stop":
-                self.play_next()
-            else:
-                self.app.toggle_play()
+    def toggle_mark(self):
+        self.set_mark(self.walker.get_focus()[1] if self.mark is None else None)
 
+    def play_pause(self):
+        if self.app.play_state == "stop":
+            self.play_next()
         else:
-            return super().keypress(size, key)
+            self.app.toggle_play()
+
+    def edit_keypress(self, size, action):
+        """The swap, move and remove actions, of the selected range if there is one."""
+        if self.mark is not None:
+            return self.range_keypress(action)
+
+        focus_id = self.walker.get_focus()[1]
+
+        if action == "swap_up":
+            self.swap(focus_id, focus_id - 1)
+            self.keypress(size, "up")
+        elif action == "swap_down":
+            self.swap(focus_id, focus_id + 1)
+            self.keypress(size, "down")
+        elif action == "to_top":
+            self.to_top(focus_id)
+            self.walker.set_focus(0)
+        elif action == "to_bottom":
+            self.to_bottom(focus_id)
+            self.walker.set_focus(len(self.walker) - 1)
+        elif action == "remove":
+            self.drop(focus_id)
+
+    def range_keypress(self, action):
+        start, stop = self.selection()
+
+        if action == "swap_up":
+            self.move_selection(start, stop, start - 1)
+        elif action == "swap_down":
+            self.move_selection(start, stop, start + 1)
+        elif action == "to_top":
+            self.move_selection(start, stop, 0)
+        elif action == "to_bottom":
+            self.move_selection(start, stop, len(self.queue))
+        elif action == "remove":
+            self.remove_range(start, stop)
+            self.mark = None
+
+        self.update_title()
@@ -3,45 +3,73 @@ def sec_to_min_sec(sec_tot):
     return s // 60, s % 60
 
 
-def lookup_keys(*key_ids):
+KEY_SERVER = "https://tuijam.fangmeier.tech"
+KEY_IDS = ("LASTFM_API_KEY", "LASTFM_API_SECRET", "GOOGLE_DEVELOPER_KEY")
+
+_server_keys = {}  # keys received from the key server during this run
+
+
+def query_key_server(host, key_ids, timeout=10, keypair=None):
+    """
+    Asks the key server at host for key_ids, returning {id: key} of those it
+    has. Raises requests.RequestException if the server can't be reached or
+    refuses the request.
+    """
     import base64
-    import yaml
     import rsa
     import requests
 
-    from tuijam import CONFIG_FILE
+    # Generate new RSA key pair. Do not reuse keys! (keypair is for load tests)
+    (pub, priv) = keypair or rsa.newkeys(512)
 
-    keys = [None] * len(key_ids)
-    # First, check if any are in configuration file
-    with open(CONFIG_FILE, "r") as f:
-        cfg = yaml.safe_load(f)
-        for idx, id_ in enumerate(key_ids):
-            try:
-                keys[idx] = cfg[id_]
-            except KeyError:
-                pass
-
-    # Next, if any unspecified in config file, ask the server for them
-    to_query = {}
-    for idx, (id_, key) in enumerate(zip(key_ids, keys)):
-        if key is None:
-            # keep track of position of each key so output order matches
-            to_query[id_] = idx
-
-    if to_query:
-        (pub, priv) = rsa.newkeys(512)  # Generate new RSA key pair. Do not reuse keys!
-        host = cfg.get("key_server", "https://tuijam.fangmeier.tech")
-
-        res = requests.post(
-            host, json={"public_key": pub.save_pkcs1().decode(), "ids": list(to_query)}
-        )
-
-        for id_, key_encrypted in res.json().items():
-            # On the server, the api key is encrypted with the public RSA key,
-            # and then base64 encoded to be delivered. Reverse that process here.
-            key_decrypted = rsa.decrypt(
-                base64.decodebytes(key_encrypted.encode()), priv
-            ).decode()
-            keys[to_query[id_]] = key_decrypted
+    res = requests.post(
+        host,
+        json={"public_key": pub.save_pkcs1().decode(), "ids": list(key_ids)},
+        timeout=timeout,
+    )
+    res.raise_for_status()
+
+    keys = {}
+    for id_, key_encrypted in res.json().items():
+        # On the server, the api key is encrypted with the public RSA key,
+        # and then base64 encoded to be delivered. Reverse that process here.
+        keys[id_] = rsa.decrypt(base64.decodebytes(key_encrypted.encode()), priv).decode()
 
     return keys
+
+
+def lookup_keys(*key_ids):
+    from .config import config as cfg
+
+    # First, check if any are in configuration file
+    # Next, if any unspecified in config file, ask the server for them. All
+    # keys TUIJam uses are asked for at once, which saves generating an RSA
+    # key pair and a round trip for each later lookup.
+    missing = [id_ for id_ in key_ids if id_ not in cfg and id_ not in _server_keys]
+    if missing:
+        to_query = set(missing) | {
+            id_ for id_ in KEY_IDS if id_ not in cfg and id_ not in _server_keys
+        }
+        host = cfg.get("key_server", KEY_SERVER)
+        _server_keys.update(query_key_server(host, sorted(to_query)))
+
+    return [cfg.get(id_, _server_keys.get(id_)) for id_ in key_ids]
+
+
+def _make_short_repr():
+    from reprlib import Repr
+
+    r = Repr()
+    r.maxlevel = 3
+    r.maxdict = r.maxlist = r.maxtuple = r.maxset = 8
+    r.maxstring = r.maxother = 120
+    return r
+
+
+_short_repr = _make_short_repr()
+
+
+def short_repr(obj, limit=1000):
+    """A repr of obj that stays short however big obj is, for log messages."""
+    text = _short_repr.repr(obj)
+    return text if len(text) <= limit else text[:limit] + "..."